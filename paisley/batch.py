@@ -0,0 +1,253 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_batch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Batching of requests to CouchDB.
+"""
+
+from twisted.internet import defer
+from twisted.web import error as tw_error
+
+# HTTP status codes for the errors _bulk_docs reports per document,
+# matching what the single document requests would have failed with
+BULK_ERRORS = {
+    'conflict': 409,
+    'forbidden': 403,
+    'unauthorized': 401,
+    'not_found': 404,
+}
+
+
+class _Batcher(object):
+    """
+    I collect calls per database in self._pending, and send each database's
+    calls in one request after a delay.
+    """
+
+    def __init__(self, couch, delay, send, clock=None):
+        """
+        @param send: called with the name of a database to send its pending
+                     calls in one request; returns a deferred firing when
+                     the request is done.
+        @type  send: callable
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._couch = couch
+        self._clock = clock
+        self._send = send
+        self.delay = delay
+
+        self._pending = {}
+        self._call = None
+
+    def flush(self, dbName=None):
+        """
+        Send the queued calls now.
+
+        @param dbName: if specified, only send the calls for this database.
+
+        @returns: a deferred that fires when all the requests sent are done.
+        @rtype:   L{defer.Deferred}
+        """
+        if dbName is None:
+            dbNames = self._pending.keys()
+        else:
+            dbNames = [dbName]
+
+        dl = [self._send(name) for name in dbNames if name in self._pending]
+
+        if not self._pending and self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        return defer.DeferredList(dl)
+
+    def _schedule(self):
+        if self._call is None:
+            self._call = self._clock.callLater(self.delay, self._timeout)
+
+    def _timeout(self):
+        self._call = None
+        self.flush()
+
+
+class BulkWriter(_Batcher):
+    """
+    I coalesce saveDoc and deleteDoc calls into _bulk_docs requests.
+
+    Calls are collected per database until either C{maxDocs} documents are
+    waiting, or C{delay} seconds have passed since the first of them.
+    Each caller gets a deferred that fires with the result for its own
+    document, like the result of L{client.CouchDB.saveDoc}, or errbacks with
+    a L{twisted.web.error.Error} when CouchDB refused that document, for
+    example with a 409 for a conflict.
+    """
+
+    def __init__(self, couch, maxDocs=100, delay=0.01, clock=None):
+        """
+        @param couch:   the client to send the requests with.
+        @type  couch:   L{client.CouchDB}
+        @param maxDocs: the number of documents that triggers a request.
+        @type  maxDocs: C{int}
+        @param delay:   the number of seconds calls are collected before the
+                        request is sent.
+        @type  delay:   C{float}
+        @param clock:   the clock to schedule the requests with; defaults to
+                        the reactor.
+        @type  clock:   L{twisted.internet.interfaces.IReactorTime}
+        """
+        _Batcher.__init__(self, couch, delay, self._bulkDocs, clock)
+        self.maxDocs = maxDocs
+        # self._pending is dbName -> list of (doc, deferred)
+
+    def saveDoc(self, dbName, body, docId=None):
+        """
+        Queue saving a document, as L{client.CouchDB.saveDoc}.
+
+        @rtype: L{defer.Deferred}
+        """
+        if isinstance(body, basestring):
+            body = self._couch.json.loads(body)
+        if docId is not None:
+            body = dict(body)
+            body['_id'] = unicode(docId)
+        return self._add(dbName, body)
+
+    def deleteDoc(self, dbName, docId, revision):
+        """
+        Queue deleting a document, as L{client.CouchDB.deleteDoc}.
+
+        @rtype: L{defer.Deferred}
+        """
+        return self._add(dbName, {
+            '_id': unicode(docId),
+            '_rev': unicode(revision),
+            '_deleted': True,
+        })
+
+    def _add(self, dbName, doc):
+        d = defer.Deferred()
+        queue = self._pending.setdefault(dbName, [])
+        queue.append((doc, d))
+
+        if len(queue) >= self.maxDocs:
+            self.flush(dbName)
+        else:
+            self._schedule()
+        return d
+
+    def _bulkDocs(self, dbName):
+        queue = self._pending.pop(dbName)
+        d = self._couch.bulkDocs(dbName, [doc for doc, _ in queue])
+
+        def bulkCb(results):
+            if len(results) != len(queue):
+                raise ValueError("_bulk_docs returned %d results for %d "
+                    "documents" % (len(results), len(queue)))
+            for result, (doc, deferred) in zip(results, queue):
+                if 'error' in result:
+                    code = BULK_ERRORS.get(result['error'], 500)
+                    deferred.errback(tw_error.Error(code,
+                        self._couch.json.dumps(result)))
+                else:
+                    result.setdefault('ok', True)
+                    deferred.callback(result)
+
+        def bulkEb(failure):
+            for doc, deferred in queue:
+                if not deferred.called:
+                    deferred.errback(failure)
+        d.addCallback(bulkCb)
+        d.addErrback(bulkEb)
+        return d
+
+
+class DocLoader(_Batcher):
+    """
+    I merge concurrent openDoc calls into _all_docs requests.
+
+    All documents asked for in the same reactor iteration are fetched with
+    one _all_docs request with include_docs, per database.  Each caller
+    gets a deferred that fires with its document, or errbacks with the same
+    404 L{twisted.web.error.Error} L{client.CouchDB.openDoc} would fail
+    with when the document is missing or deleted.
+    """
+
+    def __init__(self, couch, maxKeys=100, clock=None):
+        """
+        @param couch:   the client to send the requests with.
+        @type  couch:   L{client.CouchDB}
+        @param maxKeys: the number of documents that triggers a request.
+        @type  maxKeys: C{int}
+        @param clock:   the clock to schedule the requests with; defaults to
+                        the reactor.
+        @type  clock:   L{twisted.internet.interfaces.IReactorTime}
+        """
+        _Batcher.__init__(self, couch, 0, self._listDoc, clock)
+        self.maxKeys = maxKeys
+        # self._pending is dbName -> dict of docId -> list of deferreds
+
+    def openDoc(self, dbName, docId):
+        """
+        Queue opening a document, as L{client.CouchDB.openDoc}.
+
+        @type docId: C{unicode}
+
+        @rtype: L{defer.Deferred}
+        """
+        docId = unicode(docId)
+        d = defer.Deferred()
+        waiting = self._pending.setdefault(dbName, {})
+        waiting.setdefault(docId, []).append(d)
+
+        if len(waiting) >= self.maxKeys:
+            self.flush(dbName)
+        else:
+            self._schedule()
+        return d
+
+    def _listDoc(self, dbName):
+        waiting = self._pending.pop(dbName)
+        d = self._couch.listDoc(dbName, include_docs=True,
+            keys=waiting.keys())
+
+        def listCb(result):
+            for row in result['rows']:
+                deferreds = waiting.get(row.get('key'), [])
+                if 'error' in row:
+                    reason = row['error']
+                    if reason == 'not_found':
+                        reason = 'missing'
+                    self._notFound(deferreds, reason)
+                elif (row.get('value') or {}).get('deleted'):
+                    self._notFound(deferreds, 'deleted')
+                else:
+                    for deferred in deferreds:
+                        if not deferred.called:
+                            deferred.callback(row['doc'])
+
+            # CouchDB returns a row for every key; guard against it not
+            for deferreds in waiting.values():
+                self._notFound(deferreds, 'missing')
+
+        def listEb(failure):
+            for deferreds in waiting.values():
+                for deferred in deferreds:
+                    if not deferred.called:
+                        deferred.errback(failure)
+        d.addCallback(listCb)
+        d.addErrback(listEb)
+        return d
+
+    def _notFound(self, deferreds, reason):
+        body = self._couch.json.dumps({'error': 'not_found',
+            'reason': reason})
+        for deferred in deferreds:
+            if not deferred.called:
+                deferred.errback(tw_error.Error(404, body))
@@ -0,0 +1,393 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_bench -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Benchmarking paisley against a CouchDB server.
+
+A L{Scenario} sets up a database and exercises one operation, like
+openDoc.  L{run} calls an operation a number of times, with a given number
+of calls in flight, and returns a L{Result} with its latency percentiles
+and throughput.  Results are saved as JSON, and L{compare} flags the
+regressions against a stored baseline.
+
+See scripts/paisley_bench.py to run the scenarios.
+"""
+
+import itertools
+import math
+import time
+
+from twisted.internet import defer, task
+from twisted.web import error as tw_error
+
+from paisley import changes
+from paisley.client import json
+from paisley.metrics import PERCENTILES
+
+DOCUMENT = {
+    "Subject": "I like Plankton",
+    "Author": "Rusty",
+    "PostedDate": "2006-08-15T17:30:12-04:00",
+    "Tags": ["plankton", "baseball", "decisions"],
+    "Body": "I decided today that I don't like baseball. I like plankton.",
+}
+
+
+def percentile(values, percentile):
+    """
+    @param values: the values, sorted.
+    @type  values: C{list}
+
+    @returns: the nearest-rank percentile of the values, or None if there
+              are none.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(len(values) * percentile / 100.0)) - 1
+    return values[max(0, rank)]
+
+
+class Result(object):
+    """
+    I hold the outcome of running an operation.
+
+    @ivar latencies: the number of seconds every successful call took.
+    @ivar errors:    the number of failed calls per exception class name.
+    @ivar elapsed:   the number of seconds all calls took.
+    """
+
+    def __init__(self, name, concurrency, latencies, errors, elapsed):
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    def summary(self):
+        """
+        @returns: the name and concurrency, the number of requests and
+                  errors, the throughput in requests per second, and the
+                  mean, minimum, maximum, p50, p95 and p99 latency in
+                  seconds.
+        @rtype:   C{dict}
+        """
+        latencies = self.latencies
+        requests = len(latencies) + sum(self.errors.values())
+        result = {
+            'name': self.name,
+            'concurrency': self.concurrency,
+            'requests': requests,
+            'errors': dict(self.errors),
+            'elapsed': self.elapsed,
+            'throughput': requests / self.elapsed if self.elapsed else None,
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'min': latencies[0] if latencies else None,
+            'max': latencies[-1] if latencies else None,
+        }
+        for p in PERCENTILES:
+            result['p%d' % p] = percentile(latencies, p)
+        return result
+
+
+def run(operation, requests, concurrency=1, name='', timer=time.time):
+    """
+    Call operation requests times, with up to concurrency calls in flight.
+
+    A call starts as soon as another one finished, so the latency does not
+    include the time a request would have waited on an overloaded server
+    to be sent.
+
+    @param operation: called with the index of the call; returns a
+                      deferred.
+
+    @returns: a deferred firing with the L{Result}.
+    @rtype:   L{defer.Deferred}
+    """
+    latencies = []
+    errors = {}
+
+    def call(index):
+        start = timer()
+
+        def calledCb(_):
+            latencies.append(timer() - start)
+
+        def calledEb(failure):
+            errors[failure.type.__name__] = \
+                errors.get(failure.type.__name__, 0) + 1
+        return defer.maybeDeferred(operation, index).addCallbacks(
+            calledCb, calledEb)
+
+    # concurrency iterators take the next call from the same generator
+    calls = (call(index) for index in xrange(requests))
+    cooperator = task.Cooperator()
+    start = timer()
+    d = defer.DeferredList([cooperator.coiterate(calls)
+        for _ in range(concurrency)])
+
+    def ranCb(_):
+        cooperator.stop()
+        return Result(name, concurrency, latencies, errors, timer() - start)
+    return d.addCallback(ranCb)
+
+
+class Scenario(object):
+    """
+    I exercise one operation on a database of my own.
+
+    The operation is passed in, or defined as the operation method of a
+    subclass.
+
+    @cvar name: the name of the scenario.
+    """
+    name = None
+
+    def __init__(self, db, dbName, operation=None, name=None):
+        """
+        @type db:        L{paisley.client.CouchDB}
+        @param dbName:    the name of the database, which exists and is
+                          empty.
+        @param operation: called with the index of the call; returns a
+                          deferred.
+        @param name:      if specified, the name of the scenario.
+        """
+        if operation is not None:
+            self.operation = operation
+        elif not hasattr(self, 'operation'):
+            raise ValueError("Scenario needs an operation")
+        if name is not None:
+            self.name = name
+        self.db = db
+        self.dbName = dbName
+
+    def setUp(self):
+        return defer.succeed(None)
+
+    def tearDown(self):
+        return defer.succeed(None)
+
+    def populate(self, count):
+        """
+        Save count documents, with an index field counting from 0.
+        """
+        docs = [dict(DOCUMENT, index=index) for index in range(count)]
+        return self.db.bulkDocs(self.dbName, docs)
+
+
+class SaveDocScenario(Scenario):
+    name = 'saveDoc'
+
+    def operation(self, index):
+        return self.db.saveDoc(self.dbName, DOCUMENT)
+
+
+class OpenDocScenario(Scenario):
+    name = 'openDoc'
+
+    def setUp(self):
+        return self.db.saveDoc(self.dbName, DOCUMENT, docId='document')
+
+    def operation(self, index):
+        return self.db.openDoc(self.dbName, 'document')
+
+
+class OpenViewScenario(Scenario):
+    """
+    I open the first rows of a view on the documents.
+    """
+    name = 'openView-small'
+    documents = 1000
+    rows = 10
+
+    def setUp(self):
+        design = {"views": {"index": {
+            "map": "function(doc) { emit(doc.index, null); }"}}}
+        d = self.db.saveDoc(self.dbName, design, docId='_design/bench')
+        d.addCallback(lambda _: self.populate(self.documents))
+        # build the view index before timing it
+        d.addCallback(lambda _: self.operation(0))
+        return d
+
+    def operation(self, index):
+        return self.db.openView(self.dbName, 'bench', 'index',
+            limit=self.rows)
+
+
+class OpenLargeViewScenario(OpenViewScenario):
+    name = 'openView-large'
+    rows = 1000
+
+
+class ListDocScenario(Scenario):
+    name = 'listDoc-include_docs'
+    documents = 100
+
+    def setUp(self):
+        return self.populate(self.documents)
+
+    def operation(self, index):
+        return self.db.listDoc(self.dbName, include_docs=True)
+
+
+class AttachmentScenario(Scenario):
+    name = 'attachment'
+    size = 64 * 1024
+
+    def setUp(self):
+        document = dict(DOCUMENT)
+        self.db.addAttachments(document, {'data': 'x' * self.size})
+        return self.db.saveDoc(self.dbName, document, docId='document')
+
+    def operation(self, index):
+        return self.db.openDoc(self.dbName, 'document', attachment='data')
+
+
+class ChangesScenario(Scenario):
+    """
+    I save a document and wait until the change feed notifies of it.
+    """
+    name = 'changes'
+
+    def setUp(self):
+        self._waiting = {}
+        self._ids = itertools.count()
+        self.notifier = changes.ChangeNotifier(self.db, self.dbName)
+        self.notifier.addListener(self)
+        return self.notifier.start()
+
+    def operation(self, index):
+        docId = 'change-%d' % (self._ids.next(), )
+        d = self._waiting[docId] = defer.Deferred()
+
+        def savedEb(failure):
+            self._waiting.pop(docId).errback(failure)
+        self.db.saveDoc(self.dbName, DOCUMENT, docId=docId).addErrback(
+            savedEb)
+        return d
+
+    def tearDown(self):
+        self.notifier.stop()
+        return defer.succeed(None)
+
+    # ChangeListener
+
+    def changed(self, change):
+        d = self._waiting.pop(change['id'], None)
+        if d is not None:
+            d.callback(change)
+
+    def connectionLost(self, reason):
+        pass
+
+
+SCENARIOS = [SaveDocScenario, OpenDocScenario, OpenViewScenario,
+    OpenLargeViewScenario, ListDocScenario, AttachmentScenario,
+    ChangesScenario]
+
+
+@defer.inlineCallbacks
+def runScenario(scenarioClass, db, dbName, requests, concurrencies,
+                log=None):
+    """
+    Run a scenario on a new database, at every concurrency level.
+
+    @param scenarioClass: a L{Scenario} subclass, or any callable creating
+                          a L{Scenario} from db and dbName.
+    @param log:           if specified, called with a line of progress.
+
+    @returns: a deferred firing with the list of L{Result}.
+    @rtype:   L{defer.Deferred}
+    """
+    try:
+        yield db.deleteDB(dbName)
+    except tw_error.Error, e:
+        if int(e.status) != 404:
+            raise
+    yield db.createDB(dbName)
+
+    scenario = scenarioClass(db, dbName)
+    yield scenario.setUp()
+    results = []
+    try:
+        for concurrency in concurrencies:
+            result = yield run(scenario.operation, requests, concurrency,
+                name=scenario.name)
+            results.append(result)
+            if log is not None:
+                log(describe(result.summary()))
+    finally:
+        yield scenario.tearDown()
+    defer.returnValue(results)
+
+
+def describe(summary):
+    """
+    @returns: a line describing a result summary.
+    @rtype:   C{str}
+    """
+    line = '%-22s c=%-4d %8.1f req/s' % (summary['name'],
+        summary['concurrency'], summary['throughput'] or 0)
+    for p in PERCENTILES:
+        value = summary['p%d' % p]
+        line += '  p%d %8.2f ms' % (p, (value or 0) * 1000)
+    errors = sum(summary['errors'].values())
+    if errors:
+        line += '  %d errors' % (errors, )
+    return line
+
+
+def save(summaries, path):
+    handle = open(path, 'w')
+    try:
+        handle.write(json.dumps({'results': summaries}, indent=2,
+            sort_keys=True))
+    finally:
+        handle.close()
+
+
+def load(path):
+    handle = open(path)
+    try:
+        return json.loads(handle.read())['results']
+    finally:
+        handle.close()
+
+
+def compare(summaries, baseline, tolerance=0.1):
+    """
+    Compare result summaries to the summaries of a baseline run.
+
+    A result regressed if one of its latency percentiles grew, or its
+    throughput dropped, by more than the tolerance, as a fraction of the
+    baseline.  Results without a baseline are skipped.
+
+    @returns: a dict for every regression, with the name, concurrency,
+              metric, baseline and result values, and change as a fraction.
+    @rtype:   C{list} of C{dict}
+    """
+    baselines = dict(((s['name'], s['concurrency']), s) for s in baseline)
+    regressions = []
+    for summary in summaries:
+        base = baselines.get((summary['name'], summary['concurrency']))
+        if base is None:
+            continue
+        metrics = [('p%d' % p, 1) for p in PERCENTILES]
+        metrics.append(('throughput', -1))
+        for metric, sign in metrics:
+            old, new = base.get(metric), summary.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            if change * sign > tolerance:
+                regressions.append({
+                    'name': summary['name'],
+                    'concurrency': summary['concurrency'],
+                    'metric': metric,
+                    'baseline': old,
+                    'result': new,
+                    'change': change,
+                })
+    return regressions
@@ -0,0 +1,186 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_breaker -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Circuit breakers, to stop sending requests to an overloaded server.
+"""
+
+from twisted.internet import defer, error
+
+from paisley import client, retry
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """
+    The request was not sent, because the circuit for the server or
+    database is open.
+
+    @ivar key: the key of the circuit.
+    """
+
+    def __init__(self, key):
+        Exception.__init__(self, "circuit %r is open" % (key, ))
+        self.key = key
+
+
+def _isOverload(failure):
+    return bool(failure.check(error.ConnectError)) or \
+        retry._isTransient(failure)
+
+
+class _Circuit(object):
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.trials = 0
+
+
+class CircuitBreaker(object):
+    """
+    I stop requests to a server, or a database on it, that keeps failing.
+
+    A circuit is closed while requests succeed.  After failureThreshold
+    requests in a row failed because the server could not be reached or
+    answered 502, 503 or 504, it opens: requests fail right away with
+    L{CircuitOpenError}, giving the server time to recover.  After
+    resetTimeout seconds, it is half-open: up to halfOpenRequests requests
+    are let through to probe the server; if they succeed the circuit is
+    closed again, and if one fails it opens again.
+
+    Other errors, like 404 or 409, mean the server is answering, so they
+    count as successes.
+
+    @ivar onStateChange: if not None, called with the key, the old state and
+                         the new state when a circuit changes state.
+    """
+
+    def __init__(self, failureThreshold=5, resetTimeout=30,
+                 halfOpenRequests=1, perDatabase=False, onStateChange=None,
+                 clock=None):
+        """
+        @param failureThreshold: the number of failures in a row that open
+                                 a circuit.
+        @type  failureThreshold: C{int}
+        @param resetTimeout:     the number of seconds a circuit stays open.
+        @type  resetTimeout:     C{float}
+        @param halfOpenRequests: the number of requests let through at the
+                                 same time by a half-open circuit.
+        @type  halfOpenRequests: C{int}
+        @param perDatabase:      whether to keep a circuit per database
+                                 instead of per server.
+        @type  perDatabase:      C{bool}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.halfOpenRequests = halfOpenRequests
+        self.perDatabase = perDatabase
+        self.onStateChange = onStateChange
+        self._circuits = {}
+
+    def key(self, host, port, uri):
+        """
+        @returns: the key of the circuit for a request to uri on the given
+                  server.
+        @rtype:   C{tuple}
+        """
+        if not self.perDatabase:
+            return (host, port)
+        return (host, port, client._uriDbName(uri))
+
+    def state(self, key):
+        """
+        @returns: the state of the circuit with the given key.
+        @rtype:   C{str}
+        """
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            return CLOSED
+        self._checkReset(key, circuit)
+        return circuit.state
+
+    def states(self):
+        """
+        @returns: the state of every circuit that was used.
+        @rtype:   C{dict}
+        """
+        return dict((key, self.state(key)) for key in self._circuits)
+
+    def _setState(self, key, circuit, state):
+        if circuit.state == state:
+            return
+        old, circuit.state = circuit.state, state
+        if state == OPEN:
+            circuit.openedAt = self._clock.seconds()
+        elif state == CLOSED:
+            circuit.failures = 0
+        if self.onStateChange is not None:
+            self.onStateChange(key, old, state)
+
+    def _checkReset(self, key, circuit):
+        if circuit.state == OPEN and self._clock.seconds() >= \
+                circuit.openedAt + self.resetTimeout:
+            self._setState(key, circuit, HALF_OPEN)
+
+    def call(self, key, f, *args, **kwargs):
+        """
+        Call f through the circuit with the given key.
+
+        @param f: a callable returning a deferred.
+
+        @returns: the deferred returned by f, or a deferred failing with
+                  L{CircuitOpenError}.
+        @rtype:   L{defer.Deferred}
+        """
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = _Circuit()
+        self._checkReset(key, circuit)
+
+        if circuit.state == OPEN or (circuit.state == HALF_OPEN and
+                circuit.trials >= self.halfOpenRequests):
+            return defer.fail(CircuitOpenError(key))
+
+        trial = circuit.state == HALF_OPEN
+        if trial:
+            circuit.trials += 1
+
+        def succeeded():
+            circuit.failures = 0
+            if circuit.state == HALF_OPEN:
+                self._setState(key, circuit, CLOSED)
+
+        def callCb(result):
+            if trial:
+                circuit.trials -= 1
+            succeeded()
+            return result
+
+        def callEb(failure):
+            if trial:
+                circuit.trials -= 1
+            if failure.check(defer.CancelledError):
+                return failure
+            if not _isOverload(failure):
+                succeeded()
+                return failure
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or \
+                    circuit.failures >= self.failureThreshold:
+                self._setState(key, circuit, OPEN)
+            return failure
+
+        return defer.maybeDeferred(f, *args, **kwargs).addCallbacks(
+            callCb, callEb)
@@ -0,0 +1,482 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Caches for CouchDB results.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from paisley import changes
+from paisley.client import json
+
+
+def _jsonSize(doc):
+    return len(json.dumps(doc))
+
+
+class DocumentCache(object):
+    """
+    I am a least recently used cache of the documents of one database,
+    fronting L{client.CouchDB.openDoc}.
+
+    Add me to a L{changes.ChangeNotifier} for the same database with
+    addCache so that changed documents are dropped from me.
+
+    The cached documents are handed out as they are, so callers should not
+    modify them.
+
+    @ivar hits:          the number of documents served from the cache.
+    @ivar misses:        the number of documents fetched from the server.
+    @ivar evictions:     the number of documents dropped to make room.
+    @ivar invalidations: the number of documents dropped because they
+                         changed.
+    """
+
+    def __init__(self, couch, dbName, maxEntries=1000, maxBytes=None,
+                 ttl=None, sizeof=_jsonSize, clock=None):
+        """
+        @param couch:      the client to fetch documents with.
+        @type  couch:      L{client.CouchDB}
+        @param dbName:     the database to cache documents of.
+        @type  dbName:     C{str}
+        @param maxEntries: if not None, the maximum number of documents.
+        @type  maxEntries: C{int}
+        @param maxBytes:   if not None, the maximum total size of the
+                           documents, as computed by sizeof.
+        @type  maxBytes:   C{int}
+        @param ttl:        if not None, the number of seconds a document
+                           stays valid.
+        @type  ttl:        C{float}
+        @param sizeof:     computes the size of a document; by default the
+                           length of its JSON serialization.
+        @type  sizeof:     callable
+        @param clock:      the clock to expire documents with; defaults to
+                           the reactor.
+        @type  clock:      L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._couch = couch
+        self._dbName = dbName
+        self._clock = clock
+        self._sizeof = sizeof
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+
+        # docId -> (doc, size, expires), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # docId -> list of deferreds waiting for the document
+        self._fetching = {}
+        # documents that changed while they were being fetched
+        self._stale = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, docId):
+        # unlike get, this does not count as using the document
+        entry = self._entries.get(docId)
+        if entry is None:
+            return False
+        expires = entry[2]
+        return expires is None or expires > self._clock.seconds()
+
+    def openDoc(self, docId):
+        """
+        Open a document from the cache, or from the server when it is not
+        cached.
+
+        @type docId: C{unicode}
+
+        @rtype: L{defer.Deferred}
+        """
+        docId = unicode(docId)
+        doc = self.get(docId)
+        if doc is not None:
+            return defer.succeed(doc)
+
+        d = defer.Deferred()
+        if docId in self._fetching:
+            self._fetching[docId].append(d)
+            return d
+
+        self._fetching[docId] = [d]
+        self._stale.discard(docId)
+
+        def openCb(doc):
+            deferreds = self._fetching.pop(docId)
+            if docId in self._stale:
+                self._stale.discard(docId)
+            else:
+                self.set(docId, doc)
+            for deferred in deferreds:
+                deferred.callback(doc)
+
+        def openEb(failure):
+            self._stale.discard(docId)
+            for deferred in self._fetching.pop(docId):
+                deferred.errback(failure)
+
+        self._couch.openDoc(self._dbName, docId).addCallbacks(openCb, openEb)
+        return d
+
+    def get(self, docId, count=True):
+        """
+        Get a document from the cache.
+
+        @returns: the document, or None if it is not cached.
+        """
+        entry = self._entries.pop(docId, None)
+        if entry is not None:
+            doc, size, expires = entry
+            if expires is None or expires > self._clock.seconds():
+                # move to the most recently used end
+                self._entries[docId] = entry
+                if count:
+                    self.hits += 1
+                return doc
+            self._bytes -= size
+
+        if count:
+            self.misses += 1
+        return None
+
+    def set(self, docId, doc):
+        """
+        Store a document in the cache.
+        """
+        self._remove(docId)
+
+        size = self._sizeof(doc) if self.maxBytes is not None else 0
+        if self.maxBytes is not None and size > self.maxBytes:
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock.seconds() + self.ttl
+        self._entries[docId] = (doc, size, expires)
+        self._bytes += size
+
+        while (self.maxEntries is not None
+               and len(self._entries) > self.maxEntries) \
+                or (self.maxBytes is not None
+                    and self._bytes > self.maxBytes):
+            oldId, (_, oldSize, _) = self._entries.popitem(last=False)
+            self._bytes -= oldSize
+            self.evictions += 1
+
+    def delete(self, docId):
+        """
+        Drop a document from the cache because it changed.
+
+        Called by L{changes.ChangeNotifier} for every change.
+        """
+        if docId in self._fetching:
+            self._stale.add(docId)
+        if self._remove(docId):
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop all documents from the cache.
+        """
+        self._stale.update(self._fetching.keys())
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        """
+        @returns: the counters and the current size of the cache.
+        @rtype:   C{dict}
+        """
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def _remove(self, docId):
+        entry = self._entries.pop(docId, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        return True
+
+
+class ETagCache(object):
+    """
+    I store parsed results with their ETag, for conditional requests by
+    L{client.CouchDB} when passed as its etagCache.
+
+    The cached results are handed out as they are, so callers should not
+    modify them.
+
+    @ivar hits:      the number of results the server did not send again
+                     because they did not change.
+    @ivar misses:    the number of results the server sent.
+    @ivar evictions: the number of results dropped to make room.
+    """
+
+    def __init__(self, maxEntries=1000):
+        """
+        @param maxEntries: the maximum number of results stored.
+        @type  maxEntries: C{int}
+        """
+        self.maxEntries = maxEntries
+
+        # (host, port, uri) -> (etag, result), least recently used first
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host, port, uri):
+        """
+        @returns: the (etag, result) stored for the uri on the given server,
+                  or None.
+        """
+        key = (host, port, uri)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+        return entry
+
+    def set(self, host, port, uri, etag, result):
+        """
+        Store the result received for the uri on the given server with its
+        ETag.
+        """
+        key = (host, port, uri)
+        self.misses += 1
+        self._entries.pop(key, None)
+        self._entries[key] = (etag, result)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def notModified(self, host, port, uri):
+        """
+        Note that the server did not send the result for the uri again.
+        """
+        self.hits += 1
+
+    def delete(self, host, port, uri):
+        """
+        Drop the result stored for the uri on the given server.
+        """
+        self._entries.pop((host, port, uri), None)
+
+    def clear(self):
+        """
+        Drop all results.
+        """
+        self._entries.clear()
+
+    def stats(self):
+        """
+        @returns: the counters and the current size of the cache.
+        @rtype:   C{dict}
+        """
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class _ViewListener(changes.ChangeListener):
+    """
+    I keep a L{ViewCache} up to date with the update_seq of a database from
+    its change feed.
+    """
+
+    def __init__(self, viewCache, dbName):
+        self._viewCache = viewCache
+        self._dbName = dbName
+
+    def changed(self, change):
+        self._viewCache.noteUpdateSeq(self._dbName, change['seq'], live=True)
+
+    def connectionLost(self, reason):
+        self._viewCache.forgetUpdateSeq(self._dbName)
+
+
+class ViewCache(object):
+    """
+    I am a least recently used cache of view results, fronting
+    L{client.CouchDB.openView}.
+
+    A result stays valid as long as the update_seq of its database does not
+    change.  The update_seq is asked with infoDB, at most once every
+    checkInterval seconds per database, or followed through a change feed:
+    add the listener returned by L{listener} to a L{changes.ChangeNotifier}
+    for the database to save those requests.
+
+    Since I have the same openView method as L{client.CouchDB}, I can be
+    passed to L{views.View} in place of the client.
+
+    The cached results are handed out as they are, so callers should not
+    modify them.
+    """
+
+    def __init__(self, couch, maxEntries=100, maxBytes=None,
+                 checkInterval=0, sizeof=_jsonSize, clock=None):
+        """
+        @param couch:         the client to query with.
+        @type  couch:         L{client.CouchDB}
+        @param maxEntries:    if not None, the maximum number of results.
+        @type  maxEntries:    C{int}
+        @param maxBytes:      if not None, the maximum total size of the
+                              results, as computed by sizeof.
+        @type  maxBytes:      C{int}
+        @param checkInterval: the number of seconds an update_seq asked with
+                              infoDB is trusted; 0 asks it for every query.
+        @type  checkInterval: C{float}
+        @param sizeof:        computes the size of a result; by default the
+                              length of its JSON serialization.
+        @type  sizeof:        callable
+        @param clock:         defaults to the reactor.
+        @type  clock:         L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._couch = couch
+        self._clock = clock
+        self._sizeof = sizeof
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.checkInterval = checkInterval
+
+        # key -> (result, size, update_seq), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # dbName -> (update_seq, time it was checked, or None if live)
+        self._seqs = {}
+        # (dbName, docId, viewId) -> {'hits': ..., 'misses': ...}
+        self._stats = {}
+
+    def listener(self, dbName):
+        """
+        @returns: a listener to add to a L{changes.ChangeNotifier} for the
+                  database, keeping my update_seq for it current.
+        @rtype:   L{changes.ChangeListener}
+        """
+        return _ViewListener(self, dbName)
+
+    def noteUpdateSeq(self, dbName, seq, live=False):
+        """
+        Note the current update_seq of a database.
+
+        @param live: whether the update_seq will be kept current, so it does
+                     not have to be checked again.
+        """
+        self._seqs[dbName] = (seq, None if live else self._clock.seconds())
+
+    def forgetUpdateSeq(self, dbName):
+        """
+        Forget the update_seq of a database, so it is checked again.
+        """
+        self._seqs.pop(dbName, None)
+
+    def openView(self, dbName, docId, viewId, **kwargs):
+        """
+        Open a view from the cache, or from the server when the database
+        changed since the cached result was received.
+
+        @rtype: L{defer.Deferred}
+        """
+        key = (dbName, docId, viewId, json.dumps(sorted(kwargs.items())))
+        stats = self._stats.setdefault((dbName, docId, viewId),
+            {'hits': 0, 'misses': 0})
+
+        d = self._updateSeq(dbName)
+
+        def seqCb(seq):
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+                if entry[2] == seq:
+                    stats['hits'] += 1
+                    self._store(key, entry)
+                    return entry[0]
+
+            stats['misses'] += 1
+            d = self._couch.openView(dbName, docId, viewId, **kwargs)
+
+            def viewCb(result):
+                size = 0
+                if self.maxBytes is not None:
+                    size = self._sizeof(result)
+                self._store(key, (result, size, seq))
+                return result
+            return d.addCallback(viewCb)
+        return d.addCallback(seqCb)
+
+    def stats(self):
+        """
+        @returns: the hits and misses per (dbName, docId, viewId).
+        @rtype:   C{dict}
+        """
+        return dict((k, v.copy()) for k, v in self._stats.items())
+
+    def clear(self):
+        """
+        Drop all results.
+        """
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _updateSeq(self, dbName):
+        if dbName in self._seqs:
+            seq, checked = self._seqs[dbName]
+            if checked is None or \
+                    self._clock.seconds() - checked < self.checkInterval:
+                return defer.succeed(seq)
+
+        d = self._couch.infoDB(dbName)
+
+        def infoCb(info):
+            seq = info['update_seq']
+            # a change feed may have started meanwhile
+            if dbName not in self._seqs or self._seqs[dbName][1] is not None:
+                self.noteUpdateSeq(dbName, seq)
+            return seq
+        return d.addCallback(infoCb)
+
+    def _store(self, key, entry):
+        if self.maxBytes is not None and entry[1] > self.maxBytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry[1]
+        while (self.maxEntries is not None
+               and len(self._entries) > self.maxEntries) \
+                or (self.maxBytes is not None
+                    and self._bytes > self.maxBytes):
+            _, oldEntry = self._entries.popitem(last=False)
+            self._bytes -= oldEntry[1]
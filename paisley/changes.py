@@ -9,6 +9,7 @@ from urllib import urlencode
 from twisted.internet import error, defer
 from twisted.protocols import basic
 
+from paisley import client
 from paisley.client import json
 
 
@@ -17,14 +18,15 @@ class ChangeReceiver(basic.LineReceiver):
     # lines
     delimiter = '\n'
 
-    def __init__(self, notifier):
+    def __init__(self, notifier, loads=None):
         self._notifier = notifier
+        self._loads = loads or json.loads
 
     def lineReceived(self, line):
         if not line:
             return
 
-        change = json.loads(line)
+        change = self._loads(line)
 
         if not 'id' in change:
             return
@@ -71,12 +73,19 @@ class ChangeNotifier(object):
         self._caches = []
         self._listeners = []
         self._prot = None
+        self._starting = None
 
         self._since = since
 
         self._running = False
 
     def addCache(self, cache):
+        """
+        Add a cache to drop changed documents from, like
+        L{paisley.cache.DocumentCache}.
+
+        The cache should implement delete(docId).
+        """
         self._caches.append(cache)
 
     def addListener(self, listener):
@@ -91,6 +100,9 @@ class ChangeNotifier(object):
         Separated from __init__ so you can add caches and listeners.
 
         By default, I will start listening from the most recent change.
+
+        Cancelling the returned deferred, or calling L{stop} before it
+        fired, aborts the request for the changes.
         """
         assert 'feed' not in kwargs, \
             "ChangeNotifier always listens continuously."
@@ -113,8 +125,14 @@ class ChangeNotifier(object):
             return self._db.client.request('GET', url)
         d.addCallback(lambda _: requestChanges())
 
+        def cancelledEb(failure):
+            if client._isCancelled(failure):
+                raise defer.CancelledError()
+            return failure
+        d.addErrback(cancelledEb)
+
         def requestCb(response):
-            self._prot = ChangeReceiver(self)
+            self._prot = ChangeReceiver(self, self._db.json.loads)
             response.deliverBody(self._prot)
             self._running = True
         d.addCallback(requestCb)
@@ -122,6 +140,13 @@ class ChangeNotifier(object):
         def returnCb(_):
             return self._since
         d.addCallback(returnCb)
+
+        def startedBoth(result):
+            self._starting = None
+            return result
+        # cleared right away if the request was not needed
+        self._starting = d
+        d.addBoth(startedBoth)
         return d
 
     def stop(self):
@@ -131,6 +156,11 @@ class ChangeNotifier(object):
         # stopProducing can be used to stop delivery permanently; after this,
         # the protocol's connectionLost method will be called."
         self._running = False
+        if self._starting is not None:
+            self._starting.cancel()
+            return
+        # drop the changes received but not handled yet
+        self._prot.clearLineBuffer()
         self._prot.stopProducing()
 
     # called by receiver
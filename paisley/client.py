@@ -9,19 +9,23 @@ CouchDB client.
 """
 
 from paisley import pjson as json
+from paisley import stream
 
 from encodings import utf_8
 import logging
-import new
+import random
 
-from urllib import urlencode, quote
+from urllib import urlencode, quote, unquote
 from zope.interface import implements
 
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 
-from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.defer import CancelledError, Deferred, maybeDeferred
+from twisted.internet.defer import succeed
+from twisted.internet.error import TimeoutError
 from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
 
 try:
     from base64 import b64encode
@@ -36,6 +40,17 @@ except ImportError:
 def _namequote(name):
     return quote(name, safe='')
 
+
+def _uriDbName(uri):
+    """
+    Return the name of the database a request uri is for, or None for
+    server-wide resources like /_all_dbs.
+    """
+    dbName = uri.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+    if not dbName or dbName.startswith('_'):
+        return None
+    return unquote(dbName)
+
 def short_print(body, trim=255):
     # don't go nuts on possibly huge log entries
     # since we're a library we should try to avoid calling this and instead
@@ -68,6 +83,310 @@ except ImportError:
 
 SOCK_TIMEOUT = 300
 
+# since this is the db layer, and we generate a lot of logs, let people
+# disable them completely if they want to; clients created with disable_log
+# log to this logger, which is above every level
+_nullLog = logging.getLogger('paisley.disabled')
+_nullLog.setLevel(logging.CRITICAL + 1)
+_nullLog.propagate = False
+
+
+def _isCancelled(failure):
+    """
+    Return whether the failure of an Agent request is due to cancelling it;
+    Agent wraps the L{CancelledError} of a request cancelled before its
+    response arrived.
+    """
+    # _newclient imports reactor
+    from twisted.web._newclient import ResponseFailed, ResponseNeverReceived
+    if failure.check(CancelledError):
+        return True
+    if failure.check(ResponseFailed, ResponseNeverReceived):
+        for reason in failure.value.reasons:
+            if reason.check(CancelledError):
+                return True
+    return False
+
+
+class RequestTimeoutError(Exception):
+    """
+    A request took longer than allowed, and was aborted.
+
+    @ivar uri:     the uri of the request.
+    @ivar phase:   the phase the request was in: 'connect', 'response' while
+                   waiting for the response headers, or 'body' while
+                   receiving the response body.
+    @ivar elapsed: the number of seconds since the request started.
+    """
+
+    def __init__(self, uri, phase, elapsed):
+        Exception.__init__(self, "%s timed out in %s phase after %.3f seconds"
+            % (uri, phase, elapsed))
+        self.uri = uri
+        self.phase = phase
+        self.elapsed = elapsed
+
+
+class _Deadline(object):
+    """
+    I cancel a request whose response headers or body take too long.
+
+    @ivar phase:    'connect' while connecting, 'response' until the
+                    response headers are received, 'body' after.
+    @ivar expired:  whether I cancelled the request.
+    @ivar response: the response, once its headers are received.
+    @ivar receiver: the protocol receiving the response body.
+    @ivar timing:   the L{RequestTiming} of the request, if its phases are
+                    timed.
+    """
+
+    def __init__(self, clock, timeout, firstByteTimeout):
+        self._clock = clock
+        self.start = clock.seconds()
+        self.timeout = timeout
+        self.firstByteTimeout = firstByteTimeout
+        self.phase = 'response'
+        self.expired = False
+        self.deferred = None
+        self.response = None
+        self.receiver = None
+        self.timing = None
+        self._call = None
+        self._schedule()
+
+    def _schedule(self):
+        self.stop()
+        timeouts = [self.timeout]
+        if self.phase != 'body':
+            timeouts.append(self.firstByteTimeout)
+        timeouts = [t for t in timeouts if t is not None]
+        if timeouts:
+            delay = self.start + min(timeouts) - self._clock.seconds()
+            self._call = self._clock.callLater(max(0, delay), self._expire)
+
+    def connecting(self):
+        """
+        A new connection is being made for the request.
+        """
+        self.phase = 'connect'
+        if self.timing is not None:
+            self.timing.connectStart = self.timing.seconds()
+
+    def connected(self):
+        """
+        The connection for the request was made.
+        """
+        if self.phase == 'connect':
+            self.phase = 'response'
+        if self.timing is not None:
+            self.timing.connected = self.timing.seconds()
+
+    def received(self, response, receiver):
+        """
+        The response headers were received.
+        """
+        self.response = response
+        self.receiver = receiver
+        self.phase = 'body'
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def elapsed(self):
+        return self._clock.seconds() - self.start
+
+    def outcome(self, result):
+        """
+        @param result: the result or failure of the request.
+
+        @returns: the status of the response, or the name of the exception
+                  the request failed with before one was received, and the
+                  number of bytes of the response body received.
+        @rtype:   C{tuple}
+        """
+        if self.response is not None:
+            return self.response.code, self.receiver.received
+        if isinstance(result, Failure):
+            return result.type.__name__, 0
+        return None, 0
+
+    def _expire(self):
+        self._call = None
+        self.expired = True
+        self.deferred.cancel()
+
+
+# the phases of a request timed by RequestTiming
+PHASES = ('connect', 'firstByte', 'body', 'decode', 'parse')
+
+
+class RequestTiming(object):
+    """
+    I hold how long the phases of a request took, in seconds.
+
+    @ivar connect:   connecting; 0 if an idle connection was reused, and
+                     None if it could not be measured.
+    @ivar firstByte: from sending the request, after connecting, to
+                     receiving the response headers; mostly the time the
+                     server took.
+    @ivar body:      receiving the response body, including decoding it.
+    @ivar decode:    decoding the response body from UTF-8.
+    @ivar parse:     parsing the JSON response; None if it was not parsed,
+                     as for attachments.
+    @ivar total:     from starting the request to receiving the response
+                     body.
+    @ivar reused:    whether an idle connection was reused.
+    @ivar status:    the HTTP status, or the name of the exception the
+                     request failed with before one was received.
+    @ivar received:  the number of bytes of the response body.
+    @ivar rows:      the number of rows of a view result, or None.
+    """
+
+    def __init__(self, method, uri, descr, dbName, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self.method = method
+        self.uri = uri
+        self.descr = descr
+        self.dbName = dbName
+        self.status = None
+        self.received = 0
+        self.rows = None
+
+        self.start = self.seconds()
+        self.connectStart = None
+        self.connected = None
+        self.headers = None
+        self.done = None
+
+        self.decode = 0.0
+        self.parse = None
+
+    def seconds(self):
+        """
+        @returns: the current time, to time a phase with.
+        @rtype:   C{float}
+        """
+        return self._clock.seconds()
+
+    def _phase(self, start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def reused(self):
+        return self.connectStart is None
+
+    @property
+    def connect(self):
+        if self.reused:
+            return 0.0
+        return self._phase(self.connectStart, self.connected)
+
+    @property
+    def firstByte(self):
+        return self._phase(self.connected or self.start, self.headers)
+
+    @property
+    def body(self):
+        return self._phase(self.headers, self.done)
+
+    @property
+    def total(self):
+        return self._phase(self.start, self.done)
+
+    def phases(self):
+        """
+        @returns: the duration of every phase that was measured.
+        @rtype:   C{dict} of C{str} -> C{float}
+        """
+        result = {}
+        for phase in PHASES:
+            duration = getattr(self, phase)
+            if duration is not None:
+                result[phase] = duration
+        return result
+
+
+class _DeadlineEndpoint(object):
+
+    def __init__(self, endpoint, deadline):
+        self._endpoint = endpoint
+        self._deadline = deadline
+
+    def connect(self, protocolFactory):
+        deadline = self._deadline
+        deadline.connecting()
+
+        def connectedCb(protocol):
+            deadline.connected()
+            return protocol
+        return self._endpoint.connect(protocolFactory).addCallback(
+            connectedCb)
+
+
+class _DeadlineEndpointFactory(object):
+    """
+    I wrap the endpoint factory of an Agent, to tell the deadline of the
+    request being sent when it connects, so that a timeout is reported in
+    the right phase and connecting is timed.
+
+    Agent has no public hook for this, so I depend on its private
+    _endpointFactory attribute; Agent.request asks it for the endpoint
+    synchronously, so the deadline set around that call is the one of the
+    request being sent.  Without the attribute, a request is taken to be
+    connected when it is sent.
+
+    @ivar deadline: the L{_Deadline} of the request being sent.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self.deadline = None
+
+    def endpointForURI(self, uri):
+        endpoint = self._factory.endpointForURI(uri)
+        if self.deadline is None:
+            return endpoint
+        return _DeadlineEndpoint(endpoint, self.deadline)
+
+
+def makePool(maxPersistentPerHost=2, cachedConnectionTimeout=240,
+             retryAutomatically=True):
+    """
+    Create a persistent HTTP connection pool.
+
+    The same pool can be passed to several L{CouchDB} instances, so that
+    clients talking to the same server share their idle connections.
+
+    @param maxPersistentPerHost:    the maximum number of idle connections
+                                    kept open per host and port.
+    @type  maxPersistentPerHost:    C{int}
+    @param cachedConnectionTimeout: the number of seconds an idle connection
+                                    is kept open before it is closed.
+    @type  cachedConnectionTimeout: C{int}
+    @param retryAutomatically:      whether to retry an idempotent request
+                                    once when it fails on a cached connection
+                                    the server already closed.
+    @type  retryAutomatically:      C{bool}
+
+    @rtype: L{twisted.web.client.HTTPConnectionPool}
+    """
+    from twisted.internet import reactor
+    # t.w.c imports reactor
+    from twisted.web.client import HTTPConnectionPool
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = maxPersistentPerHost
+    pool.cachedConnectionTimeout = cachedConnectionTimeout
+    pool.retryAutomatically = retryAutomatically
+    return pool
+
 
 class StringProducer(object):
     """
@@ -94,14 +413,36 @@ class ResponseReceiver(Protocol):
     Assembles HTTP response from return stream.
     """
 
-    def __init__(self, deferred, decode_utf8):
+    def __init__(self, deferred, decode_utf8, timing=None):
         self.recv_chunks = []
         self.decoder = utf_8.IncrementalDecoder() if decode_utf8 else None
         self.deferred = deferred
+        self.aborted = False
+        self.received = 0
+        self.timing = timing
+
+    def abort(self):
+        """
+        Stop receiving the response, closing its connection.
+
+        The deferred is left to the caller, which cancelled it.
+        """
+        self.aborted = True
+        self.recv_chunks = []
+        if self.transport is not None:
+            self.transport.stopProducing()
 
     def dataReceived(self, bytes, final=False):
+        if self.aborted:
+            return
+        self.received += len(bytes)
         if self.decoder:
-            bytes = self.decoder.decode(bytes, final)
+            if self.timing is not None:
+                start = self.timing.seconds()
+                bytes = self.decoder.decode(bytes, final)
+                self.timing.decode += self.timing.seconds() - start
+            else:
+                bytes = self.decoder.decode(bytes, final)
         self.recv_chunks.append(bytes)
 
     def connectionLost(self, reason):
@@ -109,6 +450,8 @@ class ResponseReceiver(Protocol):
         from twisted.web._newclient import ResponseDone
         from twisted.web.http import PotentialDataLoss
 
+        if self.aborted:
+            return
         if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
             self.dataReceived('', final=True)
             self.deferred.callback(''.join(self.recv_chunks))
@@ -124,7 +467,13 @@ class CouchDB(object):
     def __init__(self, host, port=5984, dbName=None,
                  username=None, password=None, protocol='http',
                  disable_log=False,
-                 version=(1, 0, 1)):
+                 version=(1, 0, 1),
+                 pool=None, persistent=False, etagCache=None,
+                 retryPolicy=None, circuitBreaker=None,
+                 timeout=SOCK_TIMEOUT, connectTimeout=None,
+                 firstByteTimeout=None, logSampleRate=0.0, metrics=None,
+                 timePhases=False, timingHook=None, slowLog=None,
+                 agent=None, recorder=None, jsonBackend=None):
         """
         Initialize the client for given host.
 
@@ -142,11 +491,94 @@ class CouchDB(object):
         @type  username: C{unicode}
         @param password: the password
         @type  password: C{unicode}
+        @param pool:     if specified, the connection pool to use; pass the
+                         same pool to several clients to share connections.
+        @type  pool:     L{twisted.web.client.HTTPConnectionPool}
+        @param persistent: if True and no pool is specified, keep
+                         connections alive in a private pool created with
+                         L{makePool}.
+        @type  persistent: C{bool}
+        @param etagCache: if specified, make openDoc and openView requests
+                         conditional on the ETag of the result stored in
+                         this cache.
+        @type  etagCache: L{paisley.cache.ETagCache}
+        @param retryPolicy: if specified, the policy to retry requests that
+                         failed for transient reasons with.
+        @type  retryPolicy: L{paisley.retry.RetryPolicy}
+        @param circuitBreaker: if specified, the circuit breaker to send
+                         requests through.
+        @type  circuitBreaker: L{paisley.breaker.CircuitBreaker}
+        @param timeout:  the number of seconds a request may take, including
+                         receiving the response body; None for no limit.
+        @type  timeout:  C{float}
+        @param connectTimeout: the number of seconds connecting may take.
+        @type  connectTimeout: C{float}
+        @param firstByteTimeout: the number of seconds a request may take
+                         until the response headers are received.
+        @type  firstByteTimeout: C{float}
+        @param logSampleRate: the fraction of requests to log, with their
+                         method, uri, status, bytes and latency as fields of
+                         the record, at INFO level to the paisley.requests
+                         logger.
+        @type  logSampleRate: C{float}
+        @param metrics:  if specified, the metrics to record every request
+                         in.
+        @type  metrics:  L{paisley.metrics.Metrics}
+        @param timePhases: whether to time the phases of every request, for
+                         the metrics and the timing hook.
+        @type  timePhases: C{bool}
+        @param timingHook: if specified, called with the L{RequestTiming} of
+                         every successful request; implies timePhases.
+        @type  timingHook: callable
+        @param slowLog:  if specified, the log to check every request against
+                         for being slow or large; implies timePhases.
+        @type  slowLog:  L{paisley.slowlog.SlowRequestLog}
+        @param agent:    if specified, the agent to send requests with
+                         instead of an Agent connecting to the server, such
+                         as a L{paisley.replay.ReplayAgent}.
+        @type  agent:    L{twisted.web.iweb.IAgent}
+        @param recorder: if specified, the recorder to record every request
+                         and response with.
+        @type  recorder: L{paisley.replay.Recorder}
+        @param jsonBackend: if specified, the JSON library to encode and
+                         decode with, as a backend or the name of one, or
+                         'fastest' for the fastest conforming one; by
+                         default, the loads and dumps of L{paisley.pjson}.
+        @type  jsonBackend: L{paisley.pjson.Backend} or C{str}
         """
         from twisted.internet import reactor
         # t.w.c imports reactor
         from twisted.web.client import Agent
-        self.client = Agent(reactor)
+        self._ownPool = None
+        if pool is None and persistent:
+            pool = self._ownPool = makePool()
+        self.pool = pool
+        if agent is None:
+            agent = Agent(reactor, connectTimeout=connectTimeout, pool=pool)
+        self.client = agent
+        if jsonBackend == 'fastest':
+            jsonBackend = json.fastest()
+        elif isinstance(jsonBackend, basestring):
+            jsonBackend = json.backend(jsonBackend)
+        self.json = jsonBackend or json
+        self.timePhases = timePhases or timingHook is not None or \
+            slowLog is not None
+        self.timingHook = timingHook
+        self.slowLog = slowLog
+        self._endpoints = None
+        # deliberately wraps a private attribute of Agent, see
+        # _DeadlineEndpointFactory
+        if hasattr(self.client, '_endpointFactory'):
+            self._endpoints = self.client._endpointFactory = \
+                _DeadlineEndpointFactory(self.client._endpointFactory)
+        if recorder is not None:
+            self.client = recorder.wrap(self.client)
+        self._clock = reactor
+        self.timeout = timeout
+        self.firstByteTimeout = firstByteTimeout
+        self.etagCache = etagCache
+        self.retryPolicy = retryPolicy
+        self.circuitBreaker = circuitBreaker
         self.host = host
         self.port = int(port)
         self.username = username
@@ -156,21 +588,12 @@ class CouchDB(object):
             self.bindToDB(dbName)
 
         if disable_log:
-            # since this is the db layer, and we generate a lot of logs,
-            # let people disable them completely if they want to.
-            levels = ['trace', 'debug', 'info', 'warn', 'error', 'exception']
-
-            class FakeLog(object):
-                pass
-
-            def nullfn(self, *a, **k):
-                pass
-            self.log = FakeLog()
-            for level in levels:
-                self.log.__dict__[level] = new.instancemethod(nullfn, self.log)
+            self.log = self.requestLog = _nullLog
         else:
             self.log = logging.getLogger('paisley')
-
+            self.requestLog = logging.getLogger('paisley.requests')
+        self.logSampleRate = logSampleRate
+        self.metrics = metrics
 
         self.log.debug("[%s%s:%s/%s] init new db client",
                        '%s@' % (username, ) if username else '',
@@ -179,19 +602,39 @@ class CouchDB(object):
                        dbName if dbName else '')
         self.version = version
 
+    def close(self):
+        """
+        Close the idle connections of the pool created for this client.
+
+        Shared pools passed in by the caller are left alone.
+
+        @rtype: L{Deferred}
+        """
+        if self._ownPool is None:
+            return succeed(None)
+        return self._ownPool.closeCachedConnections()
+
     def parseResult(self, result):
         """
         Parse JSON result from the DB.
         """
-        return json.loads(result)
+        return self.json.loads(result)
+
+    def _reportTiming(self, timing):
+        if self.timingHook is not None:
+            self.timingHook(timing)
+        if self.metrics is not None:
+            self.metrics.timed(timing.descr, timing.dbName, timing.phases())
+        if self.slowLog is not None:
+            self.slowLog.check(timing, self._clock)
 
     def bindToDB(self, dbName):
         """
         Bind all operations asking for a DB name to the given DB.
         """
         for methname in ["createDB", "deleteDB", "infoDB", "listDoc",
-                         "openDoc", "saveDoc", "deleteDoc", "openView",
-                         "tempView"]:
+                         "openDoc", "saveDoc", "deleteDoc", "bulkDocs",
+                         "openView", "tempView"]:
             method = getattr(self, methname)
             newMethod = partial(method, dbName)
             setattr(self, methname, newMethod)
@@ -210,8 +653,8 @@ class CouchDB(object):
         # characters (a-z), digits (0-9), and any of the characters _, $, (,
         # ), +, -, and / are allowed. Must begin with a letter."}
 
-        return self.put("/%s/" % (_namequote(dbName), ), "", descr='CreateDB'
-            ).addCallback(self.parseResult)
+        return self.put("/%s/" % (_namequote(dbName), ), "", descr='CreateDB',
+            parse=True)
 
     def cleanDB(self, dbName):
         """
@@ -221,8 +664,7 @@ class CouchDB(object):
         """
         # Responses: 200, 404 Object Not Found
         return self.post("/%s/_view_cleanup" % (_namequote(dbName), ), "",
-        descr='cleanDB'
-            ).addCallback(self.parseResult)
+            descr='cleanDB', parse=True)
 
     def compactDB(self, dbName):
         """
@@ -232,8 +674,7 @@ class CouchDB(object):
         """
         # Responses: 202 Accepted, 404 Object Not Found
         return self.post("/%s/_compact" % (_namequote(dbName), ), "",
-            descr='compactDB'
-            ).addCallback(self.parseResult)
+            descr='compactDB', parse=True)
 
     def compactDesignDB(self, dbName, designName):
         """
@@ -244,8 +685,7 @@ class CouchDB(object):
         """
         # Responses: 202 Accepted, 404 Object Not Found
         return self.post("/%s/_compact/%s" % (_namequote(dbName), designName),
-            "", descr='compactDesignDB'
-            ).addCallback(self.parseResult)
+            "", descr='compactDesignDB', parse=True)
 
 
     def deleteDB(self, dbName):
@@ -255,16 +695,15 @@ class CouchDB(object):
         @type  dbName: str
         """
         # Responses: {u'ok': True}, 404 Object Not Found
-        return self.delete("/%s/" % (_namequote(dbName), )
-            ).addCallback(self.parseResult)
+        return self.delete("/%s/" % (_namequote(dbName), ), descr='deleteDB',
+            parse=True)
 
     def listDB(self):
         """
         List the databases on the server.
         """
         # Responses: list of db names
-        return self.get("/_all_dbs", descr='listDB').addCallback(
-            self.parseResult)
+        return self.get("/_all_dbs", descr='listDB', parse=True)
 
     def getVersion(self):
         """
@@ -272,7 +711,7 @@ class CouchDB(object):
         """
         # Responses: {u'couchdb': u'Welcome', u'version': u'1.1.0'}
         # Responses: {u'couchdb': u'Welcome', u'version': u'1.1.1a1162549'}
-        d = self.get("/", descr='version').addCallback(self.parseResult)
+        d = self.get("/", descr='version', parse=True)
 
         def cacheVersion(result):
             self.version = self._parseVersion(result['version'])
@@ -298,15 +737,34 @@ class CouchDB(object):
         """
         # Responses: {u'update_seq': 0, u'db_name': u'mydb', u'doc_count': 0}
         # 404 Object Not Found
-        return self.get("/%s/" % (_namequote(dbName), ), descr='infoDB'
-            ).addCallback(self.parseResult)
+        return self.get("/%s/" % (_namequote(dbName), ), descr='infoDB',
+            parse=True)
 
     # Document operations
 
     def listDoc(self, dbName, reverse=False, startkey=None, endkey=None,
-                include_docs=False, limit=-1, **obsolete):
+                include_docs=False, limit=-1, rowCallback=None, keys=None,
+                timeout=None, firstByteTimeout=None, **obsolete):
         """
         List all documents in a given database.
+
+        @param keys: if specified, only list the documents with these ids,
+            in this order; a missing document has a row with an error.
+        @type keys: C{list} of C{unicode}
+
+        @param rowCallback: if specified, stream the result: it is called with
+            each row as soon as the row is received, and the result fires
+            with the rest of the response and an empty list of rows.
+        @type rowCallback: callable
+
+        @param timeout: if specified, the number of seconds the request may
+            take before it fails with L{RequestTimeoutError}, instead of the
+            timeout of the client.
+        @type timeout: C{float}
+
+        @param firstByteTimeout: if specified, the number of seconds to wait
+            for the response headers, instead of the one of the client.
+        @type firstByteTimeout: C{float}
         """
         # Responses: {u'rows': [{u'_rev': -1825937535, u'_id': u'mydoc'}],
         # u'view': u'_all_docs'}, 404 Object Not Found
@@ -324,18 +782,27 @@ class CouchDB(object):
         if reverse:
             args["reverse"] = "true"
         if startkey:
-            args["startkey"] = json.dumps(startkey)
+            args["startkey"] = self.json.dumps(startkey)
         if endkey:
-            args["endkey"] = json.dumps(endkey)
+            args["endkey"] = self.json.dumps(endkey)
         if include_docs:
             args["include_docs"] = True
         if limit >= 0:
             args["limit"] = int(limit)
         if args:
             uri += "?%s" % (urlencode(args), )
-        return self.get(uri, descr='listDoc').addCallback(self.parseResult)
-
-    def openDoc(self, dbName, docId, revision=None, full=False, attachment=""):
+        if keys is not None:
+            # POST the keys in the body, as openView does
+            return self.post(uri, self.json.dumps({"keys": keys}),
+                descr='listDoc', rowCallback=rowCallback, idempotent=True,
+                parse=not rowCallback,
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        return self.get(uri, descr='listDoc', rowCallback=rowCallback,
+            parse=not rowCallback,
+            timeout=timeout, firstByteTimeout=firstByteTimeout)
+
+    def openDoc(self, dbName, docId, revision=None, full=False, attachment="",
+                timeout=None, firstByteTimeout=None):
         """
         Open a document in a given database.
 
@@ -351,6 +818,15 @@ class CouchDB(object):
         @param attachment: if specified, return the named attachment from the
             document.
         @type attachment: C{str}
+
+        @param timeout: if specified, the number of seconds the request may
+            take before it fails with L{RequestTimeoutError}, instead of the
+            timeout of the client.
+        @type timeout: C{float}
+
+        @param firstByteTimeout: if specified, the number of seconds to wait
+            for the response headers, instead of the one of the client.
+        @type firstByteTimeout: C{float}
         """
         # Responses: {u'_rev': -1825937535, u'_id': u'mydoc', ...}
         # 404 Object Not Found
@@ -373,8 +849,13 @@ class CouchDB(object):
         elif attachment:
             uri += "/%s" % quote(attachment)
             # No parsing
-            return self.get(uri, descr='openDoc', isJson=False)
-        return self.get(uri, descr='openDoc').addCallback(self.parseResult)
+            return self.get(uri, descr='openDoc', isJson=False,
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        if self.etagCache is not None:
+            return self._getConditional(uri, descr='openDoc',
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        return self.get(uri, descr='openDoc', parse=True,
+            timeout=timeout, firstByteTimeout=firstByteTimeout)
 
     def addAttachments(self, document, attachments):
         """
@@ -391,7 +872,8 @@ class CouchDB(object):
             data = b64encode(data)
             document["_attachments"][name] = {"type": "base64", "data": data}
 
-    def saveDoc(self, dbName, body, docId=None):
+    def saveDoc(self, dbName, body, docId=None, timeout=None,
+                firstByteTimeout=None):
         """
         Save/create a document to/in a given database.
 
@@ -403,6 +885,15 @@ class CouchDB(object):
 
         @param docId: if specified, the identifier to be used in the database.
         @type docId: C{unicode}
+
+        @param timeout: if specified, the number of seconds the request may
+            take before it fails with L{RequestTimeoutError}, instead of the
+            timeout of the client.
+        @type timeout: C{float}
+
+        @param firstByteTimeout: if specified, the number of seconds to wait
+            for the response headers, instead of the one of the client.
+        @type firstByteTimeout: C{float}
         """
         # Responses: {'rev': '1-9dd776365618752ddfaf79d9079edf84',
         #             'ok': True, 'id': '198abfee8852816bc112992564000295'}
@@ -416,15 +907,15 @@ class CouchDB(object):
                 'docId is %r instead of unicode' % (type(docId), )
 
         if not isinstance(body, (str, unicode)):
-            body = json.dumps(body)
+            body = self.json.dumps(body)
         if docId is not None:
-            d = self.put("/%s/%s" % (_namequote(dbName),
+            return self.put("/%s/%s" % (_namequote(dbName),
                 quote(docId.encode('utf-8'))),
-                body, descr='saveDoc')
-        else:
-            d = self.post("/%s/" % (_namequote(dbName), ), body,
-                descr='saveDoc')
-        return d.addCallback(self.parseResult)
+                body, descr='saveDoc', parse=True,
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        return self.post("/%s/" % (_namequote(dbName), ), body,
+            descr='saveDoc', parse=True,
+            timeout=timeout, firstByteTimeout=firstByteTimeout)
 
     def deleteDoc(self, dbName, docId, revision):
         """
@@ -455,14 +946,55 @@ class CouchDB(object):
         return self.delete("/%s/%s?%s" % (
                 _namequote(dbName),
                 quote(docId.encode('utf-8')),
-                urlencode({'rev': revision.encode('utf-8')}))).addCallback(
-                    self.parseResult)
+                urlencode({'rev': revision.encode('utf-8')})),
+                descr='deleteDoc', parse=True)
+
+    def bulkDocs(self, dbName, docs):
+        """
+        Save, update or delete several documents in one request.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param docs: the documents; a document with C{_deleted} set to True
+            is deleted.
+        @type docs: C{list} of C{dict}
+
+        @returns: a list with a result for each document, in order; either
+            {'ok': True, 'id': ..., 'rev': ...} or a dict with 'id', 'error'
+            and 'reason'.
+        """
+        # Responses: [{u'ok': True, u'id': u'1', u'rev': u'1-...'},
+        #             {u'id': u'2', u'error': u'conflict',
+        #              u'reason': u'Document update conflict.'}]
+        # 400 Bad Request, 417 Expectation Failed (all_or_nothing)
+        body = self.json.dumps({"docs": docs})
+        return self.post("/%s/_bulk_docs" % (_namequote(dbName), ), body,
+            descr='bulkDocs', parse=True)
 
     # View operations
 
-    def openView(self, dbName, docId, viewId, **kwargs):
+    def openView(self, dbName, docId, viewId, rowCallback=None, timeout=None,
+                 firstByteTimeout=None, **kwargs):
         """
         Open a view of a document in a given database.
+
+        The keyword arguments not listed below are the query options of the
+        view.
+
+        @param rowCallback: if specified, stream the result: it is called with
+            each row as soon as the row is received, and the result fires
+            with the rest of the response and an empty list of rows.
+        @type rowCallback: callable
+
+        @param timeout: if specified, the number of seconds the request may
+            take before it fails with L{RequestTimeoutError}, instead of the
+            timeout of the client.
+        @type timeout: C{float}
+
+        @param firstByteTimeout: if specified, the number of seconds to wait
+            for the response headers, instead of the one of the client.
+        @type firstByteTimeout: C{float}
         """
         # Responses:
         # 500 Internal Server Error (illegal database name)
@@ -475,15 +1007,18 @@ class CouchDB(object):
         # dictionary now so that it doesn't get double JSON-encoded
         body = None
         if "keys" in kwargs:
-            body = json.dumps({"keys": kwargs.pop("keys")})
+            body = self.json.dumps({"keys": kwargs.pop("keys")})
 
         # encode the rest of the values with JSON for use as query
         # arguments in the URI
         for k, v in kwargs.iteritems():
             if k == 'keys': # we do this below, for the full body
                 pass
+            elif k in ('startkey_docid', 'endkey_docid'):
+                # document ids are passed as they are, not as JSON
+                kwargs[k] = unicode(v).encode('utf-8')
             else:
-                kwargs[k] = json.dumps(v)
+                kwargs[k] = self.json.dumps(v)
         # we keep the paisley API, but couchdb uses limit now
         if 'count' in kwargs:
             kwargs['limit'] = kwargs.pop('count')
@@ -492,13 +1027,16 @@ class CouchDB(object):
         # query so that we can upload the keys as the body of
         # the POST request, otherwise use a GET request
         if body:
-            return self.post(
-                buildUri(), body=body, descr='openView').addCallback(
-                    self.parseResult)
-        else:
-            return self.get(
-                buildUri(), descr='openView').addCallback(
-                    self.parseResult)
+            return self.post(buildUri(), body=body, descr='openView',
+                rowCallback=rowCallback, idempotent=True,
+                parse=not rowCallback,
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        elif self.etagCache is not None and not rowCallback:
+            return self._getConditional(buildUri(), descr='openView',
+                timeout=timeout, firstByteTimeout=firstByteTimeout)
+        return self.get(buildUri(), descr='openView', rowCallback=rowCallback,
+            parse=not rowCallback,
+            timeout=timeout, firstByteTimeout=firstByteTimeout)
 
     def addViews(self, document, views):
         """
@@ -519,33 +1057,112 @@ class CouchDB(object):
         Make a temporary view on the server.
         """
         if not isinstance(view, (str, unicode)):
-            view = json.dumps(view)
-        d = self.post("/%s/_temp_view" % (_namequote(dbName), ), view,
-            descr='tempView')
-        return d.addCallback(self.parseResult)
+            view = self.json.dumps(view)
+        return self.post("/%s/_temp_view" % (_namequote(dbName), ), view,
+            descr='tempView', idempotent=True, parse=True)
 
     # Basic http methods
 
+    def _getConditional(self, uri, descr='', conditional=True, timeout=None,
+                        firstByteTimeout=None):
+        """
+        Execute a conditional C{GET} at C{uri}, and parse the result.
+
+        The parsed result is stored in the ETag cache along with its ETag.
+        The next time, the server is asked to only send the result if its
+        ETag changed; if it did not, the stored result is returned.
+
+        A 304 for a result that is not stored is a miss: the result is
+        asked for again, unconditionally.
+        """
+        entry = None
+        if conditional:
+            entry = self.etagCache.get(self.host, self.port, uri)
+        headers = {}
+        if entry is not None:
+            headers['If-None-Match'] = [entry[0]]
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("[%s:%s%s] GET %s (conditional)",
+                           self.host, self.port, short_print(uri), descr)
+        d = self._retry(descr, True, uri, method="GET", headers=headers,
+            withResponse=True, parse=True,
+            timeout=timeout, firstByteTimeout=firstByteTimeout)
+
+        def conditionalCb((response, result)):
+            if response.code == 304:
+                if entry is not None:
+                    self.etagCache.notModified(self.host, self.port, uri)
+                    return entry[1]
+                if conditional:
+                    return self._getConditional(uri, descr=descr,
+                        conditional=False,
+                        timeout=timeout, firstByteTimeout=firstByteTimeout)
+                result = self.parseResult(result)
+            etag = response.headers.getRawHeaders('ETag', [None])[0]
+            if etag:
+                self.etagCache.set(self.host, self.port, uri, etag, result)
+            return result
+        return d.addCallback(conditionalCb)
+
     def _getPage(self, uri, method="GET", postdata=None, headers=None,
-            isJson=True):
+            isJson=True, rowCallback=None, withResponse=False, timeout=None,
+            firstByteTimeout=None, descr='', parse=False, idempotent=False):
         """
         C{getPage}-like.
+
+        descr describes the operation, like openDoc, for the metrics.
+
+        A request that takes longer than timeout seconds, or than
+        firstByteTimeout seconds to receive the response headers, is
+        cancelled, closing its connection, and fails with
+        L{RequestTimeoutError}; if not specified, the timeouts of the client
+        are used.
+
+        If rowCallback is specified, a successful response is parsed as a
+        view result while it is received; see L{stream.RowReceiver}.
+
+        If withResponse is True, fire with a (response, body) tuple instead
+        of just the body; a 304 Not Modified response is not an error then.
+
+        If parse is True, the body is parsed with L{parseResult}, except
+        for a 304 Not Modified response, so that timing the phases of the
+        request includes parsing.
+
+        idempotent tells whether the request can be repeated safely; a
+        C{POST} that is, only reads.  Subclasses like
+        L{paisley.cluster.CouchDBCluster} use it to pick where to send it.
         """
 
-        def cb_recv_resp(response):
-            d_resp_recvd = Deferred()
+        def cb_recv_resp(response, deadline):
+            timing = deadline.timing
+            if timing is not None:
+                timing.headers = timing.seconds()
+                timing.status = response.code
+            # cancelling drops the rest of the body and frees the transport
+            d_resp_recvd = Deferred(lambda _: receiver.abort())
             content_type = response.headers.getRawHeaders('Content-Type',
                     [''])[0].lower().strip()
             decode_utf8 = 'charset=utf-8' in content_type or \
                     content_type == 'application/json'
-            response.deliverBody(ResponseReceiver(d_resp_recvd,
-                decode_utf8=decode_utf8))
+            if rowCallback and response.code < 300:
+                receiver = stream.RowReceiver(d_resp_recvd,
+                    decode_utf8=decode_utf8, rowCallback=rowCallback,
+                    timing=timing, loads=self.json.loads)
+            else:
+                receiver = ResponseReceiver(d_resp_recvd,
+                    decode_utf8=decode_utf8, timing=timing)
+            deadline.received(response, receiver)
+            response.deliverBody(receiver)
             return d_resp_recvd.addCallback(cb_process_resp, response)
 
         def cb_process_resp(body, response):
             # twisted.web.error imports reactor
             from twisted.web import error as tw_error
 
+            if withResponse and response.code == 304:
+                return (response, body)
+
             # Emulate HTTPClientFactory and raise t.w.e.Error
             # and PageRedirect if we have errors.
             if response.code > 299 and response.code < 400:
@@ -553,6 +1170,8 @@ class CouchDB(object):
             elif response.code > 399:
                 raise tw_error.Error(response.code, body)
 
+            if withResponse:
+                return (response, body)
             return body
 
         uurl = unicode(self.url_template % (uri, ))
@@ -571,42 +1190,199 @@ class CouchDB(object):
 
         body = StringProducer(postdata) if postdata else None
 
-        d = self.client.request(method, url, Headers(headers), body)
+        def cb_deadline(result, deadline):
+            deadline.stop()
+            if isinstance(result, Failure):
+                if deadline.expired:
+                    raise RequestTimeoutError(uri, deadline.phase,
+                        deadline.elapsed())
+                if _isCancelled(result):
+                    raise CancelledError()
+                # Agent times out connecting
+                if result.check(TimeoutError):
+                    raise RequestTimeoutError(uri, 'connect',
+                        deadline.elapsed())
+            return result
 
-        d.addCallback(cb_recv_resp)
+        def cb_log(result, deadline):
+            status, received = deadline.outcome(result)
+            fields = {
+                'method': method,
+                'uri': uri,
+                'status': status,
+                'bytes': received,
+                'latency': deadline.elapsed(),
+            }
+            self.requestLog.info(
+                "%(method)s %(uri)s %(status)s %(bytes)d %(latency).3f",
+                fields, extra=fields)
+            return result
 
-        return d
+        def cb_parse(result):
+            if not withResponse:
+                return self.parseResult(result)
+            response, body = result
+            if response.code == 304:
+                return result
+            return (response, self.parseResult(body))
+
+        def cb_timing(result, deadline):
+            timing = deadline.timing
+            timing.done = timing.seconds()
+            timing.status, timing.received = deadline.outcome(result)
+            if isinstance(deadline.receiver, stream.RowReceiver):
+                timing.rows = deadline.receiver.parser.rows
+            if parse:
+                start = timing.seconds()
+                result = cb_parse(result)
+                timing.parse = timing.seconds() - start
+                parsed = result
+                if withResponse:
+                    parsed = result[1]
+                if isinstance(parsed, dict) and \
+                        isinstance(parsed.get('rows'), list):
+                    timing.rows = len(parsed['rows'])
+            self._reportTiming(timing)
+            return result
 
-    def get(self, uri, descr='', isJson=True):
+        def eb_slow(failure, deadline):
+            timing = deadline.timing
+            timing.done = timing.seconds()
+            timing.status, timing.received = deadline.outcome(failure)
+            self.slowLog.check(timing, self._clock)
+            return failure
+
+        def cb_metrics(result, deadline):
+            status, received = deadline.outcome(result)
+            self.metrics.finished(descr, dbName, status, deadline.elapsed(),
+                postdata and len(postdata) or 0, received)
+            return result
+
+        if timeout is None:
+            timeout = self.timeout
+        if firstByteTimeout is None:
+            firstByteTimeout = self.firstByteTimeout
+
+        descr = descr or method
+        dbName = _uriDbName(uri)
+
+        def request():
+            deadline = _Deadline(self._clock, timeout, firstByteTimeout)
+            if self.metrics is not None:
+                self.metrics.started(descr, dbName)
+            if self.timePhases:
+                deadline.timing = RequestTiming(method, uri, descr, dbName,
+                    self._clock)
+            if self._endpoints is not None:
+                self._endpoints.deadline = deadline
+            try:
+                d = deadline.deferred = self.client.request(method, url,
+                    Headers(headers), body)
+            finally:
+                if self._endpoints is not None:
+                    self._endpoints.deadline = None
+            d.addCallback(cb_recv_resp, deadline)
+            if self.timePhases:
+                d.addCallback(cb_timing, deadline)
+            elif parse:
+                d.addCallback(cb_parse)
+            d.addBoth(cb_deadline, deadline)
+            if self.slowLog is not None:
+                d.addErrback(eb_slow, deadline)
+            if self.metrics is not None:
+                d.addBoth(cb_metrics, deadline)
+            if sampled:
+                d.addBoth(cb_log, deadline)
+            return d
+
+        # decide before the request, so unsampled requests cost nothing
+        sampled = self.logSampleRate and \
+            random.random() < self.logSampleRate and \
+            self.requestLog.isEnabledFor(logging.INFO)
+
+        if self.circuitBreaker is not None:
+            return self.circuitBreaker.call(
+                self.circuitBreaker.key(self.host, self.port, uri), request)
+        return request()
+
+    def _retry(self, descr, idempotent, uri, **kwargs):
         """
-        Execute a C{GET} at C{uri}.
+        Execute the request with L{_getPage}, retrying it according to the
+        retry policy.
+
+        A streamed request is not idempotent, since the rows received before
+        it failed were handed out already.
         """
-        self.log.debug("[%s:%s%s] GET %s",
-                       self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="GET", isJson=isJson)
+        descr = descr or kwargs['method']
+        if kwargs.get('rowCallback'):
+            idempotent = False
+        if self.retryPolicy is None:
+            return self._getPage(uri, descr=descr, idempotent=idempotent,
+                **kwargs)
+        return self.retryPolicy.call(
+            lambda: self._getPage(uri, descr=descr, idempotent=idempotent,
+                **kwargs),
+            descr=descr, idempotent=idempotent, log=self.log)
+
+    def get(self, uri, descr='', isJson=True, rowCallback=None, timeout=None,
+            firstByteTimeout=None, parse=False):
+        """
+        Execute a C{GET} at C{uri}.
 
-    def post(self, uri, body, descr=''):
+        @param parse: whether to fire with the body parsed by
+                      L{parseResult}, instead of the body.
         """
-        Execute a C{POST} of C{body} at C{uri}.
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("[%s:%s%s] GET %s",
+                           self.host, self.port, short_print(uri), descr)
+        return self._retry(descr, True, uri, method="GET", isJson=isJson,
+            rowCallback=rowCallback, timeout=timeout,
+            firstByteTimeout=firstByteTimeout, parse=parse)
+
+    def post(self, uri, body, descr='', rowCallback=None, idempotent=False,
+             timeout=None, firstByteTimeout=None, parse=False):
         """
-        self.log.debug("[%s:%s%s] POST %s: %s",
-                      self.host, self.port, short_print(uri), descr,
-                      short_print(repr(body)))
-        return self._getPage(uri, method="POST", postdata=body)
+        Execute a C{POST} of C{body} at C{uri}.
 
-    def put(self, uri, body, descr=''):
+        @param idempotent: whether the request can be retried safely, like
+                           a C{POST} that only reads.
+        @param parse:      whether to fire with the body parsed by
+                           L{parseResult}, instead of the body.
         """
-        Execute a C{PUT} of C{body} at C{uri}.
+        # repr copies the whole body, so only do it if it is logged
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("[%s:%s%s] POST %s: %s",
+                           self.host, self.port, short_print(uri), descr,
+                           short_print(repr(body)))
+        return self._retry(descr, idempotent, uri, method="POST",
+            postdata=body, rowCallback=rowCallback, timeout=timeout,
+            firstByteTimeout=firstByteTimeout, parse=parse)
+
+    def put(self, uri, body, descr='', timeout=None, firstByteTimeout=None,
+            parse=False):
         """
-        self.log.debug("[%s:%s%s] PUT %s: %s",
-                       self.host, self.port, short_print(uri), descr,
-                       short_print(repr(body)))
-        return self._getPage(uri, method="PUT", postdata=body)
+        Execute a C{PUT} of C{body} at C{uri}.
 
-    def delete(self, uri, descr=''):
+        @param parse: whether to fire with the body parsed by
+                      L{parseResult}, instead of the body.
+        """
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("[%s:%s%s] PUT %s: %s",
+                           self.host, self.port, short_print(uri), descr,
+                           short_print(repr(body)))
+        return self._retry(descr, True, uri, method="PUT", postdata=body,
+            timeout=timeout, firstByteTimeout=firstByteTimeout, parse=parse)
+
+    def delete(self, uri, descr='', timeout=None, firstByteTimeout=None,
+               parse=False):
         """
         Execute a C{DELETE} at C{uri}.
+
+        @param parse: whether to fire with the body parsed by
+                      L{parseResult}, instead of the body.
         """
-        self.log.debug("[%s:%s%s] DELETE %s",
-                       self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="DELETE")
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("[%s:%s%s] DELETE %s",
+                           self.host, self.port, short_print(uri), descr)
+        return self._retry(descr, True, uri, method="DELETE",
+            timeout=timeout, firstByteTimeout=firstByteTimeout, parse=parse)
@@ -0,0 +1,400 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cluster -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Client for several CouchDB nodes replicating the same databases.
+"""
+
+import random
+
+from collections import deque
+
+from twisted.internet import defer, error, task
+from twisted.web import error as tw_error
+
+from paisley import breaker, client
+
+# methods that do not change anything on the server
+READ_METHODS = ('GET', 'HEAD')
+
+
+def _isRead(method, idempotent=False):
+    """
+    Whether a request only reads, so that it can go to any node and be
+    hedged.
+
+    A C{POST} marked idempotent, like openView or listDoc with keys, only
+    reads; C{PUT} and C{DELETE} are idempotent too, but write.
+    """
+    return method in READ_METHODS or (idempotent and method == 'POST')
+
+# failures that mean a node is unreachable or unhealthy, rather than that
+# the request was wrong
+NODE_FAILURES = (
+    error.ConnectError,
+    error.ConnectionLost,
+    error.TimeoutError,
+    client.RequestTimeoutError,
+)
+
+LEAST_OUTSTANDING = 'least-outstanding'
+EWMA = 'ewma'
+
+
+def _isNodeFailure(failure):
+    # _newclient imports reactor
+    from twisted.web._newclient import ResponseFailed, ResponseNeverReceived
+    if failure.check(ResponseFailed, ResponseNeverReceived,
+            breaker.CircuitOpenError, *NODE_FAILURES):
+        return True
+    if failure.check(tw_error.Error) and \
+            int(failure.value.status) in (502, 503, 504):
+        return True
+    return False
+
+
+class Node(object):
+    """
+    I hold the state of one node of a L{CouchDBCluster}.
+
+    @ivar client:      the client for this node.
+    @type client:      L{client.CouchDB}
+    @ivar outstanding: the number of requests in progress.
+    @ivar latency:     the moving average of the latency in seconds, or
+                       None before the first response.
+    @ivar failures:    the number of failures in a row.
+    @ivar up:          whether the node receives requests.
+    """
+
+    def __init__(self, couch):
+        self.client = couch
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.up = True
+
+    def __repr__(self):
+        return '<Node %s:%d %s>' % (self.client.host, self.client.port,
+            self.up and 'up' or 'down')
+
+
+class HedgePolicy(object):
+    """
+    I decide when a read on a L{CouchDBCluster} is sent to a second node.
+
+    When a read took longer than the given percentile of the latencies of
+    recent reads, it is likely to be stuck on a slow node, so the same read
+    is sent to another node; the first response wins.
+
+    @ivar requests: the number of reads that could be hedged.
+    @ivar hedges:   the number of reads sent to a second node.
+    @ivar wins:     the number of reads the second node answered first.
+    """
+
+    def __init__(self, percentile=95, minDelay=0.005, maxDelay=1.0,
+                 window=1000, minSamples=20):
+        """
+        @param percentile: the percentile of the latencies to wait for
+                           before hedging.
+        @type  percentile: C{float}
+        @param minDelay:   the minimum number of seconds to wait.
+        @type  minDelay:   C{float}
+        @param maxDelay:   the maximum number of seconds to wait; also the
+                           delay before minSamples latencies are known.
+        @type  maxDelay:   C{float}
+        @param window:     the number of recent latencies considered.
+        @type  window:     C{int}
+        """
+        self.percentile = percentile
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.minSamples = minSamples
+        self._latencies = deque(maxlen=window)
+        self._delay = None
+        # the number of latencies recorded since the delay was computed
+        self._recorded = 0
+
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def record(self, latency):
+        """
+        Record the latency of a read.
+        """
+        self._latencies.append(latency)
+        self._recorded += 1
+        # recomputing the percentile for every read is too expensive
+        if self._recorded >= 32:
+            self._delay = None
+
+    def delay(self):
+        """
+        @returns: the number of seconds to wait before hedging a read.
+        @rtype:   C{float}
+        """
+        if len(self._latencies) < self.minSamples:
+            return self.maxDelay
+        if self._delay is None:
+            latencies = sorted(self._latencies)
+            index = int(len(latencies) * self.percentile / 100.0)
+            delay = latencies[min(index, len(latencies) - 1)]
+            self._delay = max(self.minDelay, min(self.maxDelay, delay))
+            self._recorded = 0
+        return self._delay
+
+    def stats(self):
+        """
+        @returns: the counters, and the hedge and win rates.
+        @rtype:   C{dict}
+        """
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'wins': self.wins,
+            'hedgeRate': self.requests and
+                float(self.hedges) / self.requests or 0.0,
+            'winRate': self.hedges and
+                float(self.wins) / self.hedges or 0.0,
+        }
+
+
+class CouchDBCluster(client.CouchDB):
+    """
+    I am a client for several CouchDB nodes replicating the same databases.
+
+    Reads are spread over the nodes that are up, either to the node with
+    the fewest requests in progress, or to the node with the lowest moving
+    average of its latency weighted by its requests in progress.  Writes go
+    to the primary node if there is one, and are spread like reads if not.
+
+    A node that fails failureThreshold requests in a row, by being
+    unreachable or answering 502, 503 or 504, is ejected; the health checks
+    started with L{startHealthChecks} admit it again once it answers.
+    When all nodes are ejected, requests are spread over all of them.
+
+    With a L{HedgePolicy}, reads that take long are sent to a second node,
+    and the slower of the two requests is cancelled.
+
+    @ivar nodes: the nodes.
+    @type nodes: C{list} of L{Node}
+    """
+
+    def __init__(self, nodes, dbName=None, balancer=LEAST_OUTSTANDING,
+                 primary=None, failureThreshold=3, decay=0.3, hedge=None,
+                 clock=None, **kwargs):
+        """
+        @param nodes:            the (host, port) of each node.
+        @type  nodes:            C{list} of C{tuple}
+        @param balancer:         how to pick a node; LEAST_OUTSTANDING or
+                                 EWMA.
+        @param primary:          if specified, the index in nodes of the
+                                 node to send all writes to.
+        @type  primary:          C{int}
+        @param failureThreshold: the number of failures in a row after
+                                 which a node is ejected.
+        @type  failureThreshold: C{int}
+        @param decay:            the weight of the newest latency in the
+                                 moving average.
+        @type  decay:            C{float}
+        @param hedge:            if specified, the policy to hedge reads
+                                 with.
+        @type  hedge:            L{HedgePolicy}
+        @param kwargs:           passed on to the client of each node.
+        """
+        if not nodes:
+            raise ValueError("A cluster needs at least one node")
+        if balancer not in (LEAST_OUTSTANDING, EWMA):
+            raise ValueError("Unknown balancer %r" % (balancer, ))
+        self.nodes = [Node(client.CouchDB(host, port, **kwargs))
+            for host, port in nodes]
+        self.balancer = balancer
+        self.primary = primary
+        self.failureThreshold = failureThreshold
+        self.decay = decay
+        self.hedge = hedge
+        self._healthCheck = None
+
+        # requests not going through _getPage, like the change feed, use the
+        # first node
+        host, port = nodes[primary or 0]
+        client.CouchDB.__init__(self, host, port, dbName, **kwargs)
+        if clock is not None:
+            self._clock = clock
+
+    def _getPage(self, uri, method="GET", **kwargs):
+        """
+        Execute the request on one of the nodes.
+        """
+        # a streamed result can not be hedged, as its rows would be handed
+        # out twice
+        idempotent = kwargs.get('idempotent', False)
+        if self.hedge is not None and _isRead(method, idempotent) \
+                and not kwargs.get('rowCallback') and len(self.nodes) > 1:
+            return self._getHedgedPage(uri, method, **kwargs)
+        node = self.pickNode(method, idempotent=idempotent)
+        return self._getNodePage(node, uri, method, **kwargs)
+
+    def pickNode(self, method='GET', exclude=(), idempotent=False):
+        """
+        Pick the node to send a request with the given method to.
+
+        @param exclude:    the nodes not to pick, if there are others.
+        @param idempotent: whether the request can be repeated safely; a
+                           C{POST} that is only reads.
+
+        @rtype: L{Node}
+        """
+        if not _isRead(method, idempotent) and self.primary is not None:
+            return self.nodes[self.primary]
+
+        candidates = [node for node in self.nodes
+            if node.up and node not in exclude] or \
+            [node for node in self.nodes if node not in exclude] or \
+            self.nodes
+        if self.balancer == LEAST_OUTSTANDING:
+            cost = lambda node: node.outstanding
+        else:
+            # prefer unmeasured nodes, so every node gets measured
+            cost = lambda node: (node.latency or 0) * (node.outstanding + 1)
+        best = min(cost(node) for node in candidates)
+        return random.choice(
+            [node for node in candidates if cost(node) == best])
+
+    def _getNodePage(self, node, uri, method, **kwargs):
+        node.outstanding += 1
+        start = self._clock.seconds()
+        d = node.client._getPage(uri, method=method, **kwargs)
+
+        def requestCb(result):
+            node.outstanding -= 1
+            latency = self._clock.seconds() - start
+            self._succeeded(node, latency)
+            if self.hedge is not None and \
+                    _isRead(method, kwargs.get('idempotent', False)):
+                self.hedge.record(latency)
+            return result
+
+        def requestEb(failure):
+            node.outstanding -= 1
+            if failure.check(defer.CancelledError):
+                pass
+            elif _isNodeFailure(failure):
+                self._failed(node)
+            else:
+                # the node answered, so it is alive
+                self._succeeded(node, self._clock.seconds() - start)
+            return failure
+        return d.addCallbacks(requestCb, requestEb)
+
+    def _getHedgedPage(self, uri, method, **kwargs):
+        policy = self.hedge
+        policy.requests += 1
+        attempts = []
+
+        def cancel(_):
+            if call.active():
+                call.cancel()
+            for d in attempts[:]:
+                d.cancel()
+        result = defer.Deferred(cancel)
+
+        def attempt(node, hedged):
+            d = self._getNodePage(node, uri, method, **kwargs)
+            attempts.append(d)
+            d.addCallbacks(attemptCb, attemptEb,
+                callbackArgs=(d, hedged), errbackArgs=(d, ))
+
+        def attemptCb(value, d, hedged):
+            attempts.remove(d)
+            if result.called:
+                return
+            if call.active():
+                call.cancel()
+            if hedged:
+                policy.wins += 1
+            result.callback(value)
+            # cancel the slower request
+            for loser in attempts[:]:
+                loser.cancel()
+
+        def attemptEb(failure, d):
+            attempts.remove(d)
+            if result.called:
+                return
+            # wait for the other request, if there is one
+            if not attempts:
+                if call.active():
+                    call.cancel()
+                result.errback(failure)
+
+        def hedge():
+            node = self.pickNode(method, exclude=[first],
+                idempotent=idempotent)
+            if node is not first:
+                policy.hedges += 1
+                attempt(node, True)
+
+        idempotent = kwargs.get('idempotent', False)
+        first = self.pickNode(method, idempotent=idempotent)
+        call = self._clock.callLater(policy.delay(), hedge)
+        attempt(first, False)
+        return result
+
+    def _succeeded(self, node, latency):
+        node.failures = 0
+        if not node.up:
+            self.log.info("[%s:%s] node is back up",
+                node.client.host, node.client.port)
+        node.up = True
+        if node.latency is None:
+            node.latency = latency
+        else:
+            node.latency += self.decay * (latency - node.latency)
+
+    def _failed(self, node):
+        node.failures += 1
+        if node.up and node.failures >= self.failureThreshold:
+            self.log.warn("[%s:%s] ejecting node after %d failures",
+                node.client.host, node.client.port, node.failures)
+            node.up = False
+
+    # health checks
+
+    def startHealthChecks(self, interval=10):
+        """
+        Check every node every interval seconds, by getting C{/}.
+        """
+        self.stopHealthChecks()
+        self._healthCheck = task.LoopingCall(self.checkHealth)
+        self._healthCheck.clock = self._clock
+        self._healthCheck.start(interval, now=False)
+
+    def stopHealthChecks(self):
+        if self._healthCheck is not None and self._healthCheck.running:
+            self._healthCheck.stop()
+        self._healthCheck = None
+
+    def checkHealth(self):
+        """
+        Check every node once.
+
+        @returns: a deferred that fires when all checks are done.
+        """
+        dl = []
+        for node in self.nodes:
+            d = self._getNodePage(node, '/', 'GET')
+            d.addErrback(lambda _: None)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def close(self):
+        """
+        Stop the health checks, and close the connections of the nodes.
+        """
+        self.stopHealthChecks()
+        return defer.DeferredList([client.CouchDB.close(self)] +
+            [node.client.close() for node in self.nodes])
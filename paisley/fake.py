@@ -0,0 +1,767 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_fake -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+An in-process fake CouchDB server, to test and benchmark against without a
+couchdb binary or a network.
+
+L{FakeCouchDB} keeps databases in memory and serves the parts of the
+CouchDB API paisley uses: documents with attachments, _all_docs,
+_bulk_docs, views with map and reduce functions written in Python, and
+normal, longpoll and continuous _changes feeds.  Its L{Faults} inject
+latency, bandwidth limits, errors and dropped connections.
+
+  couch = FakeCouchDB()
+  couch.addView('design', 'by_type', lambda doc: [(doc.get('type'), 1)])
+  port = couch.listen()
+  db = client.CouchDB('127.0.0.1', port.getHost().port)
+"""
+
+import base64
+import hashlib
+import itertools
+import random
+import uuid
+
+from collections import deque
+from urllib import unquote
+
+from twisted.web import resource, server
+
+from paisley.client import json
+
+
+class Faults(object):
+    """
+    I decide which faults to inject into each response.
+
+    @ivar latency:   the number of seconds to wait before responding.
+    @ivar jitter:    the maximum number of seconds added to the latency at
+                     random.
+    @ivar bandwidth: if not None, the number of bytes per second to send
+                     response bodies at.
+    @ivar chunkSize: the number of bytes sent at a time when the bandwidth is
+                     limited.
+    @ivar errorRate: the fraction of requests answered with errorStatus.
+    @ivar dropRate:  the fraction of requests whose connection is dropped
+                     instead of answered.
+    """
+
+    def __init__(self, seed=None):
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.bandwidth = None
+        self.chunkSize = 4096
+        self.errorRate = 0.0
+        self.errorStatus = 503
+        self.dropRate = 0.0
+        self._random = random.Random(seed)
+        # faults for the next requests, in order
+        self._queue = []
+
+    def failNext(self, status=503, count=1):
+        """
+        Answer the next count requests with status.
+        """
+        self._queue.extend([('error', status)] * count)
+
+    def dropNext(self, count=1):
+        """
+        Drop the connection of the next count requests before answering.
+        """
+        self._queue.extend([('drop', None)] * count)
+
+    def truncateNext(self, count=1):
+        """
+        Drop the connection of the next count requests halfway through
+        their response body.
+        """
+        self._queue.extend([('truncate', None)] * count)
+
+    def delay(self):
+        """
+        @returns: the number of seconds to wait before responding.
+        @rtype:   C{float}
+        """
+        return self.latency + self.jitter * self._random.random()
+
+    def next(self):
+        """
+        @returns: the fault for the next request: ('error', status),
+                  ('drop', None), ('truncate', None) or None.
+        """
+        if self._queue:
+            return self._queue.pop(0)
+        if self.errorRate and self._random.random() < self.errorRate:
+            return ('error', self.errorStatus)
+        if self.dropRate and self._random.random() < self.dropRate:
+            return ('drop', None)
+        return None
+
+
+class _Error(Exception):
+
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, status, error, reason)
+        self.status = status
+        self.body = {'error': error, 'reason': reason}
+
+
+def _notFound(reason='missing'):
+    return _Error(404, 'not_found', reason)
+
+
+# the body of a request that is not valid JSON
+_INVALID = object()
+
+
+def _json(body):
+    if body is _INVALID:
+        raise _Error(400, 'bad_request', 'invalid UTF-8 JSON')
+    return body
+
+
+class _Database(object):
+
+    def __init__(self, name):
+        self.name = name
+        # id -> current revision of the document, with _id and _rev; the
+        # attachments are kept as content_type and data
+        self.docs = {}
+        self.seq = 0
+        # id -> (seq, change) of the last change of every document
+        self.changes = {}
+        # requests of the continuous feeds
+        self.feeds = []
+        # requests of the longpoll feeds
+        self.waiting = []
+
+    def info(self):
+        return {
+            'db_name': self.name,
+            'doc_count': len([d for d in self.docs.values()
+                if not d.get('_deleted')]),
+            'update_seq': self.seq,
+        }
+
+    def get(self, docId):
+        doc = self.docs.get(docId)
+        if doc is None:
+            raise _notFound('missing')
+        if doc.get('_deleted'):
+            raise _notFound('deleted')
+        return doc
+
+    def save(self, doc, docId=None):
+        """
+        Save a new revision of a document.
+
+        @returns: the id and new revision.
+        """
+        doc = dict(doc)
+        if docId is None:
+            docId = doc.get('_id') or uuid.uuid4().hex
+        docId = unicode(docId)
+        current = self.docs.get(docId)
+        if current is not None and (current.get('_rev') != doc.get('_rev')
+                and not (current.get('_deleted') and '_rev' not in doc)):
+            raise _Error(409, 'conflict', 'Document update conflict.')
+        if current is None and '_rev' in doc:
+            raise _Error(409, 'conflict', 'Document update conflict.')
+
+        attachments = {}
+        old = (current or {}).get('_attachments', {})
+        for name, att in doc.get('_attachments', {}).items():
+            if att.get('stub'):
+                if name not in old:
+                    raise _Error(412, 'missing_stub',
+                        'no attachment %s' % (name, ))
+                attachments[name] = old[name]
+            else:
+                attachments[name] = {
+                    'content_type': att.get('content_type',
+                        'application/octet-stream'),
+                    'data': base64.b64decode(att.get('data', '')),
+                }
+        if attachments:
+            doc['_attachments'] = attachments
+        else:
+            doc.pop('_attachments', None)
+
+        number = 1
+        if current is not None:
+            number = int(current['_rev'].split('-')[0]) + 1
+        doc['_id'] = docId
+        doc.pop('_rev', None)
+        digest = hashlib.md5(repr(sorted(doc.items()))).hexdigest()
+        doc['_rev'] = u'%d-%s' % (number, digest)
+        if doc.get('_deleted'):
+            doc = {'_id': docId, '_rev': doc['_rev'], '_deleted': True}
+        self.docs[docId] = doc
+        self._changed(doc)
+        return docId, doc['_rev']
+
+    def delete(self, docId, rev):
+        doc = self.get(docId)
+        if doc['_rev'] != rev:
+            raise _Error(409, 'conflict', 'Document update conflict.')
+        return self.save({'_rev': rev, '_deleted': True}, docId)
+
+    def _changed(self, doc):
+        self.seq += 1
+        change = {'seq': self.seq, 'id': doc['_id'],
+            'changes': [{'rev': doc['_rev']}]}
+        if doc.get('_deleted'):
+            change['deleted'] = True
+        self.changes[doc['_id']] = (self.seq, change)
+        for feed in self.feeds:
+            feed.change(change)
+        waiting, self.waiting = self.waiting, []
+        for feed in waiting:
+            feed.change(change)
+
+    def changesSince(self, since):
+        return [change for seq, change in sorted(self.changes.values())
+            if seq > since]
+
+
+def _publicDoc(doc):
+    """
+    Return the document as served, with attachment stubs.
+    """
+    if '_attachments' not in doc:
+        return doc
+    doc = dict(doc)
+    doc['_attachments'] = dict((name, {
+        'content_type': att['content_type'],
+        'length': len(att['data']),
+        'stub': True,
+    }) for name, att in doc['_attachments'].items())
+    return doc
+
+
+def _sortKey(key):
+    # CouchDB collation, roughly: null, booleans, numbers, strings, arrays,
+    # objects
+    if key is None:
+        return (0, )
+    if key is False or key is True:
+        return (1, key)
+    if isinstance(key, (int, long, float)):
+        return (2, key)
+    if isinstance(key, basestring):
+        return (3, key)
+    if isinstance(key, list):
+        return (4, [_sortKey(k) for k in key])
+    return (5, sorted(key.items()))
+
+
+class _Query(object):
+    """
+    I parse the query arguments of a view or _all_docs request.
+    """
+
+    def __init__(self, request, body):
+        args = request.args
+
+        def arg(name, default=None):
+            if name not in args:
+                return default
+            return args[name][0]
+
+        def jsonArg(name):
+            if name not in args:
+                return None
+            try:
+                return json.loads(args[name][0])
+            except ValueError:
+                raise _Error(400, 'bad_request',
+                    'invalid %s: %s' % (name, args[name][0]))
+
+        def docIdArg(name):
+            if name not in args:
+                return None
+            return args[name][0].decode('utf-8')
+
+        self.key = jsonArg('key')
+        self.hasKey = 'key' in args
+        self.keys = (_json(body) or {}).get('keys')
+        self.descending = arg('descending') == 'true' or \
+            arg('reverse') == 'true'
+        self.startkey = jsonArg('startkey')
+        self.startkeyDocId = docIdArg('startkey_docid')
+        self.endkey = jsonArg('endkey')
+        self.endkeyDocId = docIdArg('endkey_docid')
+        self.inclusiveEnd = arg('inclusive_end') != 'false'
+        self.limit = int(arg('limit', arg('count', -1)))
+        self.skip = int(arg('skip', 0))
+        self.includeDocs = arg('include_docs') in ('true', 'True')
+        self.reduce = arg('reduce')
+        self.group = arg('group') == 'true'
+
+    def select(self, rows):
+        """
+        @param rows: the rows, sorted by key.
+
+        @returns: the rows asked for.
+        """
+        if self.keys is not None:
+            selected = []
+            for key in self.keys:
+                selected.extend([row for row in rows if row['key'] == key])
+            rows = selected
+        elif self.hasKey:
+            rows = [row for row in rows if row['key'] == self.key]
+        if self.descending:
+            rows = list(reversed(rows))
+        if self.startkey is not None:
+            start = self._bound(self.startkey, self.startkeyDocId)
+            if self.descending:
+                rows = [r for r in rows if self._position(r, start) <= start]
+            else:
+                rows = [r for r in rows if self._position(r, start) >= start]
+        if self.endkey is not None:
+            end = self._bound(self.endkey, self.endkeyDocId)
+
+            def inRange(row):
+                position = self._position(row, end)
+                if self.descending:
+                    return position > end or \
+                        (self.inclusiveEnd and position == end)
+                return position < end or \
+                    (self.inclusiveEnd and position == end)
+            rows = [r for r in rows if inRange(r)]
+        return rows
+
+    def _bound(self, key, docId):
+        # rows with the same key are sorted by document id, which a
+        # startkey_docid or endkey_docid narrows down
+        if docId is None:
+            return (_sortKey(key), )
+        return (_sortKey(key), docId)
+
+    def _position(self, row, bound):
+        return (_sortKey(row['key']), row['id'])[:len(bound)]
+
+    def page(self, rows):
+        rows = rows[self.skip:]
+        if self.limit >= 0:
+            rows = rows[:self.limit]
+        return rows
+
+
+class _Response(object):
+    """
+    I send a response, after the latency and at the bandwidth of the faults.
+    """
+
+    def __init__(self, couch, request):
+        self.couch = couch
+        self.request = request
+        self.gone = False
+        self._call = None
+        request.notifyFinish().addErrback(self._gone)
+
+    def _gone(self, _):
+        self.gone = True
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+    def _later(self, delay, f, *args):
+        if delay:
+            self._call = self.couch.clock.callLater(delay, f, *args)
+        else:
+            f(*args)
+
+    def send(self, status, body, headers=None, contentType=None):
+        fault = self.couch.faults.next()
+        if fault is not None and fault[0] == 'error':
+            status = fault[1]
+            body = {'error': 'fault', 'reason': 'injected'}
+            contentType = None
+        if contentType is None:
+            contentType = 'application/json'
+            if status != 304:
+                body = json.dumps(body) + '\n'
+        if status == 304:
+            body = ''
+        self._later(self.couch.faults.delay(), self._respond, status, body,
+            headers or {}, contentType, fault)
+
+    def _respond(self, status, body, headers, contentType, fault):
+        if self.gone:
+            return
+        if fault is not None and fault[0] == 'drop':
+            self.request.transport.abortConnection()
+            return
+        request = self.request
+        request.setResponseCode(status)
+        request.setHeader('Content-Type', contentType)
+        request.setHeader('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            request.setHeader(name, value)
+        if fault is not None and fault[0] == 'truncate':
+            request.write(body[:len(body) // 2])
+            request.transport.abortConnection()
+            return
+        self._write(body)
+
+    def _write(self, body):
+        if self.gone:
+            return
+        bandwidth = self.couch.faults.bandwidth
+        if not bandwidth or not body:
+            if body:
+                self.request.write(body)
+            self.request.finish()
+            return
+        size = self.couch.faults.chunkSize
+        self.request.write(body[:size])
+        self._later(float(size) / bandwidth, self._write, body[size:])
+
+
+class _Feed(object):
+    """
+    I send the changes of a database to a _changes request.
+    """
+
+    def __init__(self, db, request, continuous):
+        self.db = db
+        self.request = request
+        self.continuous = continuous
+        self.gone = False
+        request.notifyFinish().addBoth(self._gone)
+
+    def _gone(self, _):
+        self.gone = True
+        if self in self.db.feeds:
+            self.db.feeds.remove(self)
+        if self in self.db.waiting:
+            self.db.waiting.remove(self)
+
+    def start(self, changes):
+        self.request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        if self.continuous:
+            # send the headers right away, as CouchDB does
+            self.request.write('')
+            for change in changes:
+                self.change(change)
+            self.db.feeds.append(self)
+        elif changes:
+            self.finish(changes)
+        else:
+            self.db.waiting.append(self)
+
+    def change(self, change):
+        if self.gone:
+            return
+        if self.continuous:
+            self.request.write(json.dumps(change) + '\n')
+        else:
+            self.finish([change])
+
+    def finish(self, changes):
+        self.request.write(json.dumps({'results': changes,
+            'last_seq': changes and changes[-1]['seq'] or self.db.seq}))
+        self.request.finish()
+
+    def drop(self):
+        self.request.transport.abortConnection()
+
+
+class _Resource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, couch):
+        resource.Resource.__init__(self)
+        self.couch = couch
+
+    def render(self, request):
+        couch = self.couch
+        couch.requests.append((request.method, request.uri))
+        segments = [unquote(s).decode('utf-8')
+            for s in request.path.split('/')[1:]]
+        if segments and segments[-1] == '':
+            segments.pop()
+        # attachments are not JSON; the handlers check it where they need it
+        body = request.content.read() or None
+        if body is not None:
+            try:
+                body = json.loads(body)
+            except ValueError:
+                body = _INVALID
+        response = _Response(couch, request)
+        try:
+            result = self.dispatch(request, segments, body)
+        except _Error, e:
+            response.send(e.status, e.body)
+        else:
+            if result is not None:
+                response.send(*result)
+        return server.NOT_DONE_YET
+
+    def dispatch(self, request, segments, body):
+        method = request.method
+        couch = self.couch
+        if not segments:
+            return 200, {'couchdb': 'Welcome', 'version': couch.version}
+        if segments == ['_all_dbs']:
+            return 200, sorted(couch.databases.keys())
+
+        dbName = segments.pop(0)
+        if not segments:
+            if method == 'PUT':
+                if dbName in couch.databases:
+                    raise _Error(412, 'file_exists',
+                        'The database could not be created, '
+                        'the file already exists.')
+                couch.createDB(dbName)
+                return 201, {'ok': True}
+            db = couch.db(dbName)
+            if method == 'DELETE':
+                couch.deleteDB(dbName)
+                return 200, {'ok': True}
+            if method == 'POST':
+                docId, rev = db.save(_json(body) or {})
+                return 201, {'ok': True, 'id': docId, 'rev': rev}
+            return 200, db.info()
+
+        db = couch.db(dbName)
+        first = segments[0]
+        if first in ('_compact', '_view_cleanup', '_ensure_full_commit'):
+            return 202, {'ok': True}
+        if first == '_all_docs':
+            return self.allDocs(request, db, body)
+        if first == '_bulk_docs':
+            return self.bulkDocs(db, body)
+        if first == '_changes':
+            return self.changes(request, db)
+        if first == '_design':
+            if len(segments) >= 4 and segments[2] == '_view':
+                return self.view(request, db, segments[1], segments[3],
+                    body)
+            docId = '_design/' + segments[1]
+            segments = segments[2:]
+        else:
+            docId = first
+            segments = segments[1:]
+        if segments:
+            return self.attachment(request, db, docId, '/'.join(segments),
+                body)
+        return self.document(request, db, docId, body)
+
+    def document(self, request, db, docId, body):
+        method = request.method
+        if method == 'PUT':
+            docId, rev = db.save(_json(body) or {}, docId)
+            return 201, {'ok': True, 'id': docId, 'rev': rev}, \
+                {'ETag': '"%s"' % (rev, )}
+        if method == 'DELETE':
+            docId, rev = db.delete(docId, request.args.get('rev', [''])[0])
+            return 200, {'ok': True, 'id': docId, 'rev': rev}
+        doc = db.get(docId)
+        if 'rev' in request.args and request.args['rev'][0] != doc['_rev']:
+            raise _notFound('missing')
+        etag = '"%s"' % (doc['_rev'], )
+        if request.getHeader('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+        return 200, _publicDoc(doc), {'ETag': etag}
+
+    def attachment(self, request, db, docId, name, body):
+        if request.method == 'PUT':
+            doc = dict(db.docs.get(docId) or {'_id': docId})
+            if request.args.get('rev', [None])[0] != doc.get('_rev'):
+                raise _Error(409, 'conflict', 'Document update conflict.')
+            attachments = _publicDoc(doc).get('_attachments', {})
+            request.content.seek(0)
+            attachments[name] = {
+                'content_type': request.getHeader('Content-Type'),
+                'data': base64.b64encode(request.content.read()),
+            }
+            doc['_attachments'] = attachments
+            docId, rev = db.save(doc, docId)
+            return 201, {'ok': True, 'id': docId, 'rev': rev}
+        att = db.get(docId).get('_attachments', {}).get(name)
+        if att is None:
+            raise _notFound('Document is missing attachment')
+        return 200, att['data'], {}, att['content_type']
+
+    def allDocs(self, request, db, body):
+        query = _Query(request, body)
+        rows = []
+        for docId in sorted(db.docs):
+            doc = db.docs[docId]
+            row = {'id': docId, 'key': docId, 'value': {'rev': doc['_rev']}}
+            if doc.get('_deleted'):
+                if query.keys is None:
+                    continue
+                row['value']['deleted'] = True
+                row['doc'] = None
+            elif query.includeDocs:
+                row['doc'] = _publicDoc(doc)
+            rows.append(row)
+        total = len([r for r in rows if not r['value'].get('deleted')])
+        if query.keys is not None:
+            byKey = dict((row['key'], row) for row in rows)
+            selected = [byKey.get(key, {'key': key, 'error': 'not_found'})
+                for key in query.keys]
+        else:
+            selected = query.select(rows)
+        return 200, {'total_rows': total, 'offset': query.skip,
+            'rows': query.page(selected)}
+
+    def bulkDocs(self, db, body):
+        results = []
+        for doc in (_json(body) or {}).get('docs', []):
+            try:
+                docId, rev = db.save(doc)
+            except _Error, e:
+                results.append({'id': doc.get('_id'),
+                    'error': e.body['error'], 'reason': e.body['reason']})
+            else:
+                results.append({'ok': True, 'id': docId, 'rev': rev})
+        return 201, results
+
+    def view(self, request, db, designName, viewName, body):
+        view = self.couch.views.get((designName, viewName))
+        if view is None:
+            raise _notFound('missing_named_view')
+        mapper, reducer = view
+        query = _Query(request, body)
+        rows = []
+        for docId in sorted(db.docs):
+            doc = db.docs[docId]
+            if doc.get('_deleted') or docId.startswith('_design/'):
+                continue
+            for key, value in mapper(_publicDoc(doc)) or []:
+                row = {'id': docId, 'key': key, 'value': value}
+                if query.includeDocs:
+                    row['doc'] = _publicDoc(doc)
+                rows.append(row)
+        rows.sort(key=lambda row: (_sortKey(row['key']), row['id']))
+        selected = query.select(rows)
+        etag = '"%s-%d"' % (db.name, db.seq)
+        headers = {'ETag': etag}
+        if request.getHeader('If-None-Match') == etag:
+            return 304, None, headers
+
+        if reducer is not None and query.reduce != 'false':
+            if query.group:
+                groups = []
+                for key, group in itertools.groupby(selected,
+                        lambda row: row['key']):
+                    group = list(group)
+                    groups.append({'key': key, 'value': reducer(
+                        [r['key'] for r in group],
+                        [r['value'] for r in group])})
+                return 200, {'rows': query.page(groups)}, headers
+            value = reducer([r['key'] for r in selected],
+                [r['value'] for r in selected])
+            return 200, {'rows': [{'key': None, 'value': value}]}, headers
+        return 200, {'total_rows': len(rows), 'offset': query.skip,
+            'rows': query.page(selected)}, headers
+
+    def changes(self, request, db):
+        feed = request.args.get('feed', ['normal'])[0]
+        since = int(request.args.get('since', [0])[0] or 0)
+        changes = db.changesSince(since)
+        if feed == 'normal':
+            return 200, {'results': changes, 'last_seq': db.seq}
+        feed = _Feed(db, request, feed == 'continuous')
+
+        def start():
+            if not feed.gone:
+                feed.start(changes)
+        delay = self.couch.faults.delay()
+        if delay:
+            self.couch.clock.callLater(delay, start)
+        else:
+            start()
+        return None
+
+
+class FakeCouchDB(object):
+    """
+    I am an in-memory CouchDB server.
+
+    @ivar databases: the databases by name.
+    @ivar views:     the map and reduce functions of the views, by design
+                     document and view name.
+    @ivar faults:    the faults to inject.
+    @type faults:    L{Faults}
+    @ivar requests:  the method and uri of the last keepRequests requests
+                     received, oldest first.
+    """
+
+    version = '1.0.1'
+
+    def __init__(self, seed=None, keepRequests=1000, clock=None):
+        """
+        @param keepRequests: the number of requests to keep in requests; a
+                             benchmark can send many more.
+        @type  keepRequests: C{int}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+        self.databases = {}
+        self.views = {}
+        self.faults = Faults(seed)
+        self.requests = deque(maxlen=keepRequests)
+
+    def createDB(self, dbName):
+        db = self.databases[dbName] = _Database(dbName)
+        return db
+
+    def deleteDB(self, dbName):
+        db = self.databases.pop(dbName)
+        for feed in db.feeds + db.waiting:
+            feed.drop()
+
+    def db(self, dbName):
+        db = self.databases.get(dbName)
+        if db is None:
+            raise _notFound('no_db_file')
+        return db
+
+    def addView(self, designName, viewName, map, reduce=None):
+        """
+        Add a view, served for every database from
+        /db/_design/designName/_view/viewName.
+
+        @param map:    called with every document; returns a list of
+                       (key, value) pairs to emit.
+        @param reduce: if specified, called with a list of keys and a list
+                       of values; returns the reduced value.
+        """
+        self.views[(designName, viewName)] = (map, reduce)
+
+    def dropFeeds(self):
+        """
+        Drop the connections of every continuous and longpoll _changes
+        feed.
+        """
+        for db in self.databases.values():
+            for feed in db.feeds + db.waiting:
+                feed.drop()
+
+    def resource(self):
+        """
+        @returns: the root resource of the server.
+        @rtype:   L{resource.Resource}
+        """
+        return _Resource(self)
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        """
+        Listen on a TCP port.
+
+        @rtype: L{twisted.internet.interfaces.IListeningPort}
+        """
+        from twisted.internet import reactor
+        return reactor.listenTCP(port, server.Site(self.resource()),
+            interface=interface)
@@ -0,0 +1,357 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_load -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Open-loop load generation.
+
+The benchmarks in L{paisley.bench} are closed-loop: a request is only sent
+once an earlier one finished, so when the server stalls, the requests that
+would have been sent meanwhile are never measured.  This is called
+coordinated omission, and hides exactly the latency that queueing adds.
+
+L{LoadGenerator} sends requests at a fixed rate, whether or not earlier
+ones finished, and measures the latency of each request from the time it
+should have been sent, so that a request delayed by a stall of the server,
+the client or the reactor counts the delay.  L{sweep} runs the generator at
+increasing rates to find where a client configuration saturates.
+
+See scripts/paisley_load.py to run it against a server.
+"""
+
+import random
+
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class LatencyHistogram(object):
+    """
+    I count latencies in log-linear buckets, like an HDR histogram: values
+    are kept with significantDigits decimal digits of precision over the
+    whole range, in memory that grows with the logarithm of the range.
+
+    @ivar count: the number of values recorded.
+    @ivar max:   the largest value recorded.
+    """
+
+    def __init__(self, unit=0.000001, significantDigits=2):
+        """
+        @param unit:              the resolution in seconds.
+        @type  unit:              C{float}
+        @param significantDigits: the number of decimal digits of precision.
+        @type  significantDigits: C{int}
+        """
+        self.unit = unit
+        bits = 1
+        while 2 ** bits < 2 * 10 ** significantDigits:
+            bits += 1
+        self._subBucketBits = bits
+        # value in units of the lowest value of a bucket -> count
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _bucket(self, units):
+        shift = max(0, units.bit_length() - self._subBucketBits)
+        return (units >> shift) << shift, (1 << shift) - 1
+
+    def record(self, value, count=1):
+        """
+        Record a value in seconds, count times.
+        """
+        units = int(value / self.unit)
+        lowest, _ = self._bucket(units)
+        self.counts[lowest] = self.counts.get(lowest, 0) + count
+        self.count += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        @returns: the highest value equivalent to the percentile, in
+                  seconds, or None if no values were recorded.
+        @rtype:   C{float}
+        """
+        if not self.count:
+            return None
+        rank = max(1, self.count * percentile / 100.0)
+        seen = 0
+        for lowest in sorted(self.counts):
+            seen += self.counts[lowest]
+            if seen >= rank:
+                _, width = self._bucket(lowest)
+                return min((lowest + width) * self.unit, self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def snapshot(self):
+        """
+        @returns: the count, mean and maximum, and the p50, p90, p99 and
+                  p999 percentiles.
+        @rtype:   C{dict}
+        """
+        result = {'count': self.count, 'mean': self.mean(), 'max': self.max}
+        for name, p in (('p50', 50), ('p90', 90), ('p99', 99),
+                ('p999', 99.9)):
+            result[name] = self.percentile(p)
+        return result
+
+
+class LoadResult(object):
+    """
+    I hold the outcome of running a L{LoadGenerator}.
+
+    @ivar latency:    the latency of every successful request, from the
+                      time it should have been sent.
+    @type latency:    L{LatencyHistogram}
+    @ivar service:    the latency of every successful request, from the
+                      time it was sent; not corrected for coordinated
+                      omission, for comparison.
+    @type service:    L{LatencyHistogram}
+    @ivar operations: the corrected latency per operation.
+    @type operations: C{dict} of C{str} -> L{LatencyHistogram}
+    @ivar errors:     the number of failed requests per operation and
+                      exception class name.
+    @ivar elapsed:    the number of seconds from the first request being
+                      due to the last one finishing.
+    """
+
+    def __init__(self, rate, duration):
+        self.rate = rate
+        self.duration = duration
+        self.sent = 0
+        self.completed = 0
+        self.errors = {}
+        self.elapsed = 0.0
+        self.maxInFlight = 0
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.operations = {}
+
+    def achieved(self):
+        """
+        @returns: the number of requests finished per second.
+        @rtype:   C{float}
+        """
+        if not self.elapsed:
+            return None
+        return self.completed / self.elapsed
+
+    def summary(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            'rate': self.rate,
+            'duration': self.duration,
+            'achieved': self.achieved(),
+            'requests': self.completed,
+            'errors': dict(('%s %s' % key, n)
+                for key, n in self.errors.items()),
+            'maxInFlight': self.maxInFlight,
+            'latency': self.latency.snapshot(),
+            'service': self.service.snapshot(),
+            'operations': dict((name, histogram.snapshot())
+                for name, histogram in self.operations.items()),
+        }
+
+
+class LoadGenerator(object):
+    """
+    I send requests at a fixed rate for a number of seconds, picking each
+    operation at random out of a weighted mix.
+
+    Requests are sent when they are due, whether or not earlier requests
+    finished.  If maxInFlight requests are in flight, due requests wait
+    until one finishes; their latency still counts from when they were due.
+    """
+
+    def __init__(self, mix, rate, duration, maxInFlight=None, seed=None,
+                 clock=None):
+        """
+        @param mix:         the operations, with their relative weight; an
+                            operation is called without arguments and returns
+                            a deferred.
+        @type  mix:         C{list} of (C{str}, C{float}, callable)
+        @param rate:        the number of requests per second.
+        @type  rate:        C{float}
+        @param duration:    the number of seconds to send requests for.
+        @type  duration:    C{float}
+        @param maxInFlight: if not None, the maximum number of requests in
+                            flight.
+        @type  maxInFlight: C{int}
+        @param seed:        if not None, the seed to pick operations with.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self._random = random.Random(seed)
+        self.mix = mix
+        self.rate = rate
+        self.duration = duration
+        self.maxInFlight = maxInFlight
+
+        self._total = int(rate * duration)
+        self._next = 0
+        self._inFlight = 0
+        self._waiting = deque()
+        self._sending = False
+        self._start = None
+        self._deferred = None
+        self.result = LoadResult(rate, duration)
+
+    def _pick(self):
+        total = sum(weight for name, weight, operation in self.mix)
+        choice = self._random.random() * total
+        for name, weight, operation in self.mix:
+            choice -= weight
+            if choice < 0:
+                break
+        return name, operation
+
+    def start(self):
+        """
+        @returns: a deferred firing with the L{LoadResult} once every
+                  request sent finished.
+        @rtype:   L{defer.Deferred}
+        """
+        self._deferred = defer.Deferred()
+        self._start = self._clock.seconds()
+        self._tick()
+        return self._deferred
+
+    def _due(self, index):
+        return self._start + index / float(self.rate)
+
+    def _tick(self):
+        now = self._clock.seconds()
+        # catch up with every request that came due since the last tick
+        while self._next < self._total and self._due(self._next) <= now:
+            self._waiting.append(self._due(self._next))
+            self._next += 1
+        self._sendWaiting()
+        if self._next < self._total:
+            self._clock.callLater(
+                max(0, self._due(self._next) - now), self._tick)
+        else:
+            self._checkDone()
+
+    def _sendWaiting(self):
+        # operations finishing right away call me again
+        if self._sending:
+            return
+        self._sending = True
+        try:
+            while self._waiting and (self.maxInFlight is None or
+                    self._inFlight < self.maxInFlight):
+                self._send(self._waiting.popleft())
+        finally:
+            self._sending = False
+
+    def _send(self, due):
+        name, operation = self._pick()
+        sent = self._clock.seconds()
+        self._inFlight += 1
+        self.result.sent += 1
+        self.result.maxInFlight = max(self.result.maxInFlight,
+            self._inFlight)
+        d = defer.maybeDeferred(operation)
+        d.addBoth(self._finished, name, due, sent)
+
+    def _finished(self, result, name, due, sent):
+        now = self._clock.seconds()
+        self._inFlight -= 1
+        self.result.completed += 1
+        if isinstance(result, Failure):
+            key = (name, result.type.__name__)
+            self.result.errors[key] = self.result.errors.get(key, 0) + 1
+        else:
+            self.result.latency.record(now - due)
+            self.result.service.record(now - sent)
+            histogram = self.result.operations.get(name)
+            if histogram is None:
+                histogram = self.result.operations[name] = \
+                    LatencyHistogram()
+            histogram.record(now - due)
+        self._sendWaiting()
+        self._checkDone()
+
+    def _checkDone(self):
+        if self._next < self._total or self._waiting or self._inFlight:
+            return
+        if self._deferred is None or self._deferred.called:
+            return
+        self.result.elapsed = self._clock.seconds() - self._start
+        self._deferred.callback(self.result)
+
+
+def sustained(result, tolerance=0.1, maxLatency=None, percentile=99):
+    """
+    @param maxLatency: if not None, the number of seconds the corrected
+                       latency percentile may be at most.
+
+    @returns: whether the load was sustained: the requests finished at
+              least at the rate they were sent at, minus the tolerance as a
+              fraction, without errors and within the maximum latency.
+    @rtype:   C{bool}
+    """
+    achieved = result.achieved()
+    if achieved is None or achieved < result.rate * (1 - tolerance):
+        return False
+    if result.errors:
+        return False
+    if maxLatency is not None and \
+            result.latency.percentile(percentile) > maxLatency:
+        return False
+    return True
+
+
+@defer.inlineCallbacks
+def sweep(mix, rates, duration, maxInFlight=None, tolerance=0.1,
+          maxLatency=None, log=None, clock=None):
+    """
+    Run a L{LoadGenerator} at every rate, in order, until a rate is not
+    sustained.
+
+    @param log: if specified, called with the L{LoadResult} of every rate.
+
+    @returns: a deferred firing with the L{LoadResult} of every rate run.
+    @rtype:   L{defer.Deferred}
+    """
+    results = []
+    for rate in rates:
+        generator = LoadGenerator(mix, rate, duration,
+            maxInFlight=maxInFlight, clock=clock)
+        result = yield generator.start()
+        results.append(result)
+        if log is not None:
+            log(result)
+        if not sustained(result, tolerance, maxLatency):
+            break
+    defer.returnValue(results)
+
+
+def saturation(results, tolerance=0.1, maxLatency=None):
+    """
+    @returns: the highest rate sustained before the first rate that was
+              not, or None if the lowest rate was not sustained.
+    @rtype:   C{float}
+    """
+    rate = None
+    for result in sorted(results, key=lambda r: r.rate):
+        if not sustained(result, tolerance, maxLatency):
+            break
+        rate = result.rate
+    return rate
@@ -0,0 +1,282 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_metrics -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Request metrics, per operation and database.
+"""
+
+import bisect
+import re
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram(object):
+    """
+    I count values in exponentially growing buckets, to estimate
+    percentiles in constant memory.
+
+    @ivar bounds: the upper bound of every bucket but the last, which holds
+                  the values above the largest bound.
+    @ivar counts: the number of values in each bucket.
+    """
+
+    def __init__(self, smallest=0.0005, factor=2.0, buckets=20):
+        """
+        @param smallest: the upper bound of the first bucket.
+        @type  smallest: C{float}
+        @param factor:   the ratio between the bounds of adjacent buckets.
+        @type  factor:   C{float}
+        @param buckets:  the number of bounded buckets.
+        @type  buckets:  C{int}
+        """
+        self.bounds = [smallest * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        Estimate a percentile, interpolating within its bucket.
+
+        @type  percentile: C{float}
+
+        @returns: the estimate, or None if no values were added.
+        @rtype:   C{float}
+        """
+        if not self.count:
+            return None
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            if seen >= rank:
+                lower = i and self.bounds[i - 1] or 0.0
+                upper = i < len(self.bounds) and self.bounds[i] or self.max
+                fraction = (rank - (seen - n)) / float(n)
+                return min(lower + (upper - lower) * fraction, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        @returns: the count, sum and maximum, and the usual percentiles as
+                  p50, p95 and p99.
+        @rtype:   C{dict}
+        """
+        result = {'count': self.count, 'sum': self.sum, 'max': self.max}
+        for percentile in PERCENTILES:
+            result['p%d' % percentile] = self.percentile(percentile)
+        return result
+
+
+class _Operation(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = {}
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.inFlight = 0
+        self.latency = Histogram()
+        self.phases = {}
+
+
+class Metrics(object):
+    """
+    I collect request metrics per operation description, like openDoc or
+    saveDoc, and database; requests outside a database have None as
+    database.
+
+    Pass me as the metrics of a L{paisley.client.CouchDB}.  Read my
+    metrics with L{snapshot} or L{prometheusText}, or add sinks to pass
+    every request on to, like L{StatsdSink}.
+
+    A sink has a method
+    C{record(descr, dbName, status, latency, sent, received)}, where status
+    is the HTTP status, or the name of the exception class if the request
+    failed without one.
+    """
+
+    def __init__(self):
+        self._operations = {}
+        self._sinks = []
+
+    def addSink(self, sink):
+        self._sinks.append(sink)
+
+    def removeSink(self, sink):
+        self._sinks.remove(sink)
+
+    def _operation(self, descr, dbName):
+        key = (descr, dbName)
+        operation = self._operations.get(key)
+        if operation is None:
+            operation = self._operations[key] = _Operation()
+        return operation
+
+    def started(self, descr, dbName):
+        """
+        A request started.
+        """
+        self._operation(descr, dbName).inFlight += 1
+
+    def finished(self, descr, dbName, status, latency, sent, received):
+        """
+        A request started with L{started} finished.
+
+        @param status:   the HTTP status, or the name of the exception the
+                         request failed with.
+        @param latency:  the number of seconds the request took.
+        @param sent:     the number of bytes of the request body.
+        @param received: the number of bytes of the response body.
+        """
+        operation = self._operation(descr, dbName)
+        operation.inFlight -= 1
+        operation.requests += 1
+        if not isinstance(status, int) or status >= 400:
+            operation.errors[status] = operation.errors.get(status, 0) + 1
+        operation.bytesSent += sent
+        operation.bytesReceived += received
+        operation.latency.add(latency)
+
+        for sink in self._sinks:
+            sink.record(descr, dbName, status, latency, sent, received)
+
+    def timed(self, descr, dbName, phases):
+        """
+        Record how long the phases of a request took.
+
+        @param phases: the number of seconds per phase; see
+                       L{paisley.client.RequestTiming}.
+        @type  phases: C{dict} of C{str} -> C{float}
+        """
+        operation = self._operation(descr, dbName)
+        for phase, duration in phases.items():
+            histogram = operation.phases.get(phase)
+            if histogram is None:
+                histogram = operation.phases[phase] = Histogram()
+            histogram.add(duration)
+
+    def snapshot(self):
+        """
+        @returns: the metrics of every operation and database.
+        @rtype:   C{dict} of (descr, dbName) -> C{dict}
+        """
+        result = {}
+        for key, operation in self._operations.items():
+            result[key] = {
+                'requests': operation.requests,
+                'errors': dict(operation.errors),
+                'bytesSent': operation.bytesSent,
+                'bytesReceived': operation.bytesReceived,
+                'inFlight': operation.inFlight,
+                'latency': operation.latency.snapshot(),
+                'phases': dict((phase, histogram.snapshot())
+                    for phase, histogram in operation.phases.items()),
+            }
+        return result
+
+    def prometheusText(self, prefix='paisley'):
+        """
+        @returns: the metrics in the Prometheus text exposition format.
+        @rtype:   C{str}
+        """
+        lines = []
+
+        def labels(descr, dbName, **extra):
+            pairs = [('descr', descr), ('db', dbName or '')] + \
+                sorted(extra.items())
+            return '{%s}' % ','.join(['%s="%s"' % (name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for name, value in pairs])
+
+        def family(name, kind, value):
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for (descr, dbName), operation in sorted(
+                    self._operations.items()):
+                for extra, number in value(operation):
+                    lines.append('%s_%s%s %s' % (prefix, name,
+                        labels(descr, dbName, **extra), number))
+
+        family('requests_total', 'counter',
+            lambda o: [({}, o.requests)])
+        family('errors_total', 'counter',
+            lambda o: [({'status': status}, n)
+                for status, n in sorted(o.errors.items())])
+        family('sent_bytes_total', 'counter',
+            lambda o: [({}, o.bytesSent)])
+        family('received_bytes_total', 'counter',
+            lambda o: [({}, o.bytesReceived)])
+        family('in_flight', 'gauge',
+            lambda o: [({}, o.inFlight)])
+
+        def histogramFamily(name, histograms):
+            name = '%s_%s' % (prefix, name)
+            lines.append('# TYPE %s histogram' % (name, ))
+            for (descr, dbName), operation in sorted(
+                    self._operations.items()):
+                for extra, histogram in histograms(operation):
+                    seen = 0
+                    for bound, n in zip(histogram.bounds + ['+Inf'],
+                            histogram.counts):
+                        seen += n
+                        lines.append('%s_bucket%s %d' % (name,
+                            labels(descr, dbName, le=bound, **extra), seen))
+                    lines.append('%s_sum%s %r' % (name,
+                        labels(descr, dbName, **extra), histogram.sum))
+                    lines.append('%s_count%s %d' % (name,
+                        labels(descr, dbName, **extra), histogram.count))
+
+        histogramFamily('request_seconds',
+            lambda o: [({}, o.latency)])
+        histogramFamily('phase_seconds',
+            lambda o: [({'phase': phase}, histogram)
+                for phase, histogram in sorted(o.phases.items())])
+        return '\n'.join(lines) + '\n'
+
+
+_UNSAFE_RE = re.compile(r'[^A-Za-z0-9_-]')
+
+
+class StatsdSink(object):
+    """
+    I pass every request on as statsd lines:
+
+      paisley.openDoc.mydb.requests:1|c
+      paisley.openDoc.mydb.latency:12.5|ms
+      paisley.openDoc.mydb.sent:0|c
+      paisley.openDoc.mydb.received:517|c
+      paisley.openDoc.mydb.errors.404:1|c
+    """
+
+    def __init__(self, write, prefix='paisley'):
+        """
+        @param write:  called with every line, like the write method of a
+                       connected UDP transport.
+        @param prefix: the prefix of the metric names.
+        """
+        self._write = write
+        self.prefix = prefix
+
+    def record(self, descr, dbName, status, latency, sent, received):
+        name = '.'.join([self.prefix, _UNSAFE_RE.sub('_', descr),
+            _UNSAFE_RE.sub('_', dbName or '_')])
+        self._write('%s.requests:1|c' % (name, ))
+        self._write('%s.latency:%.3f|ms' % (name, latency * 1000))
+        self._write('%s.sent:%d|c' % (name, sent))
+        self._write('%s.received:%d|c' % (name, received))
+        if not isinstance(status, int) or status >= 400:
+            self._write('%s.errors.%s:1|c' % (name, status))
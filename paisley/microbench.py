@@ -0,0 +1,347 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_microbench -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Microbenchmarks of the CPU-bound hot paths: decoding JSON with
+L{paisley.pjson}, and mapping documents and view rows with
+L{paisley.mapping} and L{paisley.views}.
+
+Every benchmark runs on synthetic documents of a few shapes: small, wide,
+deeply nested, and with large arrays.  L{measure} reports the
+nanoseconds per operation, and the objects per operation: the number of
+distinct objects the result consists of.  Python 2 has no way to count
+every allocation, and the garbage collector counts neither untracked nor
+recycled dicts and lists, so this counts the allocations an operation
+keeps, which is what the size of decoded and mapped results is made of.
+
+See scripts/paisley_microbench.py to run them.
+"""
+
+import timeit
+
+from paisley import mapping, pjson, views
+from paisley.client import json
+
+
+def small():
+    """
+    @returns: a document with a handful of fields, like a blog post.
+    """
+    return {
+        "_id": "post-1",
+        "_rev": "1-967a00dff5e02add41819138abb3284d",
+        "Subject": "I like Plankton",
+        "Author": u"Rusty Caf\xe9",
+        "PostedDate": "2006-08-15T17:30:12Z",
+        "Tags": ["plankton", "baseball", "decisions"],
+        "Body": "I decided today that I don't like baseball. I like plankton.",
+    }
+
+
+def wide(fields=200):
+    """
+    @returns: a document with many fields of mixed types.
+    """
+    doc = {"_id": "wide-1", "_rev": "1-967a00dff5e02add41819138abb3284d"}
+    for index in range(fields):
+        kind = index % 4
+        if kind == 0:
+            value = u"value %d \xe9" % index
+        elif kind == 1:
+            value = index * 1000
+        elif kind == 2:
+            value = index / 7.0
+        else:
+            value = bool(index % 3)
+        doc["field%03d" % index] = value
+    return doc
+
+
+def nested(depth=20):
+    """
+    @returns: a document with objects nested depth deep.
+    """
+    child = {"leaf": True}
+    for level in range(depth, 0, -1):
+        child = {"level": level, "name": u"level %d" % level,
+            "tags": ["a", "b"], "child": child}
+    return {"_id": "nested-1", "_rev": "1-967a00dff5e02add41819138abb3284d",
+        "root": child}
+
+
+def array(items=1000):
+    """
+    @returns: a document with large arrays of numbers, strings and objects.
+    """
+    return {
+        "_id": "array-1",
+        "_rev": "1-967a00dff5e02add41819138abb3284d",
+        "numbers": range(items),
+        "strings": [u"item %d" % index for index in range(items)],
+        "objects": [{"n": index, "s": "item %d" % index}
+            for index in range(items)],
+    }
+
+SHAPES = [('small', small), ('wide', wide), ('nested', nested),
+    ('array', array)]
+
+
+def view(rows=1000):
+    """
+    @returns: a large openView result, with the documents included.
+    """
+    result = {'total_rows': rows, 'offset': 0, 'rows': []}
+    for index in range(rows):
+        doc = small()
+        doc['_id'] = 'post-%d' % index
+        result['rows'].append({'id': doc['_id'], 'key': [doc['Author'],
+            index], 'value': {'length': len(doc['Body'])}, 'doc': doc})
+    return result
+
+# the decoders to compare: the strict and non-strict ones pjson picks, and
+# the two strict ones it can pick from when the C scanner returns str
+DECODERS = [
+    ('loads-strict', lambda: pjson._get_loads(True)),
+    ('loads-nonstrict', lambda: pjson._get_loads(False)),
+    ('loads-decoding', pjson._decoding_loads),
+    ('loads-pyscanner', pjson._python_loads),
+]
+
+
+class Post(mapping.Document):
+    subject = mapping.TextField(name='Subject')
+    posted = mapping.DateTimeField(name='PostedDate')
+    price = mapping.DecimalField()
+    tags = mapping.ListField(mapping.TextField())
+    dates = mapping.ListField(mapping.DateTimeField())
+
+
+def post(items=100):
+    """
+    @returns: a document for L{Post}, with lists of items entries.
+    """
+    doc = small()
+    doc['price'] = '19.99'
+    doc['tags'] = [u'tag %d' % index for index in range(items)]
+    doc['dates'] = ['2006-08-%02dT17:30:12Z' % (index % 28 + 1)
+        for index in range(items)]
+    return doc
+
+
+class _Couch(object):
+    """
+    The part of a client a L{views.View} maps rows with.
+    """
+
+    def mapped(self, dbName, docId, obj):
+        pass
+
+
+def viewResult(rows=100):
+    """
+    @returns: a view result with rows rows, each with its document.
+    """
+    result = {'total_rows': rows, 'offset': 0, 'rows': []}
+    for index in range(rows):
+        doc = post(items=5)
+        doc['_id'] = 'post-%d' % index
+        result['rows'].append({'id': doc['_id'], 'key': index,
+            'value': None, 'doc': doc})
+    return result
+
+
+def _decode(decoder, payload):
+    loads = decoder()
+    return lambda: loads(payload), payload
+
+
+def _fromDict(doc):
+
+    def fromDict():
+        obj = Post()
+        obj.fromDict(doc)
+        return obj
+    return fromDict, doc
+
+
+def _get(name):
+    obj = Post()
+    obj.fromDict(post())
+    return lambda: getattr(obj, name), obj
+
+
+def _iterate(name):
+    obj = Post()
+    obj.fromDict(post())
+    return lambda: list(getattr(obj, name)), obj
+
+
+def _mapObjects(includeDocs):
+    result = viewResult()
+    view = views.View(_Couch(), 'db', 'design', 'view', Post)
+    return lambda: list(view._mapObjects(result,
+        include_docs=includeDocs)), result
+
+
+def benchmarks():
+    """
+    @returns: the name and a function to set up every benchmark; the
+              function returns the operation to measure and its input.
+    @rtype:   C{list} of (C{str}, callable)
+    """
+    result = []
+    for shape, factory in SHAPES + [('view', view)]:
+        payload = json.dumps(factory())
+        for name, decoder in DECODERS:
+            result.append(('%s/%s' % (name, shape),
+                lambda decoder=decoder, payload=payload:
+                    _decode(decoder, payload)))
+    for shape, factory in SHAPES:
+        result.append(('fromDict/%s' % shape,
+            lambda factory=factory: _fromDict(factory())))
+    result.extend([
+        ('get/TextField', lambda: _get('subject')),
+        ('get/DateTimeField', lambda: _get('posted')),
+        ('get/DecimalField', lambda: _get('price')),
+        ('iterate/ListField-TextField-100', lambda: _iterate('tags')),
+        ('iterate/ListField-DateTimeField-100', lambda: _iterate('dates')),
+        ('mapObjects/100', lambda: _mapObjects(False)),
+        ('mapObjects/100-include_docs', lambda: _mapObjects(True)),
+    ])
+    return result
+
+
+def _reachable(obj, seen):
+    """
+    Add the ids of the distinct objects obj consists of to seen, not
+    counting None and the booleans, and not looking into the shared fields
+    of mappings.
+    """
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if obj is None or obj is True or obj is False or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        # use the methods of the base types, since Mapping and
+        # ListField.Proxy override them to convert values
+        if isinstance(obj, dict):
+            stack.extend(dict.iterkeys(obj))
+            stack.extend(dict.itervalues(obj))
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(type(obj).__mro__[-2].__iter__(obj))
+        if hasattr(obj, '__dict__') and not isinstance(obj,
+                (type, mapping.Field)):
+            stack.append(vars(obj))
+    return seen
+
+
+def objects(operation, shared=None):
+    """
+    @param shared: if specified, the input of operation; the objects the
+                   result shares with it are not counted.
+
+    @returns: the number of distinct objects the result of calling
+              operation consists of, like the dicts, lists, strings and
+              numbers of a decoded document.
+    @rtype:   C{int}
+    """
+    seen = set()
+    if shared is not None:
+        _reachable(shared, seen)
+    before = len(seen)
+    return len(_reachable(operation(), seen)) - before
+
+
+def measure(name, operation, shared=None, minTime=0.2, repeat=3,
+            timer=None):
+    """
+    Measure an operation.
+
+    The operation is called in loops long enough to take at least minTime
+    seconds, with the garbage collector disabled like L{timeit} does, and
+    the fastest of repeat loops counts.
+
+    @param shared: if specified, the input of operation, see L{objects}.
+
+    @returns: the name, the number of calls per loop, the nanoseconds per
+              call as ns, and the objects per call as objects.
+    @rtype:   C{dict}
+    """
+    timer = timer or timeit.default_timer
+    timed = timeit.Timer(operation, timer=timer)
+    number = 1
+    while True:
+        elapsed = timed.timeit(number)
+        if elapsed >= minTime or number >= 10 ** 9:
+            break
+        number *= 10
+    best = min([elapsed] + timed.repeat(repeat - 1, number))
+    return {
+        'name': name,
+        'number': number,
+        'ns': best * 1e9 / number,
+        'objects': objects(operation, shared),
+    }
+
+
+def runAll(names=None, minTime=0.2, repeat=3, log=None):
+    """
+    Run the benchmarks, or the ones whose name starts with one of names.
+
+    @param log: if specified, called with every result as it is measured.
+
+    @rtype: C{list} of C{dict}
+    """
+    results = []
+    for name, setUp in benchmarks():
+        if names and not [n for n in names if name.startswith(n)]:
+            continue
+        operation, shared = setUp()
+        result = measure(name, operation, shared, minTime=minTime,
+            repeat=repeat)
+        if log:
+            log(result)
+        results.append(result)
+    return results
+
+
+def describe(result):
+    return '%-40s %12.0f ns/op %10.1f objects/op' % (result['name'],
+        result['ns'], result['objects'])
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare results to the results of a baseline run.
+
+    A result regressed if its ns or objects per operation grew by more
+    than the tolerance, as a fraction of the baseline.
+
+    @returns: a dict for every regression, with the name, metric, baseline
+              and result values, and change as a fraction.
+    @rtype:   C{list} of C{dict}
+    """
+    baselines = dict((result['name'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        base = baselines.get(result['name'])
+        if base is None:
+            continue
+        for metric in ('ns', 'objects'):
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            if change > tolerance:
+                regressions.append({
+                    'name': result['name'],
+                    'metric': metric,
+                    'baseline': old,
+                    'result': new,
+                    'change': change,
+                })
+    return regressions
@@ -0,0 +1,140 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_paginate -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Paging through views and _all_docs.
+"""
+
+from twisted.internet import defer
+
+
+class Paginator(object):
+    """
+    I walk a view or _all_docs page by page.
+
+    Instead of skipping over the rows already seen, which takes CouchDB
+    time proportional to the number of rows skipped, every page starts at
+    the key and document id of the row following the previous page.  I ask
+    for one row more than the page size to know that row.
+
+    While the consumer processes a page, I already fetch the next one.
+
+    Use me as an iterator of deferreds, each firing with a list of rows;
+    wait for each deferred before taking the next one:
+
+      for d in Paginator(couch, 'db', 'design', 'view'):
+          rows = yield d
+
+    @ivar done: whether the last page has been received.
+    @type done: C{bool}
+    """
+
+    def __init__(self, couch, dbName, docId=None, viewId=None, pageSize=100,
+                 prefetch=True, **options):
+        """
+        @param couch:    the client to query with.
+        @type  couch:    L{client.CouchDB}
+        @param docId:    the design document of the view; if None, walk
+                         _all_docs.
+        @param viewId:   the view.
+        @param pageSize: the number of rows in a page.
+        @type  pageSize: C{int}
+        @param prefetch: whether to fetch the next page while the consumer
+                         processes the current one.
+        @type  prefetch: C{bool}
+        @param options:  options for openView or listDoc, like endkey or
+                         include_docs.
+        """
+        if viewId is None and docId is not None:
+            raise ValueError("viewId is required for a view")
+        for option in ('limit', 'skip', 'startkey_docid', 'keys'):
+            if option in options:
+                raise ValueError("Paginator does not support %s" % option)
+
+        self._couch = couch
+        self._dbName = dbName
+        self._docId = docId
+        self._viewId = viewId
+        self.pageSize = pageSize
+        self.prefetch = prefetch
+        self._options = options
+
+        # the first row of the next page
+        self._next = None
+        self._fetching = None
+        self.done = False
+
+    def __iter__(self):
+        # with prefetch, the last page can be received before it is handed
+        # out
+        while self._fetching is not None or not self.done:
+            yield self.nextPage()
+
+    def nextPage(self):
+        """
+        Get the next page.
+
+        @returns: a deferred firing with the list of rows of the next page;
+                  it is empty after the last page.
+        @rtype:   L{defer.Deferred}
+        """
+        if self._fetching is not None:
+            d, self._fetching = self._fetching, None
+        elif self.done:
+            return defer.succeed([])
+        else:
+            d = self._fetch()
+
+        def prefetchCb(rows):
+            if self.prefetch and not self.done and self._fetching is None:
+                self._fetching = self._fetch()
+            return rows
+        return d.addCallback(prefetchCb)
+
+    def forEach(self, rowCallback):
+        """
+        Call rowCallback with every row, in order.
+
+        If rowCallback returns a deferred, the next row is only handed to it
+        once that deferred fired.
+
+        @rtype: L{defer.Deferred}
+        """
+
+        def pageCb(rows):
+            if not rows:
+                return
+            d = defer.succeed(None)
+            for row in rows:
+                d.addCallback(lambda _, row=row: rowCallback(row))
+            d.addCallback(lambda _: self.nextPage())
+            d.addCallback(pageCb)
+            return d
+        return self.nextPage().addCallback(pageCb)
+
+    def _fetch(self):
+        options = dict(self._options)
+        options['limit'] = self.pageSize + 1
+        if self._next is not None:
+            options['startkey'] = self._next['key']
+            if self._viewId is not None and 'id' in self._next:
+                options['startkey_docid'] = self._next['id']
+
+        if self._viewId is None:
+            d = self._couch.listDoc(self._dbName, **options)
+        else:
+            d = self._couch.openView(self._dbName, self._docId,
+                self._viewId, **options)
+
+        def fetchCb(result):
+            rows = result['rows']
+            if len(rows) > self.pageSize:
+                self._next = rows[self.pageSize]
+                rows = rows[:self.pageSize]
+            else:
+                self.done = True
+            return rows
+        return d.addCallback(fetchCb)
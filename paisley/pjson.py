@@ -23,6 +23,17 @@ If json is not installed, this falls back to simplejson, which is
 also not strict and will return str instead of unicode.
 
 In that case, STRICT will be set to True.
+
+Other JSON libraries can be used as a L{Backend}, per client instead of
+for the whole process.  L{available} lists the registered backends that
+are installed, L{conformance} checks that a backend decodes text as
+unicode and keeps big integers and floats intact, and L{fastest} picks
+the fastest backend that conforms.
+
+Where the C implementation returns str, the strict loads decodes str
+documents to unicode before parsing them, since the C scanner always
+returns unicode for unicode documents.  This keeps parsing at C speed,
+unlike switching to the pure-Python scanner.
 """
 
 STRICT = True
@@ -67,8 +78,38 @@ def _get_loads(strict=STRICT):
         from json import loads
         return loads
 
+    return _decoding_loads()
+
+
+def _decoding_loads(_loads=None):
+    """
+    Return a strict loads that parses with the C scanner, or with the
+    given loads.
+
+    The C scanner returns str for ASCII strings in a str document, but
+    always unicode for a unicode document, so decode str documents first.
+    """
+    if _loads is None:
+        from json import loads as _loads
+
+    def loads(s, *args, **kwargs):
+        encoding = kwargs.pop('encoding', None)
+        if isinstance(s, str):
+            s = s.decode(encoding or 'utf-8')
+        return _loads(s, *args, **kwargs)
+
+    return loads
+
+
+def _python_loads():
+    """
+    Return a strict loads that parses with the pure-Python scanner.
+
+    This is several times slower than L{_decoding_loads}, and only kept to
+    compare against.
+    """
     import json as _myjson
-    from json import scanner
+    from json import decoder, scanner
 
     class MyJSONDecoder(_myjson.JSONDecoder):
 
@@ -107,3 +148,224 @@ def _get_dumps(strict=STRICT):
 
 dumps = _get_dumps()
 loads = _get_loads()
+
+
+class Backend(object):
+    """
+    I am a JSON library to encode and decode with.
+
+    @ivar name:  the name I am registered with.
+    @type name:  C{str}
+    @ivar loads: decodes a JSON document.
+    @ivar dumps: encodes an object as a JSON document.
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return '<Backend %s>' % (self.name, )
+
+
+def _simplejson():
+    import simplejson
+    # like the C json scanner, it returns str for ASCII strings in str
+    return _decoding_loads(simplejson.loads), simplejson.dumps
+
+
+def _ujson():
+    import ujson
+    return ujson.loads, ujson.dumps
+
+
+def _cjson():
+    import cjson
+    return lambda s: cjson.decode(s, all_unicode=True), cjson.encode
+
+
+def _yajl():
+    import yajl
+    return yajl.loads, yajl.dumps
+
+# registered backends, in order of preference for equally fast ones
+_factories = [
+    ('json', lambda: (_get_loads(True), _get_dumps(True))),
+    ('simplejson', _simplejson),
+    ('ujson', _ujson),
+    ('cjson', _cjson),
+    ('yajl', _yajl),
+]
+_backends = {}
+_fastest = []
+
+
+def register(name, factory):
+    """
+    Register a backend.
+
+    @param factory: returns the loads and dumps functions of the backend,
+                    or raises ImportError if its library is not installed.
+    @type  factory: callable
+    """
+    unregister(name)
+    _factories.append((name, factory))
+
+
+def unregister(name):
+    """
+    Remove a registered backend, if there is one.
+    """
+    _factories[:] = [(n, f) for n, f in _factories if n != name]
+    _backends.pop(name, None)
+    del _fastest[:]
+
+
+def backend(name):
+    """
+    @raises KeyError:    if no backend is registered as name.
+    @raises ImportError: if the library of the backend is not installed.
+
+    @rtype: L{Backend}
+    """
+    if name not in _backends:
+        factory = dict(_factories)[name]
+        _backends[name] = Backend(name, *factory())
+    return _backends[name]
+
+
+def available():
+    """
+    @returns: the names of the registered backends that are installed.
+    @rtype:   C{list} of C{str}
+    """
+    names = []
+    for name, factory in _factories:
+        try:
+            backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+# values that must survive decoding and encoding exactly
+_FLOATS = [0.1, 1.0 / 3, 1e300, 1.7976931348623157e308, 5e-324, -2.5e-10]
+_INTS = [2 ** 53 + 1, 2 ** 64 + 1, -(2 ** 70)]
+
+
+def conformance(backend):
+    """
+    Check that a backend decodes all text as unicode, and keeps big
+    integers and floats exactly.
+
+    @type backend: L{Backend}
+
+    @returns: a description of every check the backend failed.
+    @rtype:   C{list} of C{str}
+    """
+    problems = []
+
+    def check(description, test):
+        try:
+            if not test():
+                problems.append(description)
+        except Exception, e:
+            problems.append('%s: %r' % (description, e))
+
+    def unicodeOnly(value):
+        if isinstance(value, dict):
+            return all(unicodeOnly(k) and unicodeOnly(v)
+                for k, v in value.items())
+        if isinstance(value, list):
+            return all(unicodeOnly(v) for v in value)
+        return not isinstance(value, str)
+
+    check('decodes ASCII text as unicode',
+        lambda: unicodeOnly(backend.loads('{"key": ["str", {"a": "b"}]}')))
+    check('decodes UTF-8 text',
+        lambda: backend.loads('"caf\xc3\xa9 \\u00e9"') == u'caf\xe9 \xe9')
+    check('decodes unicode documents',
+        lambda: backend.loads(u'"caf\xe9"') == u'caf\xe9')
+    check('encodes unicode text', lambda: backend.loads(
+        backend.dumps({u'caf\xe9': u'\u2603'})) == {u'caf\xe9': u'\u2603'})
+    for value in _INTS:
+        check('decodes the big integer %d' % value,
+            lambda: backend.loads(str(value)) == value)
+        check('encodes the big integer %d' % value,
+            lambda: backend.loads(backend.dumps([value])) == [value])
+    for value in _FLOATS:
+        check('decodes the float %r' % value,
+            lambda: backend.loads(repr(value)) == value)
+        check('encodes the float %r' % value,
+            lambda: backend.loads(backend.dumps([value])) == [value])
+    return problems
+
+
+def _benchmarkDocument(rows=100):
+    """
+    @returns: a view result like the ones clients decode most.
+    """
+    result = {'total_rows': rows, 'offset': 0, 'rows': []}
+    for index in range(rows):
+        doc = {'_id': 'doc-%d' % index, '_rev': '1-%032x' % index,
+            'title': u'caf\xe9 %d' % index, 'count': index * 1000,
+            'ratio': index / 7.0, 'tags': ['a', 'b', 'c'], 'done': False}
+        result['rows'].append({'id': doc['_id'], 'key': [doc['title'],
+            index], 'value': None, 'doc': doc})
+    return result
+
+
+def benchmark(backend, document=None, repeat=3, number=10):
+    """
+    Time decoding and encoding a document with a backend.
+
+    @param document: the document to decode and encode; by default, a view
+                     result of a hundred rows.
+
+    @returns: the fewest seconds a decode and an encode took.
+    @rtype:   C{float}
+    """
+    import timeit
+    if document is None:
+        document = _benchmarkDocument()
+    text = dumps(document)
+    timer = timeit.Timer(lambda: backend.dumps(backend.loads(text)))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def fastest(names=None, log=None):
+    """
+    Pick the fastest installed backend that passes L{conformance}.
+
+    The choice among all backends is made once, and remembered.
+
+    @param names: if specified, the names of the backends to choose from.
+    @param log:   if specified, called with the name of every backend, and
+                  its problems or the seconds its benchmark took.
+
+    @rtype: L{Backend}
+    """
+    if names is None and _fastest:
+        return _fastest[0]
+    timings = []
+    for position, name in enumerate(available()):
+        if names is not None and name not in names:
+            continue
+        candidate = backend(name)
+        problems = conformance(candidate)
+        if problems:
+            if log:
+                log(name, problems)
+            continue
+        seconds = benchmark(candidate)
+        if log:
+            log(name, seconds)
+        timings.append((seconds, position, candidate))
+    if not timings:
+        raise KeyError("no conforming JSON backend in %r" % (names, ))
+    result = min(timings)[2]
+    if names is None:
+        _fastest.append(result)
+    return result
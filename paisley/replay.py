@@ -0,0 +1,394 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_replay -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Recording HTTP traffic with CouchDB, and replaying it without a server.
+
+A L{Recorder} passed as the recorder of a L{paisley.client.CouchDB} writes
+every request and its response, with the time the headers and every chunk
+of the body arrived, to a file of JSON lines, gzipped if its name ends in
+.gz.  This includes the change feeds of L{paisley.changes.ChangeNotifier}.
+
+A L{ReplayAgent}, passed as the agent of a L{paisley.client.CouchDB},
+answers requests with the recorded responses, chunk by chunk, at the
+recorded speed, faster, or as fast as possible.  This benchmarks parsing,
+mapping and caching against real payloads, repeatably, without a server.
+
+  recorder = replay.Recorder('traffic.json.gz')
+  db = client.CouchDB('localhost', recorder=recorder)
+  ...
+  recorder.close()
+
+  agent = replay.ReplayAgent(replay.load('traffic.json.gz'), speed=None)
+  db = client.CouchDB('localhost', agent=agent)
+"""
+
+import gzip
+import time
+import urlparse
+
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import defer, error
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from paisley.client import json
+
+FORMAT = 1
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _path(url):
+    """
+    Return the path and query of an url, so that recordings do not depend
+    on the server they were made with.
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.query:
+        return '%s?%s' % (parts.path, parts.query)
+    return parts.path
+
+
+def _bytes(text):
+    # recorded bytes are stored as the unicode characters with the same
+    # ordinals, since chunks may split UTF-8 sequences
+    if text is None:
+        return None
+    return text.encode('latin-1')
+
+
+def _text(data):
+    if data is None:
+        return None
+    return data.decode('latin-1')
+
+
+def _isDone(reason):
+    # _newclient and http import reactor
+    from twisted.web._newclient import ResponseDone
+    from twisted.web.http import PotentialDataLoss
+    return bool(reason.check(ResponseDone, PotentialDataLoss))
+
+
+class Recorder(object):
+    """
+    I write the exchanges of recorded requests to a file, one JSON object
+    per line, as each of them finishes.
+
+    An exchange has the method, uri path and body of the request, and the
+    status, phrase and headers of the response; the number of seconds from
+    sending the request to receiving the headers as headersAt, and to the
+    end of the body as end; the chunks of the body as a list of
+    (seconds, data); and the name of the exception it failed with as
+    error, or None.
+    """
+
+    def __init__(self, path):
+        self._file = _open(path, 'wb')
+        self._file.write(json.dumps({'paisley-recording': FORMAT}) + '\n')
+        self.exchanges = 0
+
+    def wrap(self, agent):
+        """
+        @returns: an agent recording the requests made with agent.
+        """
+        return RecordingAgent(agent, self)
+
+    def add(self, exchange):
+        self._file.write(json.dumps(exchange) + '\n')
+        self.exchanges += 1
+
+    def close(self):
+        self._file.close()
+
+
+def load(path):
+    """
+    Load the exchanges written by a L{Recorder}.
+
+    @rtype: C{list} of C{dict}
+    """
+    handle = _open(path, 'rb')
+    try:
+        lines = handle.read().splitlines()
+    finally:
+        handle.close()
+    header = json.loads(lines[0])
+    if header.get('paisley-recording') != FORMAT:
+        raise ValueError("%s is not a paisley recording" % (path, ))
+    return [json.loads(line) for line in lines[1:] if line]
+
+
+class _RecordingProtocol(Protocol):
+
+    def __init__(self, protocol, exchange, recorder, start):
+        self._protocol = protocol
+        self._exchange = exchange
+        self._recorder = recorder
+        self._start = start
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self._protocol.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self._exchange['chunks'].append(
+            (time.time() - self._start, _text(data)))
+        self._protocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self._exchange['end'] = time.time() - self._start
+        if not _isDone(reason):
+            self._exchange['error'] = reason.type.__name__
+        self._recorder.add(self._exchange)
+        self._protocol.connectionLost(reason)
+
+
+class _RecordingResponse(object):
+
+    def __init__(self, response, exchange, recorder, start):
+        self._response = response
+        self._exchange = exchange
+        self._recorder = recorder
+        self._start = start
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def deliverBody(self, protocol):
+        self._response.deliverBody(_RecordingProtocol(protocol,
+            self._exchange, self._recorder, self._start))
+
+
+class RecordingAgent(object):
+    """
+    I record the requests made with an agent to a L{Recorder}.
+    """
+
+    def __init__(self, agent, recorder):
+        self._agent = agent
+        self._recorder = recorder
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        start = time.time()
+        exchange = {
+            'method': method,
+            'uri': _path(uri),
+            'body': _text(getattr(bodyProducer, 'body', None)),
+            'status': None,
+            'phrase': None,
+            'headers': [],
+            'headersAt': None,
+            'chunks': [],
+            'end': None,
+            'error': None,
+        }
+
+        def requestCb(response):
+            exchange['headersAt'] = time.time() - start
+            exchange['status'] = response.code
+            exchange['phrase'] = response.phrase
+            exchange['headers'] = [(name, values) for name, values
+                in response.headers.getAllRawHeaders()]
+            return _RecordingResponse(response, exchange, self._recorder,
+                start)
+
+        def requestEb(failure):
+            exchange['end'] = time.time() - start
+            exchange['error'] = failure.type.__name__
+            self._recorder.add(exchange)
+            return failure
+        d = self._agent.request(method, uri, headers, bodyProducer)
+        return d.addCallbacks(requestCb, requestEb)
+
+
+class ReplayMismatchError(Exception):
+    """
+    A request was made that was not recorded, or not as many times.
+    """
+
+
+class ReplayedError(Exception):
+    """
+    A recorded request failed with an exception that cannot be recreated;
+    its message is the name of the exception.
+    """
+
+
+def _failure(name):
+    # _newclient imports reactor
+    from twisted.web import _newclient
+    cls = getattr(error, name, None) or getattr(_newclient, name, None)
+    if cls is _newclient.ResponseFailed:
+        return Failure(cls([Failure(error.ConnectionLost())]))
+    if cls is _newclient.ResponseNeverReceived:
+        return Failure(cls([Failure(error.ConnectionLost())]))
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        try:
+            return Failure(cls())
+        except TypeError:
+            pass
+    return Failure(ReplayedError(name))
+
+
+class _ReplayTransport(object):
+    implements(IPushProducer)
+
+    # checked by LineReceiver
+    disconnecting = False
+
+    def __init__(self, response):
+        self._response = response
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        self.disconnecting = True
+        self._response._stop()
+
+
+class _ReplayResponse(object):
+
+    version = ('HTTP', 1, 1)
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, agent, exchange, start):
+        self._agent = agent
+        self._exchange = exchange
+        self._start = start
+        self._protocol = None
+        self._call = None
+        self._chunks = deque(exchange['chunks'])
+        self.code = exchange['status']
+        self.phrase = exchange['phrase']
+        self.headers = Headers(dict((_bytes(name),
+            [_bytes(value) for value in values])
+            for name, values in exchange['headers']))
+
+    def deliverBody(self, protocol):
+        self._protocol = protocol
+        protocol.makeConnection(_ReplayTransport(self))
+        self._next()
+
+    def _next(self):
+        if self._chunks:
+            at, data = self._chunks[0]
+            self._call = self._agent._later(self._start, at, self._deliver)
+        else:
+            self._call = self._agent._later(self._start,
+                self._exchange['end'] or 0, self._finish)
+
+    def _deliver(self):
+        at, data = self._chunks.popleft()
+        self._protocol.dataReceived(_bytes(data))
+        if self._protocol is not None:
+            self._next()
+
+    def _finish(self):
+        # _newclient imports reactor
+        from twisted.web._newclient import ResponseDone
+        protocol, self._protocol = self._protocol, None
+        if self._exchange['error']:
+            protocol.connectionLost(_failure(self._exchange['error']))
+        else:
+            protocol.connectionLost(Failure(ResponseDone()))
+
+    def _stop(self):
+        # _newclient imports reactor
+        from twisted.web._newclient import ResponseFailed
+        if self._protocol is None:
+            return
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        protocol, self._protocol = self._protocol, None
+        protocol.connectionLost(Failure(ResponseFailed(
+            [Failure(error.ConnectionDone())])))
+
+
+class ReplayAgent(object):
+    """
+    I answer requests with recorded exchanges.
+
+    A request is answered with the first exchange not replayed yet that
+    has the same method, uri path and body.
+
+    @ivar speed: the factor to speed up the recorded timings by, or None to
+                 replay as fast as possible.
+    """
+
+    def __init__(self, exchanges, speed=1.0, repeat=False, clock=None):
+        """
+        @param exchanges: the exchanges, as returned by L{load}.
+        @type  exchanges: C{list} of C{dict}
+        @param repeat:    whether to replay the exchanges for a request
+                          again once all of them were replayed, instead of
+                          failing with L{ReplayMismatchError}.
+        @type  repeat:    C{bool}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self.speed = speed
+        self.repeat = repeat
+        self._recorded = {}
+        for exchange in exchanges:
+            self._recorded.setdefault(self._key(exchange['method'],
+                exchange['uri'], exchange['body']), []).append(exchange)
+        self._queues = dict((key, deque(recorded))
+            for key, recorded in self._recorded.items())
+
+    def _key(self, method, uri, body):
+        return (method, uri, body)
+
+    def _later(self, start, at, f, *args):
+        """
+        Call f at the replayed time of a recorded offset from start.
+        """
+        delay = 0
+        if self.speed:
+            delay = max(0, start + at / self.speed - self._clock.seconds())
+        return self._clock.callLater(delay, f, *args)
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        key = self._key(method, _path(uri),
+            _text(getattr(bodyProducer, 'body', None)))
+        queue = self._queues.get(key)
+        if queue is not None and not queue and self.repeat:
+            queue.extend(self._recorded[key])
+        if not queue:
+            return defer.fail(ReplayMismatchError("%s %s was not recorded"
+                % (method, key[1])))
+        exchange = queue.popleft()
+
+        start = self._clock.seconds()
+        d = defer.Deferred(lambda _: call.cancel())
+
+        def respond():
+            if exchange['status'] is None:
+                d.errback(_failure(exchange['error']))
+            else:
+                d.callback(_ReplayResponse(self, exchange, start))
+        at = exchange['headersAt']
+        if at is None:
+            at = exchange['end'] or 0
+        call = self._later(start, at, respond)
+        return d
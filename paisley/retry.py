@@ -0,0 +1,215 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Retrying requests that failed for transient reasons.
+"""
+
+import random
+
+from collections import deque
+
+from twisted.internet import defer, error
+from twisted.web import error as tw_error
+
+from paisley import client
+
+# statuses CouchDB or a proxy in front of it answer when it is overloaded
+# or restarting
+TRANSIENT_STATUSES = (502, 503, 504)
+
+
+def _isTransient(failure):
+    # _newclient imports reactor
+    from twisted.web._newclient import ResponseFailed, ResponseNeverReceived
+    if failure.check(ResponseFailed, ResponseNeverReceived,
+            error.ConnectionLost, error.TimeoutError,
+            client.RequestTimeoutError):
+        return True
+    if failure.check(tw_error.Error) and \
+            int(failure.value.status) in TRANSIENT_STATUSES:
+        return True
+    return False
+
+
+def _notSent(failure):
+    # a request that failed to connect never reached the server
+    if failure.check(client.RequestTimeoutError):
+        return failure.value.phase == 'connect'
+    return bool(failure.check(error.ConnectError))
+
+
+class RetryPolicy(object):
+    """
+    I retry requests that failed for transient reasons: a connection that
+    could not be made or was lost, or a 502, 503 or 504 answer.
+
+    Retries wait with exponential backoff; the delays are randomized so
+    that clients failing at the same time do not retry at the same time.
+
+    A request that may have reached the server is only retried if it is
+    idempotent; a request that failed to connect is always retried.
+
+    Retries are limited by a budget: in any window of seconds, at most
+    budget times the number of requests, plus minRetries, are retried, so
+    that an unhealthy server does not get much more load from retries.
+
+    @ivar retries:   the number of retries per operation description.
+    @type retries:   C{dict} of C{str} -> C{int}
+    @ivar exhausted: the number of requests per operation description that
+                     failed because no more retries were allowed.
+    @type exhausted: C{dict} of C{str} -> C{int}
+    """
+
+    def __init__(self, maxRetries=3, initialDelay=0.1, maxDelay=10.0,
+                 multiplier=2.0, jitter=1.0, budget=0.2, minRetries=10,
+                 window=10, clock=None):
+        """
+        @param maxRetries:   the number of times a request is retried.
+        @type  maxRetries:   C{int}
+        @param initialDelay: the number of seconds before the first retry.
+        @type  initialDelay: C{float}
+        @param maxDelay:     the maximum number of seconds between retries.
+        @type  maxDelay:     C{float}
+        @param multiplier:   the factor the delay grows by with every retry.
+        @type  multiplier:   C{float}
+        @param jitter:       the fraction of each delay that is random; 1.0
+                             picks delays between 0 and the backoff.
+        @type  jitter:       C{float}
+        @param budget:       the maximum number of retries per request.
+        @type  budget:       C{float}
+        @param minRetries:   the number of retries always allowed per window.
+        @type  minRetries:   C{int}
+        @param window:       the number of seconds the budget is counted
+                             over.
+        @type  window:       C{float}
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self._random = random.random
+
+        self.maxRetries = maxRetries
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.budget = budget
+        self.minRetries = minRetries
+        self.window = window
+
+        # times of the requests and retries in the window
+        self._requestTimes = deque()
+        self._retryTimes = deque()
+
+        self.retries = {}
+        self.exhausted = {}
+
+    def delay(self, attempt):
+        """
+        @param attempt: the number of retries done so far.
+
+        @returns: the number of seconds to wait before the next retry.
+        @rtype:   C{float}
+        """
+        backoff = min(self.maxDelay,
+            self.initialDelay * self.multiplier ** attempt)
+        return backoff * (1 - self.jitter * self._random())
+
+    def shouldRetry(self, failure, idempotent):
+        """
+        @returns: whether the request failing with failure can be retried,
+                  regardless of the number of retries and the budget.
+        @rtype:   C{bool}
+        """
+        if _notSent(failure):
+            return True
+        return idempotent and _isTransient(failure)
+
+    def _expire(self, now):
+        for times in (self._requestTimes, self._retryTimes):
+            while times and times[0] <= now - self.window:
+                times.popleft()
+
+    def _allowRetry(self):
+        now = self._clock.seconds()
+        self._expire(now)
+        if len(self._retryTimes) >= \
+                self.minRetries + self.budget * len(self._requestTimes):
+            return False
+        self._retryTimes.append(now)
+        return True
+
+    def call(self, f, descr='', idempotent=True, log=None):
+        """
+        Call f, and call it again as long as it fails and may be retried.
+
+        @param f:          a callable returning a deferred.
+        @param descr:      the description of the operation, to count the
+                           retries by.
+        @type  descr:      C{str}
+        @param idempotent: whether the request can be repeated safely if it
+                           may have reached the server.
+        @type  idempotent: C{bool}
+        @param log:        if specified, the logger to log retries to.
+
+        @returns: a deferred firing with the result of the last call.
+        @rtype:   L{defer.Deferred}
+        """
+        self._requestTimes.append(self._clock.seconds())
+        state = {'attempt': 0, 'call': None, 'd': None}
+
+        def cancel(_):
+            if state['call'] is not None and state['call'].active():
+                state['call'].cancel()
+            if state['d'] is not None:
+                state['d'].cancel()
+        result = defer.Deferred(cancel)
+
+        def attempt():
+            state['call'] = None
+            state['d'] = d = defer.maybeDeferred(f)
+            d.addCallbacks(attemptCb, attemptEb)
+
+        def attemptCb(value):
+            state['d'] = None
+            if not result.called:
+                result.callback(value)
+
+        def attemptEb(failure):
+            state['d'] = None
+            if result.called:
+                return
+            if not self.shouldRetry(failure, idempotent):
+                result.errback(failure)
+                return
+            if state['attempt'] >= self.maxRetries or \
+                    not self._allowRetry():
+                self.exhausted[descr] = self.exhausted.get(descr, 0) + 1
+                result.errback(failure)
+                return
+
+            delay = self.delay(state['attempt'])
+            state['attempt'] += 1
+            self.retries[descr] = self.retries.get(descr, 0) + 1
+            if log is not None:
+                log.warn("retrying %s in %.3f seconds after %s",
+                    descr, delay, failure.getErrorMessage())
+            state['call'] = self._clock.callLater(delay, attempt)
+
+        attempt()
+        return result
+
+    def stats(self):
+        """
+        @returns: the retries and exhausted counters per operation.
+        @rtype:   C{dict}
+        """
+        return {
+            'retries': dict(self.retries),
+            'exhausted': dict(self.exhausted),
+        }
@@ -0,0 +1,135 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_slowlog -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Logging requests that were slow or returned large responses.
+"""
+
+import logging
+
+from paisley.client import short_print
+
+
+class SlowRequestLog(object):
+    """
+    I log a record for every request that took longer than the threshold
+    for its operation description, like openDoc, or whose response body was
+    larger than sizeThreshold bytes.
+
+    Pass me as the slowLog of a L{paisley.client.CouchDB}, which then times
+    the phases of every request.  Records are logged at WARNING level, with
+    their fields as attributes of the log record, and passed to the hook.
+
+    A record is a C{dict} with:
+      - reasons:      'latency', 'size' or both.
+      - method, uri:  the request, with the uri trimmed.
+      - descr, db:    the operation description and database name.
+      - status:       the HTTP status, or the name of the exception the
+                      request failed with before one was received.
+      - latency:      the number of seconds the request took.
+      - bytes:        the number of bytes of the response body.
+      - rows:         the number of rows of a view result, or None.
+      - phases:       the duration of every phase that was measured; see
+                      L{paisley.client.RequestTiming}.
+      - queueDepth:   the number of reactor calls that were due but had not
+                      run yet; a deep queue means the process, not the
+                      server, was slow.
+      - delayedCalls: the number of calls scheduled on the reactor.
+
+    @ivar thresholds: the latency threshold in seconds per operation
+                      description; None disables it for that operation.
+    @type thresholds: C{dict} of C{str} -> C{float}
+    """
+
+    def __init__(self, threshold=1.0, thresholds=None, sizeThreshold=None,
+                 hook=None, logger=None):
+        """
+        @param threshold:     the latency threshold in seconds of operations
+                              not in thresholds; None to disable it.
+        @type  threshold:     C{float}
+        @param thresholds:    the latency threshold per operation.
+        @type  thresholds:    C{dict} of C{str} -> C{float}
+        @param sizeThreshold: the size of response body in bytes above which
+                              a request is logged; None to disable it.
+        @type  sizeThreshold: C{int}
+        @param hook:          if specified, called with every record.
+        @type  hook:          callable
+        @param logger:        the logger to log to; by default paisley.slow.
+        @type  logger:        L{logging.Logger}
+        """
+        self.threshold = threshold
+        self.thresholds = dict(thresholds or {})
+        self.sizeThreshold = sizeThreshold
+        self.hook = hook
+        if logger is None:
+            logger = logging.getLogger('paisley.slow')
+        self.log = logger
+
+    def thresholdFor(self, descr):
+        """
+        @returns: the latency threshold for the operation, or None.
+        @rtype:   C{float}
+        """
+        return self.thresholds.get(descr, self.threshold)
+
+    def check(self, timing, clock=None):
+        """
+        Log the request if it was slow or its response was large.
+
+        @param timing: the timing of the finished request.
+        @type  timing: L{paisley.client.RequestTiming}
+        @param clock:  the reactor the request ran on, to measure its queue.
+
+        @returns: the record, or None if the request was not logged.
+        @rtype:   C{dict}
+        """
+        reasons = []
+        threshold = self.thresholdFor(timing.descr)
+        latency = timing.total
+        if threshold is not None and latency is not None and \
+                latency > threshold:
+            reasons.append('latency')
+        if self.sizeThreshold is not None and \
+                timing.received > self.sizeThreshold:
+            reasons.append('size')
+        if not reasons:
+            return None
+
+        record = {
+            'reasons': reasons,
+            'method': timing.method,
+            'uri': short_print(timing.uri),
+            'descr': timing.descr,
+            'db': timing.dbName,
+            'status': timing.status,
+            'latency': latency,
+            'bytes': timing.received,
+            'rows': timing.rows,
+            'phases': timing.phases(),
+        }
+        record.update(_queue(clock))
+
+        if self.hook is not None:
+            self.hook(record)
+        if self.log.isEnabledFor(logging.WARNING):
+            self.log.warning(
+                "slow request (%(reasons)s): %(method)s %(uri)s %(status)s "
+                "%(bytes)d bytes %(latency).3f seconds",
+                dict(record, reasons=','.join(reasons),
+                    latency=latency or 0.0),
+                extra=record)
+        return record
+
+
+def _queue(clock):
+    if clock is None or not hasattr(clock, 'getDelayedCalls'):
+        return {'queueDepth': None, 'delayedCalls': None}
+    now = clock.seconds()
+    calls = clock.getDelayedCalls()
+    return {
+        'queueDepth': len([c for c in calls if c.getTime() <= now]),
+        'delayedCalls': len(calls),
+    }
@@ -0,0 +1,243 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_stream -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Streaming parser for view and _all_docs results.
+
+CouchDB sends view results as an envelope object with a (possibly huge)
+rows array:
+
+  {"total_rows":3,"offset":0,"rows":[
+  {"id":"a","key":"a","value":1},
+  ...
+  ]}
+
+L{RowParser} cuts the text of each row out of the stream as soon as it is
+complete and parses only that row, so the memory used is bounded by the
+size of the largest row instead of the size of the whole result.
+"""
+
+import re
+
+from encodings import utf_8
+
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+from paisley import pjson as json
+
+# characters that change the nesting level or start a string
+_STRUCTURE_RE = re.compile(r'["{}\[\]]')
+# characters that end a string or escape the next character
+_STRING_RE = re.compile(r'["\\]')
+# the key introducing the rows array, up to and including its bracket
+_ROWS_KEY_RE = re.compile(r'"rows"\s*:\s*\[$')
+
+# where the parser is in the envelope
+_HEAD, _ROWS, _TAIL = range(3)
+
+
+class RowParser(object):
+    """
+    I parse a view result incrementally, handing out each row as soon as
+    all of its text has been fed to me.
+
+    @ivar rows: the number of rows handed out so far.
+    @type rows: C{int}
+    """
+
+    def __init__(self, rowCallback, loads=None):
+        """
+        @param rowCallback: called with each parsed row, in order.
+        @type  rowCallback: callable
+        @param loads:       if specified, decodes the rows and the envelope
+                            instead of L{paisley.pjson.loads}.
+        @type  loads:       callable
+        """
+        self._rowCallback = rowCallback
+        self._loads = loads or json.loads
+        self.rows = 0
+
+        self._state = _HEAD
+        self._depth = 0
+        self._inString = False
+        self._escape = False
+
+        # the text of the envelope, without the rows
+        self._envelope = []
+        # the text of the row being received
+        self._row = []
+
+    def feed(self, data):
+        """
+        Feed the next chunk of the result text to the parser.
+
+        @type data: C{str} or C{unicode}
+        """
+        pos = 0
+        # start of the part of data that still has to be stored
+        start = 0
+
+        if self._escape:
+            self._escape = False
+            pos = 1
+
+        while True:
+            if self._inString:
+                m = _STRING_RE.search(data, pos)
+                if not m:
+                    break
+                pos = m.end()
+                if m.group() == '\\':
+                    if pos == len(data):
+                        self._escape = True
+                        break
+                    pos += 1
+                else:
+                    self._inString = False
+                continue
+
+            m = _STRUCTURE_RE.search(data, pos)
+            if not m:
+                break
+            c = m.group()
+            pos = m.end()
+
+            if c == '"':
+                self._inString = True
+            elif c in '{[':
+                if self._state == _ROWS and self._depth == 2:
+                    # a row starts; drop the separator before it
+                    start = m.start()
+                elif self._state == _HEAD and self._depth == 1 \
+                        and c == '[':
+                    self._envelope.append(data[start:pos])
+                    start = pos
+                    if _ROWS_KEY_RE.search(''.join(self._envelope)):
+                        self._state = _ROWS
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._state == _ROWS and self._depth == 2:
+                    self._row.append(data[start:pos])
+                    start = pos
+                    self._emit()
+                elif self._state == _ROWS and self._depth == 1:
+                    # end of the rows array; the envelope continues here
+                    self._state = _TAIL
+                    start = m.start()
+
+        self._store(data[start:])
+
+    def _store(self, text):
+        if not text:
+            return
+        if self._state == _ROWS:
+            if self._depth > 2:
+                self._row.append(text)
+        else:
+            self._envelope.append(text)
+
+    def _emit(self):
+        row = self._loads(''.join(self._row))
+        self._row = []
+        self.rows += 1
+        self._rowCallback(row)
+
+    def finish(self):
+        """
+        Finish parsing.
+
+        @returns: the envelope of the result, with an empty list of rows.
+        @rtype:   C{dict}
+        """
+        return self._loads(''.join(self._envelope))
+
+
+class RowReceiver(Protocol):
+    """
+    Parses a view result from the response stream, row by row.
+
+    The deferred fires with the envelope of the result, once all rows have
+    been handed to the row callback.  If parsing or the row callback fails,
+    the rest of the response is dropped and the deferred errbacks with
+    that failure.
+
+    If a L{paisley.client.RequestTiming} is given, the time spent decoding
+    and parsing is added to it.
+    """
+
+    def __init__(self, deferred, decode_utf8, rowCallback, timing=None,
+                 loads=None):
+        self.decoder = utf_8.IncrementalDecoder() if decode_utf8 else None
+        self.deferred = deferred
+        self.parser = RowParser(rowCallback, loads)
+        self.failure = None
+        self.aborted = False
+        self.received = 0
+        self.timing = timing
+        if timing is not None:
+            timing.parse = 0.0
+
+    def abort(self):
+        """
+        Stop receiving the response, closing its connection.
+
+        The deferred is left to the caller, which cancelled it.
+        """
+        self.aborted = True
+        self.parser = None
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, bytes, final=False):
+        if self.failure or self.aborted:
+            return
+        self.received += len(bytes)
+        try:
+            if self.timing is not None:
+                self._timedFeed(bytes, final)
+            else:
+                if self.decoder:
+                    bytes = self.decoder.decode(bytes, final)
+                self.parser.feed(bytes)
+        except Exception:
+            self.failure = Failure()
+            if self.transport and not final:
+                self.transport.stopProducing()
+
+    def _timedFeed(self, bytes, final):
+        # the time in the row callback counts as parsing too
+        start = self.timing.seconds()
+        if self.decoder:
+            bytes = self.decoder.decode(bytes, final)
+        decoded = self.timing.seconds()
+        self.parser.feed(bytes)
+        self.timing.decode += decoded - start
+        self.timing.parse += self.timing.seconds() - decoded
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        if self.aborted:
+            return
+        if self.failure:
+            self.deferred.errback(self.failure)
+        elif reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            self.dataReceived('', final=True)
+            if self.failure:
+                self.deferred.errback(self.failure)
+                return
+            try:
+                result = self.parser.finish()
+            except Exception:
+                self.deferred.errback()
+            else:
+                self.deferred.callback(result)
+        else:
+            self.deferred.errback(reason)
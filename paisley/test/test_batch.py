@@ -0,0 +1,247 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_batch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for request batching.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import batch
+from paisley import pjson as json
+
+
+class StubCouch(object):
+    """
+    A stub couchdb object that records bulk requests, and answers them
+    with a deferred the test fires.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.json = json
+
+    def bulkDocs(self, dbName, docs):
+        d = defer.Deferred()
+        self.requests.append((dbName, docs, d))
+        return d
+
+    def listDoc(self, dbName, **kwargs):
+        d = defer.Deferred()
+        self.requests.append((dbName, kwargs, d))
+        return d
+
+
+class BulkWriterTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubCouch()
+        self.clock = task.Clock()
+        self.writer = batch.BulkWriter(self.couch, maxDocs=3, delay=0.5,
+            clock=self.clock)
+
+    def test_delay(self):
+        """
+        Documents saved within the delay are sent in one request, and each
+        caller gets its own result.
+        """
+        results = []
+        self.writer.saveDoc('test', {'value': 1}).addCallback(results.append)
+        self.writer.saveDoc('test', '{"value": 2}', docId='two').addCallback(
+            results.append)
+        self.assertEquals(self.couch.requests, [])
+
+        self.clock.advance(0.5)
+        self.assertEquals(len(self.couch.requests), 1)
+        dbName, docs, d = self.couch.requests[0]
+        self.assertEquals(dbName, 'test')
+        self.assertEquals(docs, [{'value': 1}, {u'value': 2, '_id': u'two'}])
+
+        d.callback([
+            {'id': 'one', 'rev': '1-a'},
+            {'ok': True, 'id': 'two', 'rev': '1-b'}])
+        self.assertEquals(results, [
+            {'ok': True, 'id': 'one', 'rev': '1-a'},
+            {'ok': True, 'id': 'two', 'rev': '1-b'}])
+
+    def test_jsonBackend(self):
+        """
+        Documents are decoded, and errors encoded, with the JSON backend of
+        the client.
+        """
+        calls = []
+
+        class Backend(object):
+
+            def loads(self, text):
+                calls.append('loads')
+                return json.loads(text)
+
+            def dumps(self, obj):
+                calls.append('dumps')
+                return json.dumps(obj)
+        self.couch.json = Backend()
+        d = self.writer.saveDoc('test', '{"_id": "a"}')
+        self.writer.flush()
+        self.couch.requests[0][2].callback([{'id': 'a', 'error': 'conflict',
+            'reason': 'Document update conflict.'}])
+        self.assertEquals(calls, ['loads', 'dumps'])
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_maxDocs(self):
+        """
+        Reaching maxDocs sends the request without waiting.
+        """
+        for i in range(3):
+            self.writer.saveDoc('test', {'value': i})
+        self.assertEquals(len(self.couch.requests), 1)
+        self.assertEquals(len(self.couch.requests[0][1]), 3)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_perDatabase(self):
+        self.writer.saveDoc('one', {'value': 1})
+        self.writer.deleteDoc('two', 'doc', '1-a')
+        self.clock.advance(0.5)
+
+        requests = sorted((r[0], r[1]) for r in self.couch.requests)
+        self.assertEquals(requests, [
+            ('one', [{'value': 1}]),
+            ('two', [{'_id': u'doc', '_rev': u'1-a', '_deleted': True}])])
+
+    def test_conflict(self):
+        """
+        A conflict on one document only errbacks the deferred for that
+        document.
+        """
+        first = self.writer.saveDoc('test', {'_id': 'a'})
+        second = self.writer.saveDoc('test', {'_id': 'b'})
+        self.writer.flush()
+
+        self.couch.requests[0][2].callback([
+            {'id': 'a', 'error': 'conflict',
+             'reason': 'Document update conflict.'},
+            {'id': 'b', 'rev': '1-b'}])
+
+        def checkConflict(error):
+            self.assertEquals(int(error.status), 409)
+        first = self.assertFailure(first, tw_error.Error)
+        first.addCallback(checkConflict)
+        second.addCallback(lambda r: self.assertEquals(r['id'], 'b'))
+        return defer.gatherResults([first, second])
+
+    def test_requestFailed(self):
+        """
+        When the request fails, all its callers get the failure.
+        """
+        first = self.writer.saveDoc('test', {'_id': 'a'})
+        second = self.writer.saveDoc('test', {'_id': 'b'})
+        self.clock.advance(0.5)
+
+        self.couch.requests[0][2].errback(tw_error.Error(400, 'bad'))
+        return defer.gatherResults([
+            self.assertFailure(first, tw_error.Error),
+            self.assertFailure(second, tw_error.Error)])
+
+    def test_flushCancelsTimer(self):
+        self.writer.saveDoc('test', {'_id': 'a'})
+        self.writer.flush('test')
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(len(self.couch.requests), 1)
+
+
+class DocLoaderTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubCouch()
+        self.clock = task.Clock()
+        self.loader = batch.DocLoader(self.couch, maxKeys=3, clock=self.clock)
+
+    def test_sameIteration(self):
+        """
+        Documents opened in the same iteration are fetched in one request,
+        and each caller gets its own document.
+        """
+        results = {}
+
+        def opened(doc):
+            results[doc['_id']] = doc
+        self.loader.openDoc('test', 'a').addCallback(opened)
+        self.loader.openDoc('test', u'b').addCallback(opened)
+        self.assertEquals(self.couch.requests, [])
+
+        self.clock.advance(0)
+        self.assertEquals(len(self.couch.requests), 1)
+        dbName, kwargs, d = self.couch.requests[0]
+        self.assertEquals(dbName, 'test')
+        self.assertEquals(kwargs['include_docs'], True)
+        self.assertEquals(sorted(kwargs['keys']), [u'a', u'b'])
+
+        d.callback({'total_rows': 2, 'offset': 0, 'rows': [
+            {'id': 'b', 'key': 'b', 'value': {'rev': '1-b'},
+             'doc': {'_id': 'b', '_rev': '1-b'}},
+            {'id': 'a', 'key': 'a', 'value': {'rev': '1-a'},
+             'doc': {'_id': 'a', '_rev': '1-a'}}]})
+        self.assertEquals(results, {
+            'a': {'_id': 'a', '_rev': '1-a'},
+            'b': {'_id': 'b', '_rev': '1-b'}})
+
+    def test_sameDocument(self):
+        """
+        The same document asked for twice is only fetched once.
+        """
+        first = self.loader.openDoc('test', 'a')
+        second = self.loader.openDoc('test', 'a')
+        self.clock.advance(0)
+        dbName, kwargs, d = self.couch.requests[0]
+        self.assertEquals(kwargs['keys'], [u'a'])
+
+        doc = {'_id': 'a', '_rev': '1-a'}
+        d.callback({'rows': [{'id': 'a', 'key': 'a', 'doc': doc,
+            'value': {'rev': '1-a'}}]})
+        first.addCallback(self.assertEquals, doc)
+        second.addCallback(self.assertEquals, doc)
+        return defer.gatherResults([first, second])
+
+    def test_maxKeys(self):
+        for docId in 'abc':
+            self.loader.openDoc('test', docId)
+        self.assertEquals(len(self.couch.requests), 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_notFound(self):
+        """
+        Missing and deleted documents fail like openDoc does.
+        """
+        missing = self.loader.openDoc('test', 'missing')
+        deleted = self.loader.openDoc('test', 'deleted')
+        self.loader.flush()
+
+        self.couch.requests[0][2].callback({'rows': [
+            {'key': 'missing', 'error': 'not_found'},
+            {'id': 'deleted', 'key': 'deleted',
+             'value': {'rev': '2-a', 'deleted': True}, 'doc': None}]})
+
+        def checkReason(error, reason):
+            self.assertEquals(int(error.status), 404)
+            self.assertEquals(json.loads(error.message),
+                {'error': 'not_found', 'reason': reason})
+        missing = self.assertFailure(missing, tw_error.Error)
+        missing.addCallback(checkReason, 'missing')
+        deleted = self.assertFailure(deleted, tw_error.Error)
+        deleted.addCallback(checkReason, 'deleted')
+        return defer.gatherResults([missing, deleted])
+
+    def test_requestFailed(self):
+        first = self.loader.openDoc('test', 'a')
+        second = self.loader.openDoc('test', 'b')
+        self.clock.advance(0)
+
+        self.couch.requests[0][2].errback(tw_error.Error(500, 'error'))
+        return defer.gatherResults([
+            self.assertFailure(first, tw_error.Error),
+            self.assertFailure(second, tw_error.Error)])
@@ -0,0 +1,139 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_bench -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the benchmark suite.
+"""
+
+import os
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import bench
+
+
+class PercentileTestCase(TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(bench.percentile(values, 50), 50)
+        self.assertEquals(bench.percentile(values, 99), 99)
+        self.assertEquals(bench.percentile(values, 100), 100)
+        self.assertEquals(bench.percentile([7], 95), 7)
+        self.assertEquals(bench.percentile([], 95), None)
+
+
+class RunTestCase(TestCase):
+
+    def test_concurrency(self):
+        state = {'inFlight': 0, 'max': 0}
+        calls = []
+
+        def operation(index):
+            calls.append(index)
+            state['inFlight'] += 1
+            state['max'] = max(state['max'], state['inFlight'])
+            d = defer.Deferred()
+
+            def done():
+                state['inFlight'] -= 1
+                d.callback(None)
+            reactor.callLater(0, done)
+            return d
+
+        d = bench.run(operation, 20, concurrency=4, name='op')
+
+        def ranCb(result):
+            self.assertEquals(sorted(calls), range(20))
+            self.assertEquals(state['max'], 4)
+            summary = result.summary()
+            self.assertEquals((summary['name'], summary['concurrency'],
+                summary['requests'], summary['errors']), ('op', 4, 20, {}))
+            self.failUnless(summary['throughput'] > 0)
+            self.failUnless(summary['min'] <= summary['p50'] <=
+                summary['p99'] <= summary['max'])
+        d.addCallback(ranCb)
+        return d
+
+    def test_errors(self):
+
+        def operation(index):
+            if index % 2:
+                raise KeyError(index)
+            return defer.succeed(None)
+
+        d = bench.run(operation, 10)
+
+        def ranCb(result):
+            self.assertEquals(len(result.latencies), 5)
+            self.assertEquals(result.summary()['errors'], {'KeyError': 5})
+            self.assertEquals(result.summary()['requests'], 10)
+        d.addCallback(ranCb)
+        return d
+
+
+class StubCouch(object):
+    """
+    A stub couchdb object with no databases.
+    """
+
+    def deleteDB(self, dbName):
+        return defer.fail(tw_error.Error(404, '{"error":"not_found"}'))
+
+    def createDB(self, dbName):
+        return defer.succeed({'ok': True})
+
+
+class ScenarioTestCase(TestCase):
+
+    def test_operation(self):
+        calls = []
+
+        def operation(index):
+            calls.append(index)
+            return defer.succeed(None)
+        d = bench.runScenario(lambda db, dbName: bench.Scenario(db, dbName,
+            operation, name='op'), StubCouch(), 'bench', 5, [1, 2])
+
+        def ranCb(results):
+            self.assertEquals([(r.name, r.concurrency) for r in results],
+                [('op', 1), ('op', 2)])
+            self.assertEquals(sorted(calls), sorted(range(5) * 2))
+        d.addCallback(ranCb)
+        return d
+
+    def test_noOperation(self):
+        self.assertRaises(ValueError, bench.Scenario, StubCouch(), 'bench')
+
+
+class CompareTestCase(TestCase):
+
+    def summary(self, name, concurrency, p50, throughput):
+        return {'name': name, 'concurrency': concurrency, 'p50': p50,
+            'p95': p50 * 2, 'p99': p50 * 3, 'throughput': throughput}
+
+    def test_compare(self):
+        baseline = [self.summary('openDoc', 1, 0.010, 100),
+            self.summary('openDoc', 10, 0.020, 500)]
+        results = [self.summary('openDoc', 1, 0.0105, 95),
+            self.summary('openDoc', 10, 0.030, 400),
+            self.summary('saveDoc', 1, 0.050, 20)]
+        regressions = bench.compare(results, baseline, tolerance=0.1)
+        self.assertEquals([(r['name'], r['concurrency'], r['metric'])
+            for r in regressions], [('openDoc', 10, 'p50'),
+            ('openDoc', 10, 'p95'), ('openDoc', 10, 'p99'),
+            ('openDoc', 10, 'throughput')])
+        self.assertAlmostEquals(regressions[0]['change'], 0.5)
+        self.assertAlmostEquals(regressions[-1]['change'], -0.2)
+
+    def test_saveLoad(self):
+        path = self.mktemp()
+        summaries = [self.summary('openDoc', 1, 0.010, 100)]
+        bench.save(summaries, path)
+        self.failUnless(os.path.exists(path))
+        self.assertEquals(bench.load(path), summaries)
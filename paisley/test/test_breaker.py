@@ -0,0 +1,170 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_breaker -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the circuit breaker.
+"""
+
+from twisted.internet import defer, error, task, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web import resource, server
+
+from paisley import breaker, client
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.changes = []
+        self.breaker = breaker.CircuitBreaker(failureThreshold=2,
+            resetTimeout=10, onStateChange=self.stateChanged,
+            clock=self.clock)
+        self.calls = 0
+
+    def stateChanged(self, key, old, new):
+        self.changes.append((key, old, new))
+
+    def call(self, result):
+        """
+        Call a function through the breaker that fails with result if it
+        is an exception, and returns it if not.
+        """
+
+        def f():
+            self.calls += 1
+            if isinstance(result, Exception):
+                return defer.fail(result)
+            return defer.succeed(result)
+        d = self.breaker.call('node', f)
+        outcome = []
+        d.addBoth(outcome.append)
+        return outcome[0]
+
+    def test_opens(self):
+        self.call(error.ConnectionRefusedError())
+        self.assertEquals(self.breaker.state('node'), breaker.CLOSED)
+        self.call(tw_error.Error(503, '{}'))
+        self.assertEquals(self.breaker.state('node'), breaker.OPEN)
+
+        failure = self.call('result')
+        self.failUnless(failure.check(breaker.CircuitOpenError))
+        self.assertEquals(failure.value.key, 'node')
+        self.assertEquals(self.calls, 2)
+        self.assertEquals(self.changes,
+            [('node', breaker.CLOSED, breaker.OPEN)])
+
+    def test_answered(self):
+        """
+        Errors answered by the server do not open the circuit.
+        """
+        self.call(tw_error.Error(503, '{}'))
+        self.call(tw_error.Error(404, '{}'))
+        self.call(tw_error.Error(503, '{}'))
+        self.assertEquals(self.breaker.state('node'), breaker.CLOSED)
+
+    def test_recovers(self):
+        self.call(error.ConnectionLost())
+        self.call(error.ConnectionLost())
+        self.clock.advance(10)
+        self.assertEquals(self.breaker.state('node'), breaker.HALF_OPEN)
+
+        self.assertEquals(self.call('result'), 'result')
+        self.assertEquals(self.breaker.state('node'), breaker.CLOSED)
+        self.assertEquals([new for key, old, new in self.changes],
+            [breaker.OPEN, breaker.HALF_OPEN, breaker.CLOSED])
+
+    def test_trialAnswered(self):
+        """
+        A trial request answered with an error closes the circuit.
+        """
+        self.call(error.ConnectionLost())
+        self.call(error.ConnectionLost())
+        self.clock.advance(10)
+        self.call(tw_error.Error(404, '{}'))
+        self.assertEquals(self.breaker.state('node'), breaker.CLOSED)
+        self.assertEquals(self.breaker._circuits['node'].trials, 0)
+
+    def test_trialFails(self):
+        self.call(error.ConnectionLost())
+        self.call(error.ConnectionLost())
+        self.clock.advance(10)
+        self.call(error.ConnectionLost())
+        self.assertEquals(self.breaker.state('node'), breaker.OPEN)
+        self.clock.advance(5)
+        self.assertEquals(self.breaker.state('node'), breaker.OPEN)
+
+    def test_oneTrial(self):
+        """
+        A half-open circuit lets one request through at a time.
+        """
+        self.call(error.ConnectionLost())
+        self.call(error.ConnectionLost())
+        self.clock.advance(10)
+        trial = defer.Deferred()
+        self.breaker.call('node', lambda: trial)
+        d = self.breaker.call('node', lambda: defer.succeed(None))
+        self.assertFailure(d, breaker.CircuitOpenError)
+        trial.callback(None)
+        self.assertEquals(self.breaker.state('node'), breaker.CLOSED)
+        return d
+
+    def test_key(self):
+        self.assertEquals(self.breaker.key('host', 5984, '/db/doc'),
+            ('host', 5984))
+        self.breaker.perDatabase = True
+        self.assertEquals(self.breaker.key('host', 5984, '/db/doc'),
+            ('host', 5984, 'db'))
+        self.assertEquals(self.breaker.key('host', 5984, '/db?x=1'),
+            ('host', 5984, 'db'))
+        self.assertEquals(self.breaker.key('host', 5984, '/_all_dbs'),
+            ('host', 5984, None))
+        self.assertEquals(self.breaker.key('host', 5984, '/my%2Fdb/doc'),
+            ('host', 5984, 'my/db'))
+
+
+class OverloadedResource(resource.Resource):
+    """
+    A resource answering 503 to every request.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        request.setResponseCode(503)
+        return '{"error": "overloaded"}'
+
+
+class ConnectedBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = OverloadedResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.breaker = breaker.CircuitBreaker(failureThreshold=2,
+            perDatabase=True)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            circuitBreaker=self.breaker)
+
+    @defer.inlineCallbacks
+    def test_failFast(self):
+        for i in range(2):
+            yield self.assertFailure(self.client.openDoc('one', 'a'),
+                tw_error.Error)
+        yield self.assertFailure(self.client.openDoc('one', 'a'),
+            breaker.CircuitOpenError)
+        self.assertEquals(self.resource.requests, 2)
+
+        # other databases have their own circuit
+        yield self.assertFailure(self.client.openDoc('two', 'a'),
+            tw_error.Error)
+        self.assertEquals(self.resource.requests, 3)
@@ -0,0 +1,340 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the caches.
+"""
+
+from twisted.internet import defer, error, task, reactor
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web import resource, server
+
+from paisley import cache, changes, client
+from paisley import pjson as json
+
+
+class StubCouch(object):
+    """
+    A stub couchdb object that answers openDoc with a deferred the test
+    fires.
+    """
+
+    def __init__(self):
+        self.opened = []
+
+    def openDoc(self, dbName, docId):
+        d = defer.Deferred()
+        self.opened.append((dbName, docId, d))
+        return d
+
+
+class DocumentCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubCouch()
+        self.clock = task.Clock()
+        self.cache = cache.DocumentCache(self.couch, 'test', maxEntries=2,
+            clock=self.clock)
+
+    def open(self, docId):
+        result = []
+        self.cache.openDoc(docId).addCallback(result.append)
+        if self.couch.opened and not self.couch.opened[-1][2].called:
+            dbName, openedId, d = self.couch.opened[-1]
+            d.callback({'_id': openedId})
+        return result[0]
+
+    def test_hit(self):
+        doc = self.open('a')
+        self.assertEquals(self.couch.opened[0][:2], ('test', u'a'))
+        self.assertIdentical(self.open('a'), doc)
+        self.assertEquals(len(self.couch.opened), 1)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_concurrentMisses(self):
+        """
+        Concurrent openDoc calls for the same document fetch it once.
+        """
+        first = self.cache.openDoc('a')
+        second = self.cache.openDoc('a')
+        self.assertEquals(len(self.couch.opened), 1)
+        self.couch.opened[0][2].callback({'_id': 'a'})
+        first.addCallback(self.assertEquals, {'_id': 'a'})
+        second.addCallback(self.assertEquals, {'_id': 'a'})
+        return defer.gatherResults([first, second])
+
+    def test_lru(self):
+        self.open('a')
+        self.open('b')
+        # use a, so b is the least recently used
+        self.open('a')
+        self.open('c')
+        self.assertEquals(self.cache.evictions, 1)
+        self.failUnless('a' in self.cache)
+        self.failIf('b' in self.cache)
+        self.failUnless('c' in self.cache)
+
+    def test_containsKeepsOrder(self):
+        """
+        Checking whether a document is cached does not count as using it.
+        """
+        self.open('a')
+        self.open('b')
+        self.failUnless('a' in self.cache)
+        self.open('c')
+        self.failIf('a' in self.cache)
+        self.failUnless('b' in self.cache)
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 3))
+
+    def test_maxBytes(self):
+        self.cache = cache.DocumentCache(self.couch, 'test', maxEntries=None,
+            maxBytes=20, sizeof=lambda doc: 8, clock=self.clock)
+        for docId in 'abc':
+            self.open(docId)
+        self.assertEquals(self.cache.stats()['bytes'], 16)
+        self.assertEquals(len(self.cache), 2)
+        self.failIf('a' in self.cache)
+
+    def test_ttl(self):
+        self.cache = cache.DocumentCache(self.couch, 'test', ttl=10,
+            clock=self.clock)
+        self.open('a')
+        self.clock.advance(5)
+        self.open('a')
+        self.assertEquals(len(self.couch.opened), 1)
+        self.clock.advance(5)
+        self.failIf('a' in self.cache)
+        self.open('a')
+        self.assertEquals(len(self.couch.opened), 2)
+
+    def test_error(self):
+        d = self.cache.openDoc('a')
+        self.couch.opened[0][2].errback(tw_error.Error(404, 'missing'))
+        self.assertEquals(len(self.cache), 0)
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_changeNotifier(self):
+        """
+        Changes received by a notifier drop the changed document.
+        """
+        notifier = changes.ChangeNotifier(None, 'test')
+        notifier.addCache(self.cache)
+        self.open('a')
+        self.open('b')
+
+        notifier.changed({'id': 'a', 'seq': 3, 'changes': []})
+        self.failIf('a' in self.cache)
+        self.failUnless('b' in self.cache)
+        self.assertEquals(self.cache.invalidations, 1)
+
+    def test_changedWhileFetching(self):
+        """
+        A document that changes while it is being fetched is not cached,
+        since the fetched version may be outdated.
+        """
+        d = self.cache.openDoc('a')
+        self.cache.delete('a')
+        self.couch.opened[0][2].callback({'_id': 'a', '_rev': '1-a'})
+        self.failIf('a' in self.cache)
+        return d
+
+
+class ETagResource(resource.Resource):
+    """
+    A resource answering every request with the same result and ETag,
+    honoring If-None-Match.
+
+    @ivar sent: the number of times the result was sent.
+    """
+    isLeaf = True
+
+    def __init__(self, result, etag):
+        resource.Resource.__init__(self)
+        self.result = result
+        self.etag = etag
+        self.sent = 0
+        self.conditions = []
+        # the number of requests to answer with 304 whatever their ETag
+        self.notModified = 0
+
+    def render_GET(self, request):
+        condition = request.getHeader('If-None-Match')
+        self.conditions.append(condition)
+        request.setHeader('ETag', self.etag)
+        if self.notModified:
+            self.notModified -= 1
+            request.setResponseCode(304)
+            return ''
+        if condition == self.etag:
+            request.setResponseCode(304)
+            return ''
+        self.sent += 1
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.result)
+
+
+class ETagCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = cache.ETagCache(maxEntries=1)
+        self.resource, self.client = self.listen()
+
+    def listen(self):
+        resource = ETagResource({'_id': 'a', '_rev': '1-a'}, '"1-a"')
+        port = reactor.listenTCP(0, server.Site(resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        return resource, client.CouchDB("127.0.0.1", port.getHost().port,
+            etagCache=self.cache)
+
+    @defer.inlineCallbacks
+    def test_openDoc(self):
+        first = yield self.client.openDoc('test', 'a')
+        second = yield self.client.openDoc('test', 'a')
+        self.assertEquals(first, {'_id': 'a', '_rev': '1-a'})
+        self.assertIdentical(second, first)
+        self.assertEquals(self.resource.conditions, [None, '"1-a"'])
+        self.assertEquals(self.resource.sent, 1)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_changed(self):
+        yield self.client.openView('test', 'design', 'view')
+        self.resource.result = {'rows': []}
+        self.resource.etag = '"changed"'
+        result = yield self.client.openView('test', 'design', 'view')
+        self.assertEquals(result, {'rows': []})
+        self.assertEquals(self.resource.sent, 2)
+
+    @defer.inlineCallbacks
+    def test_evicted(self):
+        yield self.client.openDoc('test', 'a')
+        yield self.client.openDoc('test', 'b')
+        yield self.client.openDoc('test', 'a')
+        self.assertEquals(self.resource.conditions, [None, None, None])
+        self.assertEquals(self.cache.evictions, 2)
+
+    @defer.inlineCallbacks
+    def test_servers(self):
+        """
+        Results are stored per server, so a cache can be shared by clients.
+        """
+        yield self.client.openDoc('test', 'a')
+        other, otherClient = self.listen()
+        other.result = {'_id': 'a', '_rev': '1-b'}
+        result = yield otherClient.openDoc('test', 'a')
+        self.assertEquals(result, {'_id': 'a', '_rev': '1-b'})
+        self.assertEquals(other.conditions, [None])
+
+    @defer.inlineCallbacks
+    def test_notModifiedMiss(self):
+        """
+        A 304 for a result that is not stored asks for it again.
+        """
+        self.resource.notModified = 1
+        result = yield self.client.openDoc('test', 'a')
+        self.assertEquals(result, {'_id': 'a', '_rev': '1-a'})
+        self.assertEquals(self.resource.conditions, [None, None])
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 1))
+
+
+class StubViewCouch(object):
+    """
+    A stub couchdb object with a database whose update_seq the test sets.
+    """
+
+    def __init__(self):
+        self.updateSeq = 1
+        self.infos = 0
+        self.queries = []
+
+    def infoDB(self, dbName):
+        self.infos += 1
+        return defer.succeed({'db_name': dbName,
+            'update_seq': self.updateSeq})
+
+    def openView(self, dbName, docId, viewId, **kwargs):
+        self.queries.append((dbName, docId, viewId, kwargs))
+        return defer.succeed({'rows': [{'key': len(self.queries)}]})
+
+
+class ViewCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubViewCouch()
+        self.clock = task.Clock()
+        self.cache = cache.ViewCache(self.couch, maxEntries=2,
+            clock=self.clock)
+
+    def query(self, viewId='view', **kwargs):
+        result = []
+        self.cache.openView('test', 'design', viewId, **kwargs).addCallback(
+            result.append)
+        return result[0]
+
+    def test_unchanged(self):
+        first = self.query(group=True)
+        self.assertIdentical(self.query(group=True), first)
+        self.assertEquals(len(self.couch.queries), 1)
+        self.assertEquals(self.couch.queries[0][3], {'group': True})
+        self.assertEquals(self.cache.stats(),
+            {('test', 'design', 'view'): {'hits': 1, 'misses': 1}})
+
+    def test_options(self):
+        """
+        Queries with different options are cached separately.
+        """
+        self.query(limit=1)
+        self.query(limit=2)
+        self.query(limit=1)
+        self.assertEquals(len(self.couch.queries), 2)
+
+    def test_changed(self):
+        self.query()
+        self.couch.updateSeq = 2
+        self.query()
+        self.assertEquals(len(self.couch.queries), 2)
+
+    def test_checkInterval(self):
+        self.cache.checkInterval = 10
+        self.query()
+        self.query()
+        self.assertEquals(self.couch.infos, 1)
+        self.clock.advance(10)
+        self.query()
+        self.assertEquals(self.couch.infos, 2)
+
+    def test_maxEntries(self):
+        self.query('one')
+        self.query('two')
+        self.query('three')
+        self.assertEquals(len(self.cache), 2)
+        self.query('one')
+        self.assertEquals(len(self.couch.queries), 4)
+
+    def test_changeFeed(self):
+        """
+        With a change feed, the update_seq is not asked again.
+        """
+        notifier = changes.ChangeNotifier(None, 'test')
+        notifier.addListener(self.cache.listener('test'))
+        notifier.changed({'id': 'a', 'seq': 1, 'changes': []})
+
+        self.query()
+        self.query()
+        self.assertEquals(self.couch.infos, 0)
+        self.assertEquals(len(self.couch.queries), 1)
+
+        notifier.changed({'id': 'a', 'seq': 2, 'changes': []})
+        self.query()
+        self.assertEquals(len(self.couch.queries), 2)
+
+        # without the feed, the update_seq is asked again
+        notifier.connectionLost(Failure(error.ConnectionDone()))
+        self.query()
+        self.assertEquals(self.couch.infos, 1)
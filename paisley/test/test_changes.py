@@ -12,6 +12,7 @@ from twisted.trial import unittest
 from paisley import client, changes
 
 from paisley.test import util
+from paisley.test.test_client import HangingResource
 
 
 class FakeNotifier(object):
@@ -43,6 +44,33 @@ class TestStubChangeReceiver(unittest.TestCase):
         self.assertEquals(notifier.changes[2]["deleted"], True)
 
 
+class StoppingNotifierTestCase(unittest.TestCase):
+    """
+    Test stopping a notifier against a server that does not answer.
+    """
+
+    def setUp(self):
+        from twisted.web import server
+        self.resource = HangingResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.db = client.CouchDB("127.0.0.1", port.getHost().port)
+
+    def testStopWhileStarting(self):
+        """
+        Stopping a notifier whose request is not answered yet aborts the
+        request.
+        """
+        notifier = changes.ChangeNotifier(self.db, 'test', since=0)
+        d = notifier.start()
+        reactor.callLater(0.05, notifier.stop)
+        d = self.assertFailure(d, defer.CancelledError)
+        d.addCallback(lambda _: self.resource.lost[0])
+        d.addCallback(lambda _: self.failIf(notifier.isRunning()))
+        return d
+
+
 class BaseTestCase(util.CouchDBTestCase):
     tearing = False # set to True during teardown so we can assert
     expect_tearing = False
@@ -21,7 +21,7 @@ from twisted.web import resource, server
 from twisted.web._newclient import ResponseDone
 from twisted.python.failure import Failure
 
-from paisley import client
+from paisley import client, retry
 
 from paisley.test import util
 
@@ -51,6 +51,8 @@ class TestableCouchDB(client.CouchDB):
         self.called = True
         self.uri = uri
         self.kwargs = kwargs
+        if kwargs.get('parse'):
+            return self.deferred.addCallback(self.parseResult)
         return self.deferred
 
 
@@ -70,6 +72,24 @@ class CouchDBTestCase(TestCase):
         import logging
         log = logging.getLogger('paisley')
         self.assertNotEqual(log, client.log)
+        self.failIf(client.log.isEnabledFor(logging.CRITICAL))
+
+    def test_debugDisabled(self):
+        """
+        The body is not formatted for the log unless DEBUG is enabled.
+        """
+        import logging
+
+        class Body(str):
+
+            def __repr__(self):
+                raise AssertionError("body formatted")
+        log = logging.getLogger('paisley')
+        level = log.level
+        self.addCleanup(log.setLevel, level)
+        log.setLevel(logging.INFO)
+        self.client.post("bar", Body("egg"))
+        self.assertEquals(self.client.kwargs["postdata"], "egg")
 
     def test_enable_log_and_defaults(self):
         client = TestableCouchDB('localhost')
@@ -245,6 +265,18 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs["method"], "GET")
         return self._checkParseDeferred(d)
 
+    def test_listDocKeys(self):
+        """
+        Test listDoc with keys: this should C{POST} the keys in the body.
+        """
+        d = self.client.listDoc("mydb", include_docs=True, keys=["a", "b"])
+        self.assertEquals(self.client.uri,
+            "/mydb/_all_docs?include_docs=True")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(self.client.kwargs["postdata"],
+            '{"keys": ["a", "b"]}')
+        return self._checkParseDeferred(d)
+
     def test_openDoc(self):
         """
         Test openDoc.
@@ -320,6 +352,17 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs["method"], "DELETE")
         return self._checkParseDeferred(d)
 
+    def test_bulkDocs(self):
+        """
+        Test bulkDocs: this should C{POST} the documents to _bulk_docs.
+        """
+        d = self.client.bulkDocs("mydb", [{"_id": "1"}, {"_id": "2"}])
+        self.assertEquals(self.client.uri, "/mydb/_bulk_docs")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(json.loads(self.client.kwargs["postdata"]),
+            {"docs": [{"_id": "1"}, {"_id": "2"}]})
+        return self._checkParseDeferred(d)
+
     def test_addAttachments(self):
         """
         Test addAttachments.
@@ -341,6 +384,41 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs["method"], "GET")
         return self._checkParseDeferred(d)
 
+    def test_openViewTimeouts(self):
+        """
+        The timeouts of openView are not query options of the view.
+        """
+        d = self.client.openView("mydb", "viewdoc", "myview", limit=1,
+            timeout=5, firstByteTimeout=1)
+        self.assertEquals(self.client.uri,
+            "/mydb/_design/viewdoc/_view/myview?limit=1")
+        self.assertEquals((self.client.kwargs["timeout"],
+            self.client.kwargs["firstByteTimeout"]), (5, 1))
+        return self._checkParseDeferred(d)
+
+    def test_openDocTimeouts(self):
+        d = self.client.openDoc("mydb", "mydoc", timeout=5,
+            firstByteTimeout=1)
+        self.assertEquals(self.client.uri, "/mydb/mydoc")
+        self.assertEquals((self.client.kwargs["timeout"],
+            self.client.kwargs["firstByteTimeout"]), (5, 1))
+        return self._checkParseDeferred(d)
+
+    def test_listDocTimeouts(self):
+        d = self.client.listDoc("mydb", timeout=5, firstByteTimeout=1)
+        self.assertEquals(self.client.uri, "/mydb/_all_docs")
+        self.assertEquals((self.client.kwargs["timeout"],
+            self.client.kwargs["firstByteTimeout"]), (5, 1))
+        return self._checkParseDeferred(d)
+
+    def test_saveDocTimeouts(self):
+        d = self.client.saveDoc("mydb", "", "mydoc", timeout=5,
+            firstByteTimeout=1)
+        self.assertEquals(self.client.uri, "/mydb/mydoc")
+        self.assertEquals((self.client.kwargs["timeout"],
+            self.client.kwargs["firstByteTimeout"]), (5, 1))
+        return self._checkParseDeferred(d)
+
     def test_openViewWithQuery(self):
         """
         Test openView with query arguments.
@@ -380,6 +458,16 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs['postdata'],
                           '{"keys": [1, 3, 4, "hello, world", {"1": 5}]}')
 
+    def test_openViewStartkeyDocid(self):
+        """
+        Test openView passes document ids as they are, not as JSON.
+        """
+        d = self.client.openView("mydb", "viewdoc", "myview",
+            startkey_docid=u"my doc")
+        self.assertEquals(self.client.uri,
+            "/mydb/_design/viewdoc/_view/myview?startkey_docid=my+doc")
+        return self._checkParseDeferred(d)
+
     def test_tempView(self):
         """
         Test tempView.
@@ -473,6 +561,238 @@ class ConnectedCouchDBTestCase(TestCase):
         return d
 
 
+class RequestLogTestCase(TestCase):
+    """
+    Test the sampled request log.
+    """
+
+    def setUp(self):
+        import logging
+        self.resource = FakeCouchDBResource()
+        self.resource.result = json.dumps([u"mydb"])
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+        self.records = []
+        handler = logging.Handler()
+        handler.emit = self.records.append
+        log = logging.getLogger('paisley.requests')
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+        level = log.level
+        log.setLevel(logging.INFO)
+        self.addCleanup(log.setLevel, level)
+
+    def test_sampled(self):
+        db = client.CouchDB("127.0.0.1", self.port, logSampleRate=1.0)
+        d = db.listDB()
+
+        def cb(_):
+            [record] = self.records
+            self.assertEquals((record.method, record.uri, record.status,
+                record.bytes), ('GET', '/_all_dbs', 200, 8))
+            self.failUnless(record.latency >= 0)
+            self.assertEquals(record.getMessage().split()[:4],
+                ['GET', '/_all_dbs', '200', '8'])
+        return d.addCallback(cb)
+
+    def test_notSampled(self):
+        db = client.CouchDB("127.0.0.1", self.port)
+        d = db.listDB()
+        d.addCallback(lambda _: self.assertEquals(self.records, []))
+        return d
+
+
+class CountingSite(server.Site):
+    """
+    A site that counts the connections made to it.
+    """
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class PooledCouchDBTestCase(TestCase):
+    """
+    Test C{CouchDB} keeping connections alive in a pool.
+    """
+
+    def setUp(self):
+        self.resource = FakeCouchDBResource()
+        self.resource.result = json.dumps([u"mydb"])
+        self.site = CountingSite(self.resource)
+        port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+    def test_persistent(self):
+        """
+        Sequential requests of a persistent client reuse one connection.
+        """
+        db = client.CouchDB("127.0.0.1", self.port, persistent=True)
+        self.addCleanup(db.close)
+
+        d = db.listDB()
+        d.addCallback(lambda _: db.listDB())
+
+        def cb(result):
+            self.assertEquals(result, [u"mydb"])
+            self.assertEquals(self.site.connections, 1)
+        d.addCallback(cb)
+        return d
+
+    def test_sharedPool(self):
+        """
+        Clients sharing a pool share its connections, and leave closing the
+        pool to its owner.
+        """
+        pool = client.makePool(maxPersistentPerHost=1)
+        self.addCleanup(pool.closeCachedConnections)
+        first = client.CouchDB("127.0.0.1", self.port, pool=pool)
+        second = client.CouchDB("127.0.0.1", self.port, pool=pool)
+        self.assertIdentical(first.pool, pool)
+
+        d = first.listDB()
+        d.addCallback(lambda _: second.listDB())
+        d.addCallback(lambda _: second.close())
+
+        def cb(_):
+            self.assertEquals(self.site.connections, 1)
+            self.assertEquals(len(pool._connections), 1)
+        d.addCallback(cb)
+        return d
+
+    def test_notPersistent(self):
+        """
+        By default, every request uses a new connection.
+        """
+        db = client.CouchDB("127.0.0.1", self.port)
+
+        d = db.listDB()
+        d.addCallback(lambda _: db.listDB())
+
+        def cb(_):
+            self.assertEquals(self.site.connections, 2)
+        d.addCallback(cb)
+        return d
+
+
+class HangingResource(resource.Resource):
+    """
+    A resource that never finishes its response.
+
+    @ivar headers: whether to send the response headers and part of the
+                   body before hanging.
+    @ivar lost:    deferreds firing when the client closed the connection.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.headers = False
+        self.lost = []
+
+    def render(self, request):
+        d = request.notifyFinish()
+        d.addErrback(lambda _: None)
+        self.lost.append(d)
+        if self.headers:
+            request.setHeader('Content-Length', '100')
+            request.write('{"rows": [')
+        return server.NOT_DONE_YET
+
+
+class TimeoutCouchDBTestCase(TestCase):
+    """
+    Test C{CouchDB} aborting requests that take too long or are cancelled.
+    """
+
+    def setUp(self):
+        self.resource = HangingResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            timeout=0.2)
+
+    def checkTimeout(self, d, phase):
+
+        def eb(error):
+            self.assertEquals(error.phase, phase)
+            self.failUnless(error.elapsed >= 0.05)
+            # the server sees the connection closed
+            return self.resource.lost[0]
+        d = self.assertFailure(d, client.RequestTimeoutError)
+        return d.addCallback(eb)
+
+    def test_firstByte(self):
+        d = self.client.get('/', firstByteTimeout=0.05)
+        return self.checkTimeout(d, 'response')
+
+    def test_body(self):
+        self.resource.headers = True
+        d = self.client.get('/', firstByteTimeout=0.05)
+        return self.checkTimeout(d, 'body')
+
+    def test_streamedBody(self):
+        self.resource.headers = True
+        d = self.client.openView('test', 'design', 'view',
+            rowCallback=lambda row: None)
+        return self.checkTimeout(d, 'body')
+
+    def test_cancelResponse(self):
+        """
+        Cancelling a request before its response arrived closes the
+        connection, and fails with L{defer.CancelledError}.
+        """
+        d = self.client.openDoc('test', 'a')
+        reactor.callLater(0.05, d.cancel)
+        d = self.assertFailure(d, defer.CancelledError)
+        return d.addCallback(lambda _: self.resource.lost[0])
+
+    def test_cancelBody(self):
+        """
+        Cancelling a request while its body is received closes the
+        connection.
+        """
+        self.resource.headers = True
+        self.client.timeout = None
+        d = self.client.get('/')
+        reactor.callLater(0.1, d.cancel)
+        d = self.assertFailure(d, defer.CancelledError)
+        return d.addCallback(lambda _: self.resource.lost[0])
+
+    def test_connect(self):
+        """
+        A request timing out before its connection is made times out in
+        the connect phase, so it is known not to have been sent.
+        """
+        self.client._endpoints._factory = HangingEndpointFactory()
+        d = self.assertFailure(self.client.get('/'),
+            client.RequestTimeoutError)
+
+        def eb(error):
+            self.assertEquals(error.phase, 'connect')
+            self.failUnless(retry._notSent(Failure(error)))
+        return d.addCallback(eb)
+
+
+class HangingEndpointFactory(object):
+    """
+    An endpoint factory whose endpoints never connect.
+    """
+
+    def endpointForURI(self, uri):
+        return self
+
+    def connect(self, protocolFactory):
+        return defer.Deferred()
+
+
 class RealCouchDBTestCase(util.CouchDBTestCase):
 
     def setUp(self):
@@ -1129,3 +1449,26 @@ class ResponseReceiverTestCase(TestCase):
             rvr.dataReceived(c)
 
         rvr.connectionLost(Failure(ResponseDone()))
+
+    def test_abort(self):
+        """
+        An aborted receiver drops what it received, stops the transport and
+        leaves the cancelled deferred alone.
+        """
+        d = defer.Deferred()
+        rvr = client.ResponseReceiver(d, decode_utf8=False)
+        stopped = []
+
+        class FakeTransport(object):
+
+            def stopProducing(self):
+                stopped.append(True)
+        rvr.makeConnection(FakeTransport())
+        rvr.dataReceived('{"rows": [')
+        rvr.abort()
+        rvr.dataReceived('{}')
+        rvr.connectionLost(Failure(ResponseDone()))
+
+        self.assertEquals(stopped, [True])
+        self.assertEquals(rvr.recv_chunks, [])
+        self.failIf(d.called)
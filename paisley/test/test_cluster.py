@@ -0,0 +1,275 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cluster -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the cluster client.
+"""
+
+from twisted.internet import defer, error, reactor, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web import server
+
+from paisley import cluster
+from paisley import pjson as json
+
+from paisley.test.test_client import FakeCouchDBResource
+
+
+class StubNodeClient(object):
+    """
+    A stub client for a node, recording requests and answering them with a
+    deferred the test fires.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.requests = []
+        self.cancelled = []
+
+    def _getPage(self, uri, method='GET', **kwargs):
+        d = defer.Deferred(lambda d: self.cancelled.append(uri))
+        self.requests.append((uri, method, d))
+        if kwargs.get('parse'):
+            return d.addCallback(json.loads)
+        return d
+
+    def close(self):
+        return defer.succeed(None)
+
+
+class CouchDBClusterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cluster = cluster.CouchDBCluster(
+            [('one', 5984), ('two', 5984), ('three', 5984)],
+            failureThreshold=2, clock=self.clock)
+        for node in self.cluster.nodes:
+            node.client = StubNodeClient(node.client.host, node.client.port)
+
+    def requests(self):
+        return [len(node.client.requests) for node in self.cluster.nodes]
+
+    def test_leastOutstanding(self):
+        """
+        Reads go to the nodes with the fewest requests in progress.
+        """
+        for i in range(3):
+            self.cluster.listDB()
+        self.assertEquals(self.requests(), [1, 1, 1])
+
+        # finish the request of the second node; it gets the next one
+        self.cluster.nodes[1].client.requests[0][2].callback('[]')
+        self.cluster.listDB()
+        self.assertEquals(self.requests(), [1, 2, 1])
+
+    def test_ewma(self):
+        self.cluster.balancer = cluster.EWMA
+        latencies = [0.3, 0.1, 0.2]
+        for node, latency in zip(self.cluster.nodes, latencies):
+            self.cluster._getNodePage(node, '/', 'GET')
+            self.clock.advance(latency)
+            node.client.requests[0][2].callback('{}')
+        self.cluster.listDB()
+        self.assertEquals(self.requests(), [1, 2, 1])
+
+    def test_primary(self):
+        self.cluster.primary = 2
+        self.cluster.saveDoc('test', {}, 'a')
+        self.cluster.deleteDoc('test', 'a', '1-a')
+        self.assertEquals(self.requests(), [0, 0, 2])
+        self.assertEquals(self.cluster.nodes[2].client.requests[0][1], 'PUT')
+
+    def test_ejection(self):
+        node = self.cluster.nodes[0]
+        for i in range(2):
+            self.cluster._getNodePage(node, '/', 'GET').addErrback(
+                lambda _: None)
+            node.client.requests[-1][2].errback(
+                error.ConnectionRefusedError())
+        self.failIf(node.up)
+
+        for i in range(4):
+            self.cluster.listDB()
+        self.assertEquals(self.requests()[0], 2)
+
+    def test_httpErrorsKeepNodeUp(self):
+        """
+        A node answering with an error that is not about its health stays
+        up.
+        """
+        node = self.cluster.nodes[0]
+        for i in range(3):
+            d = self.cluster._getNodePage(node, '/test/a', 'GET')
+            self.assertFailure(d, tw_error.Error)
+            node.client.requests[-1][2].errback(tw_error.Error(404, '{}'))
+        self.failUnless(node.up)
+
+    def test_healthCheck(self):
+        node = self.cluster.nodes[1]
+        node.up = False
+        node.failures = 5
+        self.cluster.startHealthChecks(interval=10)
+        self.assertEquals(self.requests(), [0, 0, 0])
+        self.clock.advance(10)
+        self.assertEquals(self.requests(), [1, 1, 1])
+        self.assertEquals(node.client.requests[0][:2], ('/', 'GET'))
+
+        node.client.requests[0][2].callback('{"couchdb": "Welcome"}')
+        self.failUnless(node.up)
+        self.assertEquals(node.failures, 0)
+        self.cluster.stopHealthChecks()
+
+    def test_allDown(self):
+        for node in self.cluster.nodes:
+            node.up = False
+        self.cluster.listDB()
+        self.assertEquals(sum(self.requests()), 1)
+
+
+class HedgeTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = cluster.HedgePolicy(percentile=50, minDelay=0.01,
+            maxDelay=1.0, minSamples=4)
+        self.cluster = cluster.CouchDBCluster(
+            [('one', 5984), ('two', 5984)], hedge=self.policy,
+            clock=self.clock)
+        for node in self.cluster.nodes:
+            node.client = StubNodeClient(node.client.host, node.client.port)
+
+    def requests(self):
+        return [node.client.requests for node in self.cluster.nodes]
+
+    def test_delay(self):
+        self.assertEquals(self.policy.delay(), 1.0)
+        for latency in (0.1, 0.2, 0.3, 0.001):
+            self.policy.record(latency)
+        self.assertEquals(self.policy.delay(), 0.2)
+        for i in range(32):
+            self.policy.record(0.001)
+        self.assertEquals(self.policy.delay(), 0.01)
+
+    def test_fullWindow(self):
+        """
+        The delay follows the latencies once the window is full.
+        """
+        policy = cluster.HedgePolicy(percentile=95, minDelay=0.005,
+            maxDelay=1.0)
+        for i in range(1000):
+            policy.record(0.01)
+            policy.delay()
+        self.assertEquals(policy.delay(), 0.01)
+        for i in range(5000):
+            policy.record(0.5)
+            policy.delay()
+        self.assertEquals(policy.delay(), 0.5)
+
+    def test_fastEnough(self):
+        """
+        A read answered before the delay is not hedged.
+        """
+        d = self.cluster.infoDB('test')
+        self.clock.advance(0.5)
+        [request] = sum(self.requests(), [])
+        request[2].callback('{"db_name": "test"}')
+        self.clock.advance(1)
+        self.assertEquals(len(sum(self.requests(), [])), 1)
+        self.assertEquals(self.policy.stats()['hedges'], 0)
+        return d
+
+    def test_hedgeWins(self):
+        """
+        A slow read is sent to the other node, and the first answer wins;
+        the slow request is cancelled.
+        """
+        d = self.cluster.openDoc('test', 'a')
+        [slow] = sum(self.requests(), [])
+        self.clock.advance(1.0)
+        [hedged] = [r for r in sum(self.requests(), []) if r is not slow]
+        self.assertEquals(hedged[0], slow[0])
+
+        hedged[2].callback('{"_id": "a"}')
+        cancelled = sum([node.client.cancelled
+            for node in self.cluster.nodes], [])
+        self.assertEquals(cancelled, [slow[0]])
+
+        self.assertEquals(self.policy.stats()['wins'], 1)
+        self.assertEquals(self.policy.stats()['hedgeRate'], 1.0)
+        d.addCallback(self.assertEquals, {'_id': 'a'})
+        return d
+
+    def test_firstFails(self):
+        """
+        A failure before the delay is not hedged.
+        """
+        d = self.cluster.listDB()
+        [request] = sum(self.requests(), [])
+        request[2].errback(tw_error.Error(500, '{}'))
+        self.clock.advance(1.0)
+        self.assertEquals(len(sum(self.requests(), [])), 1)
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_oneFails(self):
+        """
+        When one of the hedged requests fails, the other one can still
+        answer.
+        """
+        d = self.cluster.listDB()
+        self.clock.advance(1.0)
+        requests = sum(self.requests(), [])
+        requests[0][2].errback(error.ConnectionLost())
+        requests[1][2].callback('["test"]')
+        d.addCallback(self.assertEquals, [u'test'])
+        return d
+
+    def test_postReadHedged(self):
+        """
+        Reads sent as a POST, like openView with keys, are hedged.
+        """
+        d = self.cluster.openView('test', 'design', 'view', keys=['a'])
+        self.clock.advance(1.0)
+        requests = sum(self.requests(), [])
+        self.assertEquals([method for uri, method, _ in requests],
+            ['POST', 'POST'])
+        requests[1][2].callback('{"rows": []}')
+        d.addCallback(self.assertEquals, {'rows': []})
+        return d
+
+    def test_writesNotHedged(self):
+        self.cluster.saveDoc('test', {}, 'a')
+        self.cluster.saveDoc('test', {})
+        self.cluster.deleteDoc('test', 'a', '1-a')
+        self.clock.advance(1.0)
+        self.assertEquals(len(sum(self.requests(), [])), 3)
+
+
+class ConnectedClusterTestCase(TestCase):
+
+    def test_spread(self):
+        """
+        Reads are spread over real servers.
+        """
+        resources = []
+        nodes = []
+        for i in range(2):
+            resource = FakeCouchDBResource()
+            resource.result = json.dumps([u'db%d' % i])
+            resources.append(resource)
+            port = reactor.listenTCP(0, server.Site(resource),
+                interface="127.0.0.1")
+            self.addCleanup(port.stopListening)
+            nodes.append(('127.0.0.1', port.getHost().port))
+
+        db = cluster.CouchDBCluster(nodes)
+        d = defer.gatherResults([db.listDB(), db.listDB()])
+
+        def cb(results):
+            self.assertEquals(sorted(results), [[u'db0'], [u'db1']])
+        return d.addCallback(cb)
@@ -0,0 +1,205 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_fake -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the fake CouchDB server, through the client.
+"""
+
+import time
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import changes, client, fake, paginate
+
+
+class FakeCouchDBTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = fake.FakeCouchDB(seed=0)
+        self.couch.addView('design', 'by_type',
+            lambda doc: [(doc.get('type'), doc.get('size', 1))],
+            lambda keys, values: sum(values))
+        port = self.couch.listen()
+        self.addCleanup(port.stopListening)
+        self.db = client.CouchDB('127.0.0.1', port.getHost().port)
+        return self.db.createDB('test')
+
+    @defer.inlineCallbacks
+    def test_documents(self):
+        result = yield self.db.saveDoc('test', {'type': 'a'}, docId='one')
+        self.assertEquals(result['id'], 'one')
+        doc = yield self.db.openDoc('test', 'one')
+        self.assertEquals((doc['_id'], doc['_rev'], doc['type']),
+            (u'one', result['rev'], u'a'))
+
+        yield self.assertFailure(self.db.saveDoc('test', {}, docId='one'),
+            tw_error.Error)
+        doc['type'] = 'b'
+        updated = yield self.db.saveDoc('test', doc, docId='one')
+        self.failUnless(updated['rev'].startswith('2-'))
+
+        yield self.db.deleteDoc('test', 'one', updated['rev'])
+        e = yield self.assertFailure(self.db.openDoc('test', 'one'),
+            tw_error.Error)
+        self.assertEquals(int(e.status), 404)
+
+        info = yield self.db.infoDB('test')
+        self.assertEquals((info['doc_count'], info['update_seq']), (0, 3))
+        dbs = yield self.db.listDB()
+        self.assertEquals(dbs, [u'test'])
+
+    @defer.inlineCallbacks
+    def test_allDocsAndViews(self):
+        yield self.db.bulkDocs('test', [
+            {'_id': 'a', 'type': 'x', 'size': 2},
+            {'_id': 'b', 'type': 'y', 'size': 3},
+            {'_id': 'c', 'type': 'x', 'size': 5}])
+
+        result = yield self.db.listDoc('test', include_docs=True, limit=2)
+        self.assertEquals([row['id'] for row in result['rows']], ['a', 'b'])
+        self.assertEquals(result['rows'][0]['doc']['size'], 2)
+        result = yield self.db.listDoc('test', keys=['c', 'z'])
+        self.assertEquals(result['rows'][1], {'key': 'z',
+            'error': 'not_found'})
+
+        result = yield self.db.openView('test', 'design', 'by_type',
+            reduce=False, startkey='x', endkey='x')
+        self.assertEquals([row['id'] for row in result['rows']], ['a', 'c'])
+        result = yield self.db.openView('test', 'design', 'by_type',
+            group=True)
+        self.assertEquals(result['rows'], [{'key': 'x', 'value': 7},
+            {'key': 'y', 'value': 3}])
+
+        rows = []
+        yield self.db.openView('test', 'design', 'by_type', reduce=False,
+            descending=True, rowCallback=rows.append)
+        self.assertEquals([row['id'] for row in rows], ['b', 'c', 'a'])
+
+    @defer.inlineCallbacks
+    def test_docIds(self):
+        """
+        startkey_docid and endkey_docid narrow down rows with the same key.
+        """
+        yield self.db.bulkDocs('test', [{'_id': docId, 'type': 'x'}
+            for docId in 'abcd'])
+
+        result = yield self.db.openView('test', 'design', 'by_type',
+            reduce=False, startkey='x', startkey_docid='b', endkey='x',
+            endkey_docid='c')
+        self.assertEquals([row['id'] for row in result['rows']], ['b', 'c'])
+        result = yield self.db.openView('test', 'design', 'by_type',
+            reduce=False, descending=True, startkey='x', startkey_docid='c')
+        self.assertEquals([row['id'] for row in result['rows']],
+            ['c', 'b', 'a'])
+
+        rows = []
+        paginator = paginate.Paginator(self.db, 'test', 'design', 'by_type',
+            pageSize=3, reduce=False)
+        yield paginator.forEach(rows.append)
+        self.assertEquals([row['id'] for row in rows], list('abcd'))
+
+    @defer.inlineCallbacks
+    def test_keepRequests(self):
+        """
+        Only the last requests are kept.
+        """
+        couch = fake.FakeCouchDB(keepRequests=2)
+        port = couch.listen()
+        self.addCleanup(port.stopListening)
+        db = client.CouchDB('127.0.0.1', port.getHost().port)
+        for dbName in ('a', 'b', 'c'):
+            yield db.createDB(dbName)
+        self.assertEquals(list(couch.requests),
+            [('PUT', '/b/'), ('PUT', '/c/')])
+
+    @defer.inlineCallbacks
+    def test_attachments(self):
+        doc = {}
+        self.db.addAttachments(doc, {'data': 'x' * 10000})
+        yield self.db.saveDoc('test', doc, docId='one')
+        data = yield self.db.openDoc('test', 'one', attachment='data')
+        self.assertEquals(data, 'x' * 10000)
+        doc = yield self.db.openDoc('test', 'one')
+        self.assertEquals(doc['_attachments']['data']['length'], 10000)
+        self.failUnless(doc['_attachments']['data']['stub'])
+
+    def test_changes(self):
+        received = []
+        notified = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                received.append(change)
+                if change['id'] == 'two':
+                    notified.callback(None)
+
+        notifier = changes.ChangeNotifier(self.db, 'test')
+        notifier.addListener(Listener())
+        d = self.db.saveDoc('test', {}, docId='one')
+        d.addCallback(lambda _: notifier.start())
+        d.addCallback(lambda _: self.db.saveDoc('test', {}, docId='two'))
+        d.addCallback(lambda _: notified)
+
+        def notifiedCb(_):
+            # the feed started after the first change
+            self.assertEquals([c['id'] for c in received], ['two'])
+            self.assertEquals(received[0]['seq'], 2)
+            notifier.stop()
+        d.addCallback(notifiedCb)
+        return d
+
+    @defer.inlineCallbacks
+    def test_latency(self):
+        self.couch.faults.latency = 0.1
+        start = time.time()
+        yield self.db.listDB()
+        self.failUnless(time.time() - start >= 0.1)
+
+    @defer.inlineCallbacks
+    def test_bandwidth(self):
+        self.couch.faults.bandwidth = 100000
+        self.couch.faults.chunkSize = 1000
+        yield self.db.bulkDocs('test', [{'text': 'x' * 10000}])
+        start = time.time()
+        result = yield self.db.listDoc('test', include_docs=True)
+        self.failUnless(time.time() - start >= 0.09)
+        self.assertEquals(len(result['rows'][0]['doc']['text']), 10000)
+
+    @defer.inlineCallbacks
+    def test_faults(self):
+        self.couch.faults.failNext(503)
+        e = yield self.assertFailure(self.db.listDB(), tw_error.Error)
+        self.assertEquals(int(e.status), 503)
+
+        self.couch.faults.dropNext()
+        yield self.assertFailure(self.db.listDB(), Exception)
+
+        yield self.db.bulkDocs('test', [{'text': 'x' * 1000}])
+        self.couch.faults.truncateNext()
+        yield self.assertFailure(self.db.listDoc('test', include_docs=True),
+            Exception)
+
+        dbs = yield self.db.listDB()
+        self.assertEquals(dbs, [u'test'])
+
+    def test_dropFeeds(self):
+        lost = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def connectionLost(self, reason):
+                lost.callback(reason.value)
+
+        notifier = changes.ChangeNotifier(self.db, 'test')
+        notifier.addListener(Listener())
+        d = notifier.start()
+        d.addCallback(lambda _: self.couch.dropFeeds())
+        d.addCallback(lambda _: lost)
+        d.addCallback(lambda reason: self.failIf(notifier.isRunning()))
+        return d
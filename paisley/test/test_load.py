@@ -0,0 +1,121 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_load -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the open-loop load generator.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from paisley import load
+
+
+class LatencyHistogramTestCase(TestCase):
+
+    def test_precision(self):
+        histogram = load.LatencyHistogram()
+        for micros in range(1, 10001):
+            histogram.record(micros / 1000000.0)
+        self.assertEquals(histogram.count, 10000)
+        for p in (50, 90, 99, 99.9):
+            exact = p * 100 / 1000000.0
+            self.failUnless(abs(histogram.percentile(p) - exact) <=
+                exact * 0.01, (p, histogram.percentile(p)))
+        self.assertEquals(histogram.percentile(100), 0.01)
+        # memory grows with the logarithm of the range
+        self.failUnless(len(histogram.counts) < 1000)
+
+    def test_empty(self):
+        histogram = load.LatencyHistogram()
+        self.assertEquals(histogram.percentile(99), None)
+        self.assertEquals(histogram.snapshot()['mean'], None)
+
+
+class LoadGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+
+    def operation(self, serviceTime):
+
+        def call():
+            self.calls.append(self.clock.seconds())
+            d = defer.Deferred()
+            self.clock.callLater(serviceTime, d.callback, None)
+            return d
+        return call
+
+    def generate(self, generator, seconds):
+        d = generator.start()
+        results = []
+        d.addCallback(results.append)
+        self.clock.pump([0.01] * int(seconds * 100))
+        return results[0]
+
+    def test_openLoop(self):
+        """
+        Requests are sent at the rate, even when earlier ones did not
+        finish yet.
+        """
+        generator = load.LoadGenerator([('op', 1, self.operation(0.45))],
+            rate=10, duration=1, clock=self.clock)
+        result = self.generate(generator, 2)
+        self.assertEquals(len(self.calls), 10)
+        self.assertAlmostEquals(self.calls[-1], 0.9)
+        self.assertEquals(result.completed, 10)
+        self.assertEquals(result.maxInFlight, 5)
+        self.failUnless(0.44 < result.latency.percentile(99) < 0.47)
+        self.assertEquals(result.operations.keys(), ['op'])
+        self.failUnless(1.34 < result.elapsed < 1.36)
+
+    def test_coordinatedOmission(self):
+        """
+        A request that waits for a slot counts its wait as latency.
+        """
+        generator = load.LoadGenerator([('op', 1, self.operation(0.45))],
+            rate=10, duration=1, maxInFlight=1, clock=self.clock)
+        result = self.generate(generator, 6)
+        self.assertEquals(result.completed, 10)
+        self.assertEquals(result.maxInFlight, 1)
+        # the last request was due at 0.9 and finished at 4.5
+        self.failUnless(3.5 < result.latency.max < 3.7)
+        self.failUnless(result.service.max < 0.46)
+        self.failIf(load.sustained(result))
+
+    def test_mix(self):
+        generator = load.LoadGenerator([
+            ('a', 1, lambda: defer.succeed(None)),
+            ('b', 0, lambda: defer.fail(KeyError()))],
+            rate=100, duration=1, seed=1, clock=self.clock)
+        result = self.generate(generator, 1)
+        self.assertEquals(result.completed, 100)
+        self.assertEquals(result.errors, {})
+        self.assertEquals(result.operations['a'].count, 100)
+
+    def test_errors(self):
+        generator = load.LoadGenerator([
+            ('a', 1, lambda: defer.fail(KeyError()))],
+            rate=10, duration=1, clock=self.clock)
+        result = self.generate(generator, 1)
+        self.assertEquals(result.errors, {('a', 'KeyError'): 10})
+        self.assertEquals(result.summary()['errors'], {'a KeyError': 10})
+        self.failIf(load.sustained(result))
+
+    def test_sweep(self):
+        """
+        A sweep stops at the first rate that is not sustained.
+        """
+        # a server that handles one request at a time, in 0.05 seconds
+        d = load.sweep([('op', 1, self.operation(0.05))], [5, 10, 40, 80],
+            duration=1, maxInFlight=1, clock=self.clock)
+        results = []
+        d.addCallback(results.extend)
+        self.clock.pump([0.01] * 1000)
+        self.assertEquals([r.rate for r in results], [5, 10, 40])
+        self.assertEquals(load.saturation(results), 10)
+        self.assertEquals(load.saturation(results, maxLatency=0.01), None)
@@ -0,0 +1,241 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_metrics -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the request metrics.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web import resource, server
+
+from paisley import client, metrics
+from paisley import pjson as json
+
+
+class HistogramTestCase(TestCase):
+
+    def test_percentiles(self):
+        histogram = metrics.Histogram(smallest=1, factor=2, buckets=4)
+        self.assertEquals(histogram.percentile(50), None)
+        for value in range(1, 11):
+            histogram.add(value)
+        self.assertEquals(histogram.counts, [1, 1, 2, 4, 2])
+        self.assertEquals(histogram.count, 10)
+        self.assertEquals(histogram.sum, 55)
+        # the fifth value is in the bucket from 4 to 8
+        self.assertEquals(histogram.percentile(50), 5.0)
+        # values above the largest bound are estimated up to the maximum
+        self.assertEquals(histogram.percentile(100), 10)
+        self.failUnless(8 < histogram.percentile(95) < 10)
+
+    def test_snapshot(self):
+        histogram = metrics.Histogram()
+        histogram.add(0.01)
+        snapshot = histogram.snapshot()
+        self.assertEquals(sorted(snapshot.keys()),
+            ['count', 'max', 'p50', 'p95', 'p99', 'sum'])
+        self.failUnless(snapshot['p99'] <= 0.01)
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def request(self, descr, dbName, status, latency=0.01, sent=0,
+                received=10):
+        self.metrics.started(descr, dbName)
+        self.metrics.finished(descr, dbName, status, latency, sent,
+            received)
+
+    def test_snapshot(self):
+        self.request('openDoc', 'test', 200)
+        self.request('openDoc', 'test', 404)
+        self.request('saveDoc', 'test', 'ConnectionLost', sent=5,
+            received=0)
+        self.metrics.started('openDoc', 'test')
+
+        snapshot = self.metrics.snapshot()
+        openDoc = snapshot[('openDoc', 'test')]
+        self.assertEquals(openDoc['requests'], 2)
+        self.assertEquals(openDoc['errors'], {404: 1})
+        self.assertEquals(openDoc['bytesReceived'], 20)
+        self.assertEquals(openDoc['inFlight'], 1)
+        self.assertEquals(openDoc['latency']['count'], 2)
+
+        saveDoc = snapshot[('saveDoc', 'test')]
+        self.assertEquals(saveDoc['errors'], {'ConnectionLost': 1})
+        self.assertEquals(saveDoc['bytesSent'], 5)
+
+    def test_prometheus(self):
+        self.request('openDoc', 'test', 404)
+        self.request('listDB', None, 200)
+        text = self.metrics.prometheusText()
+        lines = text.splitlines()
+
+        self.failUnless('# TYPE paisley_requests_total counter' in lines)
+        self.failUnless(
+            'paisley_requests_total{descr="openDoc",db="test"} 1' in lines)
+        self.failUnless(
+            'paisley_requests_total{descr="listDB",db=""} 1' in lines)
+        self.failUnless('paisley_errors_total'
+            '{descr="openDoc",db="test",status="404"} 1' in lines)
+        self.failUnless('paisley_request_seconds_bucket'
+            '{descr="openDoc",db="test",le="+Inf"} 1' in lines)
+        self.failUnless(
+            'paisley_request_seconds_count{descr="openDoc",db="test"} 1'
+            in lines)
+
+    def test_phases(self):
+        self.metrics.timed('openView', 'test', {'firstByte': 0.2,
+            'parse': 0.01})
+        phases = self.metrics.snapshot()[('openView', 'test')]['phases']
+        self.assertEquals(sorted(phases.keys()), ['firstByte', 'parse'])
+        self.assertEquals(phases['parse']['count'], 1)
+        self.failUnless('paisley_phase_seconds_count'
+            '{descr="openView",db="test",phase="parse"} 1'
+            in self.metrics.prometheusText().splitlines())
+
+    def test_statsd(self):
+        lines = []
+        self.metrics.addSink(metrics.StatsdSink(lines.append))
+        self.request('openDoc', 'my/db', 404, latency=0.0125)
+        self.assertEquals(lines, [
+            'paisley.openDoc.my_db.requests:1|c',
+            'paisley.openDoc.my_db.latency:12.500|ms',
+            'paisley.openDoc.my_db.sent:0|c',
+            'paisley.openDoc.my_db.received:10|c',
+            'paisley.openDoc.my_db.errors.404:1|c',
+        ])
+
+
+class StatusResource(resource.Resource):
+    """
+    A resource answering every request with the status set by the test.
+    """
+    isLeaf = True
+    code = 200
+
+    def render(self, request):
+        request.setResponseCode(self.code)
+        request.setHeader('Content-Type', 'application/json')
+        if request.path.endswith('_view/view'):
+            return json.dumps({'rows': [{'key': 1}, {'key': 2}]})
+        return json.dumps({'_id': 'a'})
+
+
+class ConnectedMetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = StatusResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.metrics = metrics.Metrics()
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            metrics=self.metrics)
+
+    def test_operations(self):
+        d = self.client.openDoc('my/db', 'a')
+
+        def openedCb(_):
+            self.resource.code = 409
+            return self.assertFailure(
+                self.client.saveDoc('test', {}, 'a'), tw_error.Error)
+        d.addCallback(openedCb)
+
+        def savedCb(_):
+            snapshot = self.metrics.snapshot()
+            self.assertEquals(sorted(snapshot.keys()),
+                [('openDoc', 'my/db'), ('saveDoc', 'test')])
+            openDoc = snapshot[('openDoc', 'my/db')]
+            self.assertEquals(openDoc['requests'], 1)
+            self.assertEquals(openDoc['errors'], {})
+            self.assertEquals(openDoc['bytesReceived'],
+                len(json.dumps({'_id': 'a'})))
+            self.assertEquals(openDoc['inFlight'], 0)
+            saveDoc = snapshot[('saveDoc', 'test')]
+            self.assertEquals(saveDoc['errors'], {409: 1})
+            self.assertEquals(saveDoc['bytesSent'], 2)
+        d.addCallback(savedCb)
+        return d
+
+
+class PhaseTimingTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = StatusResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.metrics = metrics.Metrics()
+        self.timings = []
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            metrics=self.metrics, timingHook=self.timings.append)
+
+    def test_parsed(self):
+        d = self.client.openDoc('test', 'a')
+
+        def openedCb(doc):
+            self.assertEquals(doc, {'_id': 'a'})
+            [timing] = self.timings
+            self.assertEquals((timing.method, timing.descr, timing.dbName,
+                timing.status), ('GET', 'openDoc', 'test', 200))
+            self.failIf(timing.reused)
+            phases = timing.phases()
+            self.assertEquals(sorted(phases.keys()), sorted(client.PHASES))
+            for duration in phases.values():
+                self.failUnless(duration >= 0)
+            self.failUnless(timing.total >= timing.firstByte)
+
+            snapshot = self.metrics.snapshot()[('openDoc', 'test')]
+            self.assertEquals(snapshot['phases']['parse']['count'], 1)
+        d.addCallback(openedCb)
+        return d
+
+    def test_streamed(self):
+        rows = []
+        d = self.client.openView('test', 'design', 'view',
+            rowCallback=rows.append)
+
+        def viewedCb(_):
+            self.assertEquals(len(rows), 2)
+            [timing] = self.timings
+            self.assertEquals(timing.descr, 'openView')
+            self.failIf(timing.parse is None)
+        d.addCallback(viewedCb)
+        return d
+
+    def test_notParsed(self):
+        """
+        The timing of a result that is not parsed has no parse phase.
+        """
+        d = self.client.openDoc('test', 'a', attachment='file')
+
+        def reportedCb(_):
+            [timing] = self.timings
+            self.assertEquals(timing.parse, None)
+            self.failIf('parse' in timing.phases())
+        d.addCallback(reportedCb)
+        return d
+
+    def test_concurrent(self):
+        """
+        Concurrent requests each report their own timing.
+        """
+        parsed = self.client.openDoc('test', 'a')
+        notParsed = self.client.openDoc('test', 'a', attachment='file')
+        d = defer.gatherResults([parsed, notParsed])
+
+        def reportedCb(_):
+            timings = dict((timing.uri, timing) for timing in self.timings)
+            self.assertEquals(len(timings), 2)
+            self.failIf(timings['/test/a'].parse is None)
+            self.assertEquals(timings['/test/a/file'].parse, None)
+        d.addCallback(reportedCb)
+        return d
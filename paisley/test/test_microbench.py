@@ -0,0 +1,76 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_microbench -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the microbenchmarks.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from paisley import microbench
+from paisley.client import json
+
+
+class MicrobenchTestCase(TestCase):
+
+    def test_shapes(self):
+        for name, factory in microbench.SHAPES:
+            doc = factory()
+            self.assertEquals(json.loads(json.dumps(doc)), doc)
+        self.assertEquals(len(microbench.wide(fields=10)), 12)
+        self.assertEquals(len(microbench.array(items=10)['objects']), 10)
+
+    def test_benchmarks(self):
+        """
+        Every benchmark sets up an operation that runs.
+        """
+        names = []
+        for name, setUp in microbench.benchmarks():
+            operation, shared = setUp()
+            operation()
+            names.append(name)
+        self.assertEquals(len(names), len(set(names)))
+        operation, doc = dict(microbench.benchmarks())['fromDict/small']()
+        self.assertEquals(operation().subject, u'I like Plankton')
+        # the instance, its __dict__ and its key, and the copy of the
+        # document
+        self.assertEquals(microbench.objects(operation, doc), 4)
+
+    def test_objects(self):
+        self.assertEquals(microbench.objects(lambda: [{}]), 2)
+        self.assertEquals(microbench.objects(lambda: None), 0)
+        self.assertEquals(microbench.objects(
+            lambda: {'a': [1.5, 1.5], 'b': (True, u'x')}), 7)
+        obj = microbench.Post()
+        obj.fromDict({'tags': [u'a', u'b']})
+        # the instance, its __dict__, _data, the two keys, the list and
+        # its items
+        self.assertEquals(microbench.objects(lambda: obj), 8)
+
+    def test_measure(self):
+        result = microbench.measure('list', lambda: [], minTime=0.001,
+            repeat=2)
+        self.assertEquals((result['name'], result['objects']), ('list', 1))
+        self.failUnless(result['number'] >= 1)
+        self.failUnless(result['ns'] > 0)
+
+    def test_runAll(self):
+        logged = []
+        results = microbench.runAll(['get/'], minTime=0.001, repeat=1,
+            log=logged.append)
+        self.assertEquals([r['name'] for r in results], ['get/TextField',
+            'get/DateTimeField', 'get/DecimalField'])
+        self.assertEquals(logged, results)
+
+    def test_compare(self):
+        baseline = [{'name': 'a', 'ns': 100.0, 'objects': 2.0},
+            {'name': 'b', 'ns': 100.0, 'objects': 0.0}]
+        results = [{'name': 'a', 'ns': 105.0, 'objects': 3.0},
+            {'name': 'b', 'ns': 200.0, 'objects': 5.0},
+            {'name': 'c', 'ns': 1000.0, 'objects': 1.0}]
+        regressions = microbench.compare(results, baseline)
+        self.assertEquals([(r['name'], r['metric']) for r in regressions],
+            [('a', 'objects'), ('b', 'ns')])
@@ -0,0 +1,146 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_paginate -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for paging through views.
+"""
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from paisley import paginate
+
+# a view with duplicate keys, sorted by key and id like CouchDB does
+ROWS = [{'id': 'doc%02d' % i, 'key': i // 3, 'value': None}
+    for i in range(10)]
+
+
+class StubCouch(object):
+    """
+    A stub couchdb object that serves ROWS as a view and as _all_docs,
+    honoring startkey, startkey_docid and limit.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.pending = None
+
+    def _query(self, rows, options):
+        self.queries.append(options)
+        if 'startkey' in options:
+            start = (options['startkey'], options.get('startkey_docid', ''))
+            rows = [r for r in rows if (r['key'], r['id']) >= start]
+        self.pending = defer.Deferred()
+        self.pending.callback({'total_rows': len(ROWS), 'offset': 0,
+            'rows': rows[:options['limit']]})
+        return self.pending
+
+    def openView(self, dbName, docId, viewId, **options):
+        return self._query(ROWS, options)
+
+    def listDoc(self, dbName, **options):
+        rows = [{'id': r['id'], 'key': r['id'], 'value': {}} for r in ROWS]
+        return self._query(rows, options)
+
+
+class PaginatorTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubCouch()
+
+    @defer.inlineCallbacks
+    def test_view(self):
+        paginator = paginate.Paginator(self.couch, 'test', 'design', 'view',
+            pageSize=4, prefetch=False)
+        pages = []
+        for d in paginator:
+            rows = yield d
+            pages.append([row['id'] for row in rows])
+
+        self.assertEquals(pages, [
+            ['doc00', 'doc01', 'doc02', 'doc03'],
+            ['doc04', 'doc05', 'doc06', 'doc07'],
+            ['doc08', 'doc09']])
+        # the second page starts in the middle of the rows with key 1
+        self.assertEquals(self.couch.queries[1],
+            {'limit': 5, 'startkey': 1, 'startkey_docid': 'doc04'})
+        self.failIf('skip' in self.couch.queries[2])
+
+    @defer.inlineCallbacks
+    def test_iteratePrefetch(self):
+        """
+        Iterating hands out the last page even when it was prefetched.
+        """
+        paginator = paginate.Paginator(self.couch, 'test', 'design', 'view',
+            pageSize=4)
+        ids = []
+        for d in paginator:
+            rows = yield d
+            ids.extend([row['id'] for row in rows])
+
+        self.assertEquals(ids, [row['id'] for row in ROWS])
+        self.assertEquals(len(self.couch.queries), 3)
+
+    @defer.inlineCallbacks
+    def test_allDocs(self):
+        paginator = paginate.Paginator(self.couch, 'test', pageSize=5,
+            include_docs=True)
+        rows = []
+        yield paginator.forEach(rows.append)
+
+        self.assertEquals([row['id'] for row in rows],
+            [row['id'] for row in ROWS])
+        self.assertEquals(self.couch.queries[1],
+            {'limit': 6, 'startkey': 'doc05', 'include_docs': True})
+
+    def test_prefetch(self):
+        """
+        The next page is fetched as soon as a page is handed out.
+        """
+        paginator = paginate.Paginator(self.couch, 'test', 'design', 'view',
+            pageSize=4)
+        paginator.nextPage()
+        self.assertEquals(len(self.couch.queries), 2)
+
+        paginator.nextPage()
+        paginator.nextPage()
+        self.assertEquals(len(self.couch.queries), 3)
+        self.failUnless(paginator.done)
+
+        d = paginator.nextPage()
+        d.addCallback(self.assertEquals, [])
+        return d
+
+    def test_exactPages(self):
+        paginator = paginate.Paginator(self.couch, 'test', 'design', 'view',
+            pageSize=10, prefetch=False)
+        d = paginator.nextPage()
+        d.addCallback(lambda rows: self.assertEquals(len(rows), 10))
+        d.addCallback(lambda _: self.failUnless(paginator.done))
+        return d
+
+    def test_forEachWaits(self):
+        """
+        forEach waits for deferreds returned by the row callback.
+        """
+        paginator = paginate.Paginator(self.couch, 'test', 'design', 'view',
+            pageSize=4)
+        waiting = []
+
+        def rowCallback(row):
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+        done = paginator.forEach(rowCallback)
+        self.assertEquals(len(waiting), 1)
+        while waiting:
+            waiting.pop().callback(None)
+        self.failUnless(done.called)
+        return done
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, paginate.Paginator, self.couch, 'test',
+            'design', 'view', skip=10)
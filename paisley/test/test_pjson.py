@@ -30,3 +30,128 @@ class JSONTestCase(unittest.TestCase):
         u = json.loads(u'"str"')
         self.assertEquals(u, u'str')
         self.assertEquals(type(u), unicode)
+
+
+class DecodingLoadsTestCase(unittest.TestCase):
+    """
+    The strict loads used when the C scanner returns str.
+    """
+
+    def setUp(self):
+        self.loads = json._decoding_loads()
+
+    def testStrToUnicode(self):
+        result = self.loads('{"key": ["str", "caf\xc3\xa9", 1, 1.5]}')
+        self.assertEquals(result, {u'key': [u'str', u'caf\xe9', 1, 1.5]})
+        key, = result.keys()
+        self.assertEquals(type(key), unicode)
+        self.assertEquals([type(v) for v in result[key][:2]],
+            [unicode, unicode])
+
+    def testEncoding(self):
+        self.assertEquals(self.loads('"caf\xe9"', encoding='latin-1'),
+            u'caf\xe9')
+
+    def testSameAsPythonScanner(self):
+        s = json.dumps({'rows': [{'id': 'a', 'key': [u'caf\xe9', 1],
+            'value': {'nested': [True, None, 1e10]}}]})
+        self.assertEquals(self.loads(s), json._python_loads()(s))
+
+
+class BackendTestCase(unittest.TestCase):
+
+    def register(self, name, loads, dumps=None):
+        json.register(name, lambda: (loads, dumps or json.dumps))
+        self.addCleanup(json.unregister, name)
+
+    def testJSON(self):
+        self.failUnless('json' in json.available())
+        backend = json.backend('json')
+        self.assertEquals(backend.name, 'json')
+        self.assertEquals(json.conformance(backend), [])
+        self.failUnless(json.benchmark(backend, {'a': 1}, 1, 1) > 0)
+
+    def testUnknown(self):
+        self.assertRaises(KeyError, json.backend, 'unknown')
+
+    def testNotInstalled(self):
+
+        def factory():
+            import paisley_no_such_json_library
+        json.register('missing', factory)
+        self.addCleanup(json.unregister, 'missing')
+        self.failIf('missing' in json.available())
+        self.assertRaises(ImportError, json.backend, 'missing')
+
+    def testConformance(self):
+
+        def lossy(s):
+            return json.loads(s, parse_float=lambda f: round(float(f), 6),
+                parse_int=float)
+        self.register('lossy', lossy)
+        problems = json.conformance(json.backend('lossy'))
+        self.failUnless('decodes the float 0.1' not in problems)
+        self.failUnless('decodes the float 5e-324' in problems)
+        self.failUnless('decodes the big integer 18446744073709551617'
+            in problems)
+
+        self.register('bytes', lambda s: json.loads(s).encode('utf-8'))
+        problems = json.conformance(json.backend('bytes'))
+        self.failUnless(problems[0].startswith(
+            'decodes ASCII text as unicode'))
+
+    def testFastest(self):
+        self.register('broken', lambda s: None)
+        self.register('copy', json.loads)
+        logged = []
+        backend = json.fastest(['broken', 'copy'],
+            log=lambda *args: logged.append(args))
+        self.assertEquals(backend.name, 'copy')
+        self.assertEquals([name for name, result in logged],
+            ['broken', 'copy'])
+        self.assertRaises(KeyError, json.fastest, ['broken'])
+        self.failUnless(json.fastest().name in json.available())
+
+
+class ClientBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # fake imports client, which imports pjson
+        from paisley import fake
+        self.couch = fake.FakeCouchDB()
+        self.couch.addView('design', 'all', lambda doc: [(doc['_id'], 1)])
+        port = self.couch.listen()
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+        self.decoded = []
+
+        def loads(s):
+            self.decoded.append(s)
+            return json.loads(s)
+        json.register('recording', lambda: (loads, json.dumps))
+        self.addCleanup(json.unregister, 'recording')
+
+    def testBackend(self):
+        from paisley import client
+        db = client.CouchDB('127.0.0.1', self.port)
+        self.assertIdentical(db.json, json)
+        db = client.CouchDB('127.0.0.1', self.port, jsonBackend='fastest')
+        self.assertIdentical(db.json, json.fastest())
+
+        db = client.CouchDB('127.0.0.1', self.port, jsonBackend='recording')
+        d = db.createDB('test')
+        d.addCallback(lambda _: db.saveDoc('test', {'a': 1}, docId='one'))
+        d.addCallback(lambda _: db.openDoc('test', 'one'))
+
+        def openedCb(doc):
+            self.assertEquals(doc['a'], 1)
+            self.failUnless(self.decoded)
+            del self.decoded[:]
+            rows = []
+            d = db.openView('test', 'design', 'all', rowCallback=rows.append)
+            d.addCallback(lambda _: self.assertEquals(len(rows), 1))
+            return d
+        d.addCallback(openedCb)
+        # a row, and the envelope
+        d.addCallback(lambda _: self.assertEquals(len(self.decoded), 2))
+        return d
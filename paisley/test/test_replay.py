@@ -0,0 +1,166 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_replay -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for recording and replaying requests.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import changes, client, fake, replay
+
+
+class RecordReplayTestCase(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp() + '.json.gz'
+        self.couch = fake.FakeCouchDB(seed=0)
+        self.couch.addView('design', 'all',
+            lambda doc: [(doc['_id'], None)])
+        self.couch.faults.bandwidth = 100000
+        self.couch.faults.chunkSize = 100
+        port = self.couch.listen()
+        self.addCleanup(port.stopListening)
+        self.recorder = replay.Recorder(self.path)
+        self.db = client.CouchDB('127.0.0.1', port.getHost().port,
+            recorder=self.recorder)
+
+    @defer.inlineCallbacks
+    def record(self):
+        yield self.db.createDB('test')
+        yield self.db.bulkDocs('test', [{'_id': 'doc-%d' % i, 'i': i}
+            for i in range(10)])
+        doc = yield self.db.openDoc('test', 'doc-1')
+        rows = []
+        yield self.db.openView('test', 'design', 'all',
+            rowCallback=rows.append)
+        yield self.assertFailure(self.db.openDoc('test', 'missing'),
+            tw_error.Error)
+        self.recorder.close()
+        defer.returnValue((doc, rows))
+
+    def replayer(self, **kwargs):
+        agent = replay.ReplayAgent(replay.load(self.path), **kwargs)
+        return client.CouchDB('127.0.0.1', 1, agent=agent)
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        doc, rows = yield self.record()
+        self.assertEquals(self.recorder.exchanges, 5)
+        exchanges = replay.load(self.path)
+        self.assertEquals(exchanges[2]['uri'], '/test/doc-1')
+        self.failUnless(len(exchanges[3]['chunks']) > 1)
+
+        db = self.replayer(speed=None)
+        yield db.createDB('test')
+        yield db.bulkDocs('test', [{'_id': 'doc-%d' % i, 'i': i}
+            for i in range(10)])
+        replayed = yield db.openDoc('test', 'doc-1')
+        self.assertEquals(replayed, doc)
+        replayedRows = []
+        yield db.openView('test', 'design', 'all',
+            rowCallback=replayedRows.append)
+        self.assertEquals(replayedRows, rows)
+        e = yield self.assertFailure(db.openDoc('test', 'missing'),
+            tw_error.Error)
+        self.assertEquals(int(e.status), 404)
+
+    @defer.inlineCallbacks
+    def test_mismatch(self):
+        yield self.record()
+        db = self.replayer(speed=None)
+        # the body differs from the recorded one
+        yield self.assertFailure(db.bulkDocs('test', []),
+            replay.ReplayMismatchError)
+        yield db.openDoc('test', 'doc-1')
+        yield self.assertFailure(db.openDoc('test', 'doc-1'),
+            replay.ReplayMismatchError)
+
+        db = self.replayer(speed=None, repeat=True)
+        yield db.openDoc('test', 'doc-1')
+        yield db.openDoc('test', 'doc-1')
+
+    @defer.inlineCallbacks
+    def test_changes(self):
+        received = []
+        notified = defer.Deferred()
+        lost = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                received.append(change)
+                if change['id'] == 'two':
+                    notified.callback(None)
+
+            def connectionLost(self, reason):
+                lost.callback(None)
+
+        yield self.db.createDB('test')
+        notifier = changes.ChangeNotifier(self.db, 'test')
+        notifier.addListener(Listener())
+        yield notifier.start()
+        yield self.db.saveDoc('test', {}, docId='one')
+        yield self.db.saveDoc('test', {}, docId='two')
+        yield notified
+        notifier.stop()
+        yield lost
+        self.recorder.close()
+        recorded = [change['id'] for change in received]
+        self.assertEquals(recorded, ['one', 'two'])
+
+        del received[:]
+        notified = defer.Deferred()
+        lost = defer.Deferred()
+        db = self.replayer(speed=None)
+        yield db.createDB('test')
+        notifier = changes.ChangeNotifier(db, 'test')
+        notifier.addListener(Listener())
+        yield notifier.start()
+        yield notified
+        notifier.stop()
+        yield lost
+        self.assertEquals([change['id'] for change in received], recorded)
+
+
+class ReplayAgentTestCase(TestCase):
+
+    exchange = {
+        'method': 'GET', 'uri': '/test', 'body': None,
+        'status': 200, 'phrase': 'OK',
+        'headers': [('Content-Type', ['application/json'])],
+        'headersAt': 1.0, 'chunks': [(2.0, u'{"a":'), (3.0, u' 1}')],
+        'end': 4.0, 'error': None,
+    }
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_speed(self):
+        """
+        Responses are replayed at the recorded timings, sped up.
+        """
+        agent = replay.ReplayAgent([self.exchange], speed=2.0,
+            clock=self.clock)
+        db = client.CouchDB('127.0.0.1', 1, agent=agent)
+        db._clock = self.clock
+        results = []
+        db.get('/test').addCallback(db.parseResult).addCallback(
+            results.append)
+        self.clock.advance(1.9)
+        self.assertEquals(results, [])
+        self.clock.advance(0.1)
+        self.assertEquals(results, [{u'a': 1}])
+
+    def test_error(self):
+        exchange = dict(self.exchange, status=None, phrase=None,
+            headersAt=None, chunks=[], end=0.5, error='ConnectionRefusedError')
+        agent = replay.ReplayAgent([exchange], clock=self.clock)
+        d = agent.request('GET', 'http://localhost:5984/test')
+        self.clock.advance(0.5)
+        return self.assertFailure(d, replay.error.ConnectionRefusedError)
@@ -0,0 +1,139 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for retrying requests.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import client, retry
+
+
+class FlakyCouchDB(client.CouchDB):
+    """
+    A couchdb client whose requests fail with the given failures first.
+    """
+
+    def __init__(self, failures, *args, **kwargs):
+        client.CouchDB.__init__(self, *args, **kwargs)
+        self.failures = list(failures)
+        self.requests = []
+
+    def _getPage(self, uri, **kwargs):
+        self.requests.append((uri, kwargs))
+        if self.failures:
+            return defer.fail(self.failures.pop(0))
+        if kwargs.get('parse'):
+            return defer.succeed(self.parseResult('{"ok": true}'))
+        return defer.succeed('{"ok": true}')
+
+
+class RetryPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = retry.RetryPolicy(maxRetries=3, initialDelay=1,
+            jitter=0, clock=self.clock)
+
+    def couch(self, *failures):
+        return FlakyCouchDB(failures, 'localhost', retryPolicy=self.policy)
+
+    def test_delay(self):
+        self.assertEquals([self.policy.delay(i) for i in range(6)],
+            [1, 2, 4, 8, 10, 10])
+        self.policy.jitter = 0.5
+        self.policy._random = lambda: 1.0
+        self.assertEquals(self.policy.delay(2), 2)
+
+    def test_retried(self):
+        couch = self.couch(error.ConnectionLost(),
+            tw_error.Error(503, '{}'))
+        d = couch.openDoc('test', 'a')
+        self.assertEquals(len(couch.requests), 1)
+        self.clock.advance(1)
+        self.assertEquals(len(couch.requests), 2)
+        self.failIf(d.called)
+        self.clock.advance(2)
+        self.assertEquals(len(couch.requests), 3)
+        self.assertEquals(self.policy.retries, {'openDoc': 2})
+        d.addCallback(self.assertEquals, {'ok': True})
+        return d
+
+    def test_maxRetries(self):
+        couch = self.couch(*[tw_error.Error(503, '{}')] * 5)
+        d = couch.listDB()
+        self.clock.pump([1, 2, 4, 8])
+        self.assertEquals(len(couch.requests), 4)
+        self.assertEquals(self.policy.exhausted, {'listDB': 1})
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_notTransient(self):
+        couch = self.couch(tw_error.Error(409, '{}'))
+        d = couch.saveDoc('test', {}, 'a')
+        self.assertEquals(len(couch.requests), 1)
+        self.assertEquals(self.policy.retries, {})
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_notIdempotent(self):
+        """
+        Saving a document without an id is not retried once it may have
+        reached the server, since it would create the document twice.
+        """
+        couch = self.couch(error.ConnectionLost())
+        d = couch.saveDoc('test', {})
+        self.clock.advance(10)
+        self.assertEquals(len(couch.requests), 1)
+        return self.assertFailure(d, error.ConnectionLost)
+
+    def test_notSent(self):
+        couch = self.couch(error.ConnectionRefusedError())
+        d = couch.saveDoc('test', {})
+        self.clock.advance(1)
+        self.assertEquals(len(couch.requests), 2)
+        return d
+
+    def test_idempotentPost(self):
+        couch = self.couch(error.ConnectionLost())
+        d = couch.listDoc('test', keys=['a'])
+        self.clock.advance(1)
+        self.assertEquals(len(couch.requests), 2)
+        return d
+
+    def test_budget(self):
+        """
+        Once the budget is spent, failed requests are not retried until
+        enough time passed.
+        """
+        self.policy.minRetries = 1
+        self.policy.budget = 0
+        couch = self.couch(error.ConnectionLost())
+        first = couch.listDB()
+        self.clock.advance(1)
+        self.assertEquals(self.policy.retries, {'listDB': 1})
+
+        couch.failures.append(error.ConnectionLost())
+        second = self.assertFailure(couch.listDB(), error.ConnectionLost)
+        self.assertEquals(self.policy.exhausted, {'listDB': 1})
+
+        self.clock.advance(10)
+        couch.failures.append(error.ConnectionLost())
+        third = couch.listDB()
+        self.clock.advance(1)
+        self.assertEquals(self.policy.retries, {'listDB': 2})
+        self.assertEquals(len(couch.requests), 5)
+        return defer.gatherResults([first, second, third])
+
+    def test_cancel(self):
+        couch = self.couch(error.ConnectionLost())
+        d = couch.listDB()
+        d.cancel()
+        self.clock.advance(1)
+        self.assertEquals(len(couch.requests), 1)
+        self.failIf(self.clock.getDelayedCalls())
+        return self.assertFailure(d, defer.CancelledError)
@@ -0,0 +1,139 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_slowlog -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the slow request log.
+"""
+
+import logging
+
+from twisted.internet import reactor, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web import server
+
+from paisley import client, slowlog
+from paisley.test.test_metrics import StatusResource
+
+
+class SlowRequestLogTestCase(TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.log = slowlog.SlowRequestLog(threshold=1.0,
+            thresholds={'openView': 5.0}, sizeThreshold=1000,
+            hook=self.records.append)
+        self.clock = task.Clock()
+
+    def timing(self, descr, total, received=10):
+        timing = client.RequestTiming('GET', '/test/' + 'x' * 300, descr,
+            'test')
+        timing.status = 200
+        timing.headers = timing.start + total / 2
+        timing.done = timing.start + total
+        timing.received = received
+        return timing
+
+    def test_thresholds(self):
+        self.failIf(self.log.check(self.timing('openDoc', 0.5)))
+        self.failIf(self.log.check(self.timing('openView', 2.0)))
+        self.assertEquals(self.records, [])
+
+        record = self.log.check(self.timing('openDoc', 2.0))
+        self.assertEquals(self.records, [record])
+        self.assertEquals(record['reasons'], ['latency'])
+        self.assertEquals((record['descr'], record['db'], record['status']),
+            ('openDoc', 'test', 200))
+        self.assertEquals(record['uri'], client.short_print('/test/' +
+            'x' * 300))
+        self.assertEquals(sorted(record['phases'].keys()),
+            ['body', 'connect', 'decode', 'firstByte'])
+
+    def test_size(self):
+        record = self.log.check(self.timing('openView', 0.1, received=2000))
+        self.assertEquals(record['reasons'], ['size'])
+        self.assertEquals(record['bytes'], 2000)
+
+    def test_disabled(self):
+        self.log.thresholds['openDoc'] = None
+        self.failIf(self.log.check(self.timing('openDoc', 10)))
+
+    def test_queue(self):
+        self.clock.callLater(0, lambda: None)
+        self.clock.callLater(10, lambda: None)
+        record = self.log.check(self.timing('openDoc', 2.0), self.clock)
+        self.assertEquals(record['queueDepth'], 1)
+        self.assertEquals(record['delayedCalls'], 2)
+
+    def test_logged(self):
+        logged = []
+
+        class Handler(logging.Handler):
+
+            def emit(self, record):
+                logged.append(record)
+
+        logger = logging.getLogger('paisley.test.slow')
+        handler = Handler()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.log.log = logger
+
+        self.log.check(self.timing('openDoc', 2.0, received=2000))
+        [record] = logged
+        self.assertEquals(record.levelno, logging.WARNING)
+        self.assertEquals(record.reasons, ['latency', 'size'])
+        self.failUnless(record.getMessage().startswith(
+            'slow request (latency,size): GET /test/'))
+
+
+class ConnectedSlowRequestLogTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = StatusResource()
+        port = reactor.listenTCP(0, server.Site(self.resource),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.records = []
+        self.log = slowlog.SlowRequestLog(threshold=0,
+            hook=self.records.append)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            slowLog=self.log)
+
+    def test_view(self):
+        d = self.client.openView('test', 'design', 'view')
+
+        def viewedCb(_):
+            [record] = self.records
+            self.assertEquals((record['method'], record['descr'],
+                record['db'], record['status'], record['rows']),
+                ('GET', 'openView', 'test', 200, 2))
+            self.failUnless('parse' in record['phases'])
+            self.failIf(record['queueDepth'] is None)
+        d.addCallback(viewedCb)
+        return d
+
+    def test_streamed(self):
+        d = self.client.openView('test', 'design', 'view',
+            rowCallback=lambda row: None)
+
+        def viewedCb(_):
+            [record] = self.records
+            self.assertEquals(record['rows'], 2)
+        d.addCallback(viewedCb)
+        return d
+
+    def test_failed(self):
+        self.resource.code = 404
+        d = self.assertFailure(self.client.openDoc('test', 'a'),
+            tw_error.Error)
+
+        def failedCb(_):
+            [record] = self.records
+            self.assertEquals(record['status'], 404)
+            self.failUnless(record['bytes'] > 0)
+        d.addCallback(failedCb)
+        return d
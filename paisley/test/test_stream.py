@@ -0,0 +1,162 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_stream -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the streaming view result parser.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import server
+from twisted.web._newclient import ResponseDone
+from twisted.python.failure import Failure
+
+from paisley import client, stream
+from paisley import pjson as json
+
+from paisley.test.test_client import FakeCouchDBResource
+
+RESULT = {
+    u'total_rows': 3,
+    u'offset': 0,
+    u'rows': [
+        {u'id': u'a', u'key': u'a', u'value': {u'text': u'brackets ] } [ {'}},
+        {u'id': u'b', u'key': [u'b', 1], u'value': u'quote \\" and \\\\'},
+        {u'id': u'c', u'key': u'c', u'value': u'\u201cI\xf1t\xebrn\u201d'},
+    ],
+}
+
+
+class RowParserTestCase(TestCase):
+
+    def parse(self, text, size=None):
+        rows = []
+        parser = stream.RowParser(rows.append)
+        if size is None:
+            parser.feed(text)
+        else:
+            for i in range(0, len(text), size):
+                parser.feed(text[i:i + size])
+        return parser.finish(), rows
+
+    def test_whole(self):
+        envelope, rows = self.parse(json.dumps(RESULT))
+        self.assertEquals(rows, RESULT['rows'])
+        self.assertEquals(envelope,
+            {u'total_rows': 3, u'offset': 0, u'rows': []})
+
+    def test_chunked(self):
+        """
+        Rows are parsed correctly wherever the chunks are split, including
+        inside strings and escapes.
+        """
+        text = json.dumps(RESULT)
+        for size in (1, 2, 3, 7, 64):
+            envelope, rows = self.parse(text, size)
+            self.assertEquals(rows, RESULT['rows'])
+            self.assertEquals(envelope[u'total_rows'], 3)
+
+    def test_couchFormat(self):
+        """
+        Test the layout CouchDB uses, with rows on their own lines and keys
+        after the rows.
+        """
+        text = '{"total_rows":2,"offset":0,"rows":[\r\n' \
+            '{"id":"1","key":1,"value":null},\r\n' \
+            '{"id":"2","key":2,"value":[1,2]}\r\n' \
+            '],"update_seq":5}\n'
+        envelope, rows = self.parse(text, 5)
+        self.assertEquals(envelope,
+            {u'total_rows': 2, u'offset': 0, u'rows': [], u'update_seq': 5})
+        self.assertEquals([row['key'] for row in rows], [1, 2])
+        self.assertEquals(rows[1]['value'], [1, 2])
+
+    def test_arrayBeforeRows(self):
+        text = '{"keys":[["rows"]],"rows":[{"key":1}]}'
+        envelope, rows = self.parse(text, 4)
+        self.assertEquals(envelope, {u'keys': [[u'rows']], u'rows': []})
+        self.assertEquals(rows, [{u'key': 1}])
+
+    def test_noRows(self):
+        envelope, rows = self.parse('{"error":"not_found","reason":"missing"}')
+        self.assertEquals(envelope[u'error'], u'not_found')
+        self.assertEquals(rows, [])
+
+    def test_emptyRows(self):
+        envelope, rows = self.parse('{"rows":[]}')
+        self.assertEquals(envelope, {u'rows': []})
+        self.assertEquals(rows, [])
+
+    def test_rowsAsSoonAsComplete(self):
+        rows = []
+        parser = stream.RowParser(rows.append)
+        parser.feed('{"rows":[{"key":1}')
+        self.assertEquals(rows, [{u'key': 1}])
+        parser.feed(',{"key":2')
+        self.assertEquals(len(rows), 1)
+        parser.feed('}]}')
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(parser.rows, 2)
+
+
+class RowReceiverTestCase(TestCase):
+
+    def test_utf8(self):
+        d = defer.Deferred()
+        rows = []
+        receiver = stream.RowReceiver(d, True, rows.append)
+
+        for c in json.dumps(RESULT, ensure_ascii=False).encode('utf-8'):
+            receiver.dataReceived(c)
+        receiver.connectionLost(Failure(ResponseDone()))
+
+        def cb(envelope):
+            self.assertEquals(envelope[u'rows'], [])
+            self.assertEquals(rows, RESULT['rows'])
+        return d.addCallback(cb)
+
+    def test_callbackFails(self):
+        d = defer.Deferred()
+
+        def rowCallback(row):
+            raise ValueError(row)
+        receiver = stream.RowReceiver(d, False, rowCallback)
+
+        receiver.dataReceived('{"rows":[{"key":1},')
+        receiver.dataReceived('{"key":2}]}')
+        receiver.connectionLost(Failure(ResponseDone()))
+        return self.assertFailure(d, ValueError)
+
+
+class ConnectedStreamTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = FakeCouchDBResource()
+        self.resource.result = json.dumps(RESULT)
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port)
+
+    def test_openView(self):
+        rows = []
+        d = self.client.openView('test', 'design', 'view',
+            rowCallback=rows.append, include_docs=True)
+
+        def cb(result):
+            self.assertEquals(result[u'rows'], [])
+            self.assertEquals(result[u'total_rows'], 3)
+            self.assertEquals(rows, RESULT['rows'])
+        return d.addCallback(cb)
+
+    def test_listDoc(self):
+        rows = []
+        d = self.client.listDoc('test', rowCallback=rows.append)
+
+        def cb(result):
+            self.assertEquals(result[u'offset'], 0)
+            self.assertEquals(rows, RESULT['rows'])
+        return d.addCallback(cb)
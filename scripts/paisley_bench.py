@@ -4,91 +4,117 @@
 # Copyright (c) 2007-2008
 # See LICENSE for details.
 
+"""
+Benchmark paisley against a CouchDB server.
 
-import time
+Runs the scenarios of L{paisley.bench} at every concurrency level, prints
+their throughput and latency percentiles, and optionally writes them as
+JSON and compares them to a baseline written before, exiting with status 1
+if any regressed.
+"""
+
+import optparse
 import sys
-import numpy
 
 import paisley
-
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, waitForDeferred
-
-def benchmark(times, timer=time.time, timeStore=None, progressDest=sys.stdout):
-    def _decorator(f):
-        def _decorated(*args, **kwargs):
-            for x in xrange(times):
-                startTime=timer()
-                result = yield f(*args, **kwargs)
-                timeStore.setdefault(f.__name__, []).append(timer()-startTime)
-
-                if x%(times*.10) == 0.0:
-                    progressDest.write('.')
-                    progressDest.flush()
-            progressDest.write('\n')
-
-        _decorated.__name__ = f.__name__
-
-        return inlineCallbacks(_decorated)
-
-    return _decorator
-
-RUN_TIMES = 1000
-TIMES = {}
-
-benchmarkDecorator = benchmark(RUN_TIMES, timeStore=TIMES)
-
-
-@benchmarkDecorator
-def bench_saveDoc(server):
-    d = server.saveDoc('benchmarks', """
-        {
-            "Subject":"I like Planktion",
-            "Author":"Rusty",
-            "PostedDate":"2006-08-15T17:30:12-04:00",
-            "Tags":["plankton", "baseball", "decisions"],
-            "Body":"I decided today that I don't like baseball. I like plankton."
-        }
-""")
-    return d
-
-
-@inlineCallbacks
-def run_tests(server):
-    for bench in [bench_saveDoc]:
-        print "benchmarking %s" % (bench.__name__,)
-        result = yield bench(server).addCallback(_printCb)
-        print "    avg: %r" % (
-            sum(TIMES[bench.__name__])/len(TIMES[bench.__name__]),)
-        print "    std: %r" % (
-            numpy.std(TIMES[bench.__name__]),)
-        print "    min: %r" % (
-            min(TIMES[bench.__name__]),)
-        print "    max: %r" % (
-            max(TIMES[bench.__name__]),)
-        print "  total: %r" % (
-            sum(TIMES[bench.__name__]),)
-
-
-def run():
-    s = paisley.CouchDB('localhost')
-    d = s.createDB('benchmarks')
-    d.addBoth(_printCb)
-    d.addCallback(lambda _: run_tests(s))
-
-    return d
-
-
-def _printCb(msg):
-    if msg is not None:
-        print msg
+from paisley import bench, fake
+
+from twisted.internet import defer, reactor
+
+
+def parseOptions(argv):
+    names = [s.name for s in bench.SCENARIOS]
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-H', '--host', default='localhost',
+        help="host of the CouchDB server [default: %default]")
+    parser.add_option('-p', '--port', type='int', default=5984,
+        help="port of the CouchDB server [default: %default]")
+    parser.add_option('--fake', action='store_true', default=False,
+        help="run against an in-process fake CouchDB instead")
+    parser.add_option('--fake-latency', type='float', default=0.0,
+        help="number of seconds the fake CouchDB waits before responding "
+             "[default: %default]")
+    parser.add_option('-d', '--database', default='paisley-benchmarks',
+        help="database to create for every scenario [default: %default]")
+    parser.add_option('-s', '--scenario', action='append', dest='scenarios',
+        choices=names, metavar='NAME',
+        help="scenario to run, out of %s; can be repeated "
+             "[default: all]" % (', '.join(names), ))
+    parser.add_option('-c', '--concurrency', default='1,10,50',
+        help="comma-separated numbers of requests in flight "
+             "[default: %default]")
+    parser.add_option('-n', '--requests', type='int', default=1000,
+        help="number of requests per scenario and concurrency "
+             "[default: %default]")
+    parser.add_option('--persistent', action='store_true', default=False,
+        help="keep connections alive")
+    parser.add_option('-o', '--output',
+        help="file to write the results to as JSON")
+    parser.add_option('-b', '--baseline',
+        help="JSON results to compare the results to")
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+        help="fraction a result may be worse than the baseline "
+             "[default: %default]")
+    options, args = parser.parse_args(argv)
+    options.concurrency = [int(c) for c in options.concurrency.split(',')]
+    return options
+
+
+@defer.inlineCallbacks
+def main(options):
+    if options.fake:
+        couch = fake.FakeCouchDB()
+        couch.addView('bench', 'index',
+            lambda doc: [(doc.get('index'), None)])
+        couch.faults.latency = options.fake_latency
+        port = couch.listen()
+        options.host, options.port = '127.0.0.1', port.getHost().port
+    db = paisley.CouchDB(options.host, options.port,
+        persistent=options.persistent)
+    scenarios = bench.SCENARIOS
+    if options.scenarios:
+        scenarios = [s for s in scenarios if s.name in options.scenarios]
+
+    def log(line):
+        print line
+        sys.stdout.flush()
+
+    summaries = []
+    for scenario in scenarios:
+        results = yield bench.runScenario(scenario, db, options.database,
+            options.requests, options.concurrency, log=log)
+        summaries.extend([result.summary() for result in results])
+    yield db.deleteDB(options.database)
+    yield db.close()
+
+    if options.output:
+        bench.save(summaries, options.output)
+
+    regressions = []
+    if options.baseline:
+        regressions = bench.compare(summaries,
+            bench.load(options.baseline), options.tolerance)
+        for r in regressions:
+            print "REGRESSION %s c=%d %s: %r -> %r (%+.1f%%)" % (
+                r['name'], r['concurrency'], r['metric'], r['baseline'],
+                r['result'], r['change'] * 100)
+    defer.returnValue(regressions and 1 or 0)
 
 
 if __name__ == '__main__':
+    options = parseOptions(sys.argv[1:])
+    status = []
+
     def _run():
-        d = run()
-        d.addBoth(_printCb)
+        d = main(options)
+        d.addCallback(status.append)
+
+        def _errback(failure):
+            failure.printTraceback(sys.stderr)
+            status.append(2)
+        d.addErrback(_errback)
         d.addBoth(lambda _: reactor.stop())
 
     reactor.callWhenRunning(_run)
     reactor.run()
+    sys.exit(status and status[0] or 0)
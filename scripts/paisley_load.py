@@ -0,0 +1,193 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Find the request rate a paisley client configuration saturates at.
+
+Sends an open-loop mix of requests to a CouchDB server at increasing
+rates, printing the latency corrected for coordinated omission at every
+rate, until a rate is not sustained.
+"""
+
+import optparse
+import random
+import sys
+
+import paisley
+from paisley import batch, bench, cache, client, fake, load
+
+from twisted.internet import defer, reactor
+
+OPERATIONS = ('openDoc', 'saveDoc', 'openView', 'listDoc')
+
+
+def parseOptions(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-H', '--host', default='localhost',
+        help="host of the CouchDB server [default: %default]")
+    parser.add_option('-p', '--port', type='int', default=5984,
+        help="port of the CouchDB server [default: %default]")
+    parser.add_option('--fake', action='store_true', default=False,
+        help="run against an in-process fake CouchDB instead")
+    parser.add_option('--fake-latency', type='float', default=0.0,
+        help="number of seconds the fake CouchDB waits before responding "
+             "[default: %default]")
+    parser.add_option('-d', '--database', default='paisley-load',
+        help="database to create [default: %default]")
+    parser.add_option('-r', '--rates', default='50,100,200,400,800,1600',
+        help="comma-separated request rates per second to sweep "
+             "[default: %default]")
+    parser.add_option('-D', '--duration', type='float', default=10,
+        help="number of seconds to run every rate [default: %default]")
+    parser.add_option('-m', '--mix', default='openDoc:8,saveDoc:1,openView:1',
+        help="comma-separated operation:weight pairs, out of %s "
+             "[default: %%default]" % (', '.join(OPERATIONS), ))
+    parser.add_option('--documents', type='int', default=1000,
+        help="number of documents to open [default: %default]")
+    parser.add_option('--pool-size', type='int', default=0,
+        help="number of persistent connections to keep; 0 to not keep "
+             "connections alive [default: %default]")
+    parser.add_option('--batch', action='store_true', default=False,
+        help="batch saveDoc with BulkWriter and openDoc with DocLoader")
+    parser.add_option('--cache', type='int', default=0,
+        help="number of documents to cache for openDoc [default: %default]")
+    parser.add_option('--max-in-flight', type='int',
+        help="maximum number of requests in flight")
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+        help="fraction the achieved rate may be below the target rate "
+             "[default: %default]")
+    parser.add_option('--max-latency', type='float',
+        help="number of seconds the corrected p99 latency may be at most")
+    parser.add_option('-o', '--output',
+        help="file to write the results to as JSON")
+    options, args = parser.parse_args(argv)
+    options.rates = [float(r) for r in options.rates.split(',')]
+    options.mix = [(name, float(weight)) for name, weight in
+        [pair.split(':') for pair in options.mix.split(',')]]
+    for name, weight in options.mix:
+        if name not in OPERATIONS:
+            parser.error("unknown operation %r" % (name, ))
+    return options
+
+
+def makeMix(db, options):
+    """
+    @returns: the operations of the mix, through the batchers and cache of
+              the options.
+    """
+    dbName = options.database
+    openDoc = lambda docId: db.openDoc(dbName, docId)
+    saveDoc = lambda doc: db.saveDoc(dbName, doc)
+    if options.batch:
+        loader = batch.DocLoader(db)
+        openDoc = lambda docId: loader.openDoc(dbName, docId)
+        writer = batch.BulkWriter(db)
+        saveDoc = lambda doc: writer.saveDoc(dbName, doc)
+    if options.cache:
+        docCache = cache.DocumentCache(db, dbName, maxEntries=options.cache)
+        openDoc = docCache.openDoc
+
+    operations = {
+        'openDoc': lambda: openDoc(u'doc-%d' % (
+            random.randrange(options.documents), )),
+        'saveDoc': lambda: saveDoc(bench.DOCUMENT),
+        'openView': lambda: db.openView(dbName, 'bench', 'index',
+            limit=10),
+        'listDoc': lambda: db.listDoc(dbName, include_docs=True, limit=10),
+    }
+    return [(name, weight, operations[name])
+        for name, weight in options.mix]
+
+
+def describe(result):
+    summary = result.summary()
+    line = '%8.1f req/s  achieved %8.1f' % (summary['rate'],
+        summary['achieved'] or 0)
+    for name in ('p50', 'p90', 'p99', 'p999', 'max'):
+        line += '  %s %8.2f ms' % (name,
+            (summary['latency'][name] or 0) * 1000)
+    line += '  uncorrected p99 %8.2f ms' % (
+        (summary['service']['p99'] or 0) * 1000, )
+    errors = sum(summary['errors'].values())
+    if errors:
+        line += '  %d errors' % (errors, )
+    return line
+
+
+@defer.inlineCallbacks
+def setUp(db, options):
+    dbName = options.database
+    try:
+        yield db.deleteDB(dbName)
+    except Exception:
+        pass
+    yield db.createDB(dbName)
+    yield db.saveDoc(dbName, {"views": {"index": {
+        "map": "function(doc) { emit(doc.index, null); }"}}},
+        docId='_design/bench')
+    yield db.bulkDocs(dbName, [dict(bench.DOCUMENT, _id=u'doc-%d' % index,
+        index=index) for index in range(options.documents)])
+    # build the view index before loading it
+    yield db.openView(dbName, 'bench', 'index', limit=1)
+
+
+@defer.inlineCallbacks
+def main(options):
+    pool = None
+    if options.pool_size:
+        pool = client.makePool(maxPersistentPerHost=options.pool_size)
+    if options.fake:
+        couch = fake.FakeCouchDB()
+        couch.addView('bench', 'index',
+            lambda doc: [(doc.get('index'), None)])
+        couch.faults.latency = options.fake_latency
+        port = couch.listen()
+        options.host, options.port = '127.0.0.1', port.getHost().port
+    db = paisley.CouchDB(options.host, options.port, pool=pool)
+    yield setUp(db, options)
+
+    def log(result):
+        print describe(result)
+        sys.stdout.flush()
+
+    results = yield load.sweep(makeMix(db, options), options.rates,
+        options.duration, maxInFlight=options.max_in_flight,
+        tolerance=options.tolerance, maxLatency=options.max_latency, log=log)
+    rate = load.saturation(results, options.tolerance, options.max_latency)
+    if rate is None:
+        print "saturated below %.1f req/s" % (options.rates[0], )
+    else:
+        print "sustained up to %.1f req/s" % (rate, )
+
+    if options.output:
+        handle = open(options.output, 'w')
+        handle.write(client.json.dumps({
+            'saturation': rate,
+            'results': [result.summary() for result in results],
+        }, indent=2, sort_keys=True))
+        handle.close()
+
+    yield db.deleteDB(options.database)
+    if pool is not None:
+        yield pool.closeCachedConnections()
+
+
+if __name__ == '__main__':
+    options = parseOptions(sys.argv[1:])
+    status = []
+
+    def _run():
+        d = main(options)
+
+        def _errback(failure):
+            failure.printTraceback(sys.stderr)
+            status.append(2)
+        d.addErrback(_errback)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+    sys.exit(status and status[0] or 0)
@@ -0,0 +1,72 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Microbenchmark the JSON decoding and document mapping hot paths.
+
+Runs the benchmarks of L{paisley.microbench}, prints their nanoseconds
+and objects per operation, and optionally writes them as JSON and
+compares them to a baseline written before, exiting with status 1 if any
+regressed.
+"""
+
+import optparse
+import sys
+
+from paisley import bench, microbench
+
+
+def parseOptions(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [PREFIX...]",
+        description="Run the benchmarks whose name starts with one of the "
+                    "prefixes, or all of them.")
+    parser.add_option('-m', '--min-time', type='float', default=0.2,
+        help="number of seconds every loop of a benchmark runs at least "
+             "[default: %default]")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help="number of loops to take the fastest of [default: %default]")
+    parser.add_option('-l', '--list', action='store_true', default=False,
+        help="list the benchmarks and exit")
+    parser.add_option('-o', '--output',
+        help="file to write the results to as JSON")
+    parser.add_option('-b', '--baseline',
+        help="JSON results to compare the results to")
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+        help="fraction a result may be worse than the baseline "
+             "[default: %default]")
+    options, args = parser.parse_args(argv)
+    options.names = args
+    return options
+
+
+def main(options):
+    if options.list:
+        for name, setUp in microbench.benchmarks():
+            print name
+        return 0
+
+    def log(result):
+        print microbench.describe(result)
+        sys.stdout.flush()
+
+    results = microbench.runAll(options.names, minTime=options.min_time,
+        repeat=options.repeat, log=log)
+    if options.output:
+        bench.save(results, options.output)
+
+    regressions = []
+    if options.baseline:
+        regressions = microbench.compare(results,
+            bench.load(options.baseline), options.tolerance)
+        for r in regressions:
+            print "REGRESSION %s %s: %r -> %r (%+.1f%%)" % (
+                r['name'], r['metric'], r['baseline'], r['result'],
+                r['change'] * 100)
+    return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parseOptions(sys.argv[1:])))